@@ -0,0 +1,75 @@
+import os
+import tempfile
+import time
+import fire
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader
+
+from datasource import CsvImagesDataset, ShardImagesDataset, common_transform, normalize_batch, shards_path
+from pack_shards import pack
+
+
+def measure(dataset, batch_size: int, num_workers: int, batches: int, normalize: bool) -> float:
+    """ Images per second of the training loader on CPU, the first batch warming up the workers is not counted """
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=True)
+    batches = min(batches, len(loader))
+    iterator = iter(loader)
+    next(iterator)
+    start = time.time()
+    for _ in range(batches - 1):
+        images = next(iterator)
+        if normalize:
+            normalize_batch(images)
+    return (batches - 1) * batch_size / (time.time() - start)
+
+
+def make_images(root: str, count: int, size: tuple[int, int], seed: int = 0) -> str:
+    """ csv file of `count` random photo-sized jpgs """
+    rng = np.random.default_rng(seed)
+    # smooth noise compresses and decodes more like photos than white noise
+    small = rng.integers(0, 256, (count, size[1] // 16, size[0] // 16, 3), dtype=np.uint8)
+    paths = []
+    for i in range(count):
+        path = os.path.join(root, f"{i:05d}.jpg")
+        Image.fromarray(small[i]).resize(size, Image.BILINEAR).save(path, quality=90)
+        paths.append(path)
+    csv_file = os.path.join(root, "images.csv")
+    with open(csv_file, 'w') as f:
+        f.write("\n".join(paths) + "\n")
+    return csv_file
+
+
+def benchmark(
+    csv_file: str | None = None,
+    synthetic: int = 512,
+    size: tuple[int, int] = (1280, 960),
+    batch_size: int = 96,
+    num_workers: int | None = None,
+    batches: int = 20,
+) -> None:
+    """
+        Training loader throughput of the csv + jpg path against packed shards, on CPU.
+        Uses the shards next to `csv_file`, packing them first if needed,
+        or `synthetic` random jpgs of `size` without a csv file
+    """
+    num_workers = num_workers if num_workers is not None else max(4, os.cpu_count() // 2)
+    torch.set_num_threads(1)
+    with tempfile.TemporaryDirectory() as root:
+        if csv_file is None:
+            csv_file = make_images(root, synthetic, size)
+        shards = shards_path(csv_file)
+        if not os.path.exists(shards):
+            pack(csv_file, shards, 4096, os.cpu_count())
+        results = {
+            "csv + jpg": measure(CsvImagesDataset(csv_file, common_transform(), True), batch_size, num_workers,
+                                 batches, False),
+            "shards": measure(ShardImagesDataset(shards, True), batch_size, num_workers, batches, True),
+        }
+    for name, rate in results.items():
+        print(f"{name:>10}: {rate:8.1f} images/s with {num_workers} workers")
+
+
+if __name__ == "__main__":
+    fire.Fire(benchmark)
@@ -1,6 +1,8 @@
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
+import json
 import os
+import random
 import pandas as pd
 import cv2
 from PIL import Image
@@ -11,33 +13,161 @@ from torchvision import transforms as tvt
 import lightning as L
 
 
+# mean and std taken from unicom.vision_transformer
+MEAN = (0.48145466, 0.4578275, 0.40821073)
+STD = (0.26862954, 0.26130258, 0.27577711)
+# image size is 224x224 because of the ViT-B/16 model
+IMAGE_SIZE = 224
+# views of every image stored by teacher_cache.py: original and horizontally flipped
+TEACHER_VIEWS = 2
+SHARDS_VERSION = 1
+SHARDS_INDEX = "index.json"
+# width of the resized image inside the padding, to flip only the image part
+SHARDS_WIDTHS = "widths.npy"
+
+
+def letterbox_transforms():
+    """ Resize the longest side to IMAGE_SIZE and pad to a centered square """
+    return [
+        A.LongestMaxSize(IMAGE_SIZE),
+        A.PadIfNeeded(IMAGE_SIZE, IMAGE_SIZE, border_mode=cv2.BORDER_CONSTANT, value=0),
+    ]
+
+
+def common_transform():
+    return A.Compose([
+        *letterbox_transforms(),
+        A.Normalize(mean=MEAN, std=STD),
+        ToTensorV2(),
+    ])
+
+
+def normalize_batch(images: torch.Tensor) -> torch.Tensor:
+    """ uint8 NCHW batch of letterboxed images normalized like `common_transform` """
+    mean = torch.tensor(MEAN, device=images.device).view(1, 3, 1, 1)
+    std = torch.tensor(STD, device=images.device).view(1, 3, 1, 1)
+    return (images.float() / 255 - mean) / std
+
+
+def teacher_cache_path(csv_file: str) -> str:
+    return os.path.splitext(csv_file)[0] + ".teacher.npy"
+
+
+def shards_path(csv_file: str) -> str:
+    return os.path.splitext(csv_file)[0] + ".shards"
+
+
+class TeacherCache():
+    """
+        Teacher embeddings of both views of every image made by teacher_cache.py.
+        Opened by every loader worker on first use, a memmap would be pickled with its data
+    """
+    def __init__(self, path, csv_file, count):
+        assert os.path.exists(path), f"{path} does not exist, run teacher_cache.py first"
+        assert os.path.getmtime(path) >= os.path.getmtime(csv_file), \
+            f"{csv_file} changed after {path} was made, run teacher_cache.py again"
+        self.path = path
+        self.count = count
+        self.targets = None
+
+    def get(self, idx, flipped):
+        if self.targets is None:
+            self.targets = np.load(self.path, mmap_mode='r')
+            assert self.targets.shape[:2] == (self.count, TEACHER_VIEWS), \
+                f"{self.path} doesn't match the dataset, run teacher_cache.py again"
+        return torch.from_numpy(np.array(self.targets[idx, int(flipped)]))
+
+
 class CsvImagesDataset(Dataset):
     """
         Read images from csv file
         csv file contains only image paths, without header
 
-        Target embeddings are not pre-computed because after augmentation
-        they need to be recomputed anyway
+        flip is the only augmentation, so the teacher embedding of an image has two possible values.
+        With `teacher_cache` made by teacher_cache.py the target of the drawn view is returned with the image
     """
     def __init__(
             self, 
             csv_file, 
-            transform=None
+            transform=None,
+            flip=False,
+            teacher_cache=None,
         ):
         self.csv_file = csv_file
         self.transform = transform
-        self.df = pd.read_csv(self.csv_file, header=None, names=["image_path"])
+        self.flip = flip
+        self.paths = pd.read_csv(self.csv_file, header=None, names=["image_path"])["image_path"].tolist()
+        self.teacher = TeacherCache(teacher_cache, csv_file, len(self)) if teacher_cache is not None else None
 
     def __len__(self):
-        return len(self.df)
+        return len(self.paths)
+
+    def read_rgb(self, idx):
+        img = cv2.imread(self.paths[idx])
+        assert img is not None, f"Can't read {self.paths[idx]}"
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
     def __getitem__(self, idx):
-        img_path = self.df.iloc[idx]["image_path"]
-        img = cv2.imread(img_path)
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        img = self.read_rgb(idx)
+        flipped = self.flip and random.random() < 0.5
+        if flipped:
+            img = cv2.flip(img, 1)
         if self.transform:
             img = self.transform(image=img)['image']
-        return img
+        if self.teacher is None:
+            return img
+        return img, self.teacher.get(idx, flipped)
+
+
+class ShardImagesDataset(Dataset):
+    """
+        Images of a csv file decoded and letterboxed once by pack_shards.py, in the same order.
+        Samples are slices of memory mapped uint8 shards, returned as uint8 CHW tensors without a copy,
+        `normalize_batch` turns whole batches into the input of the networks
+    """
+    def __init__(
+            self,
+            shards_dir,
+            flip=False,
+            teacher_cache=None,
+        ):
+        self.shards_dir = shards_dir
+        self.flip = flip
+        with open(os.path.join(shards_dir, SHARDS_INDEX)) as f:
+            index = json.load(f)
+        assert index["version"] == SHARDS_VERSION and index["size"] == IMAGE_SIZE, \
+            f"{shards_dir} was packed by another version, run pack_shards.py again"
+        self.files = [os.path.join(shards_dir, shard["file"]) for shard in index["shards"]]
+        self.starts = np.cumsum([0] + [shard["count"] for shard in index["shards"]])
+        self.widths = np.load(os.path.join(shards_dir, SHARDS_WIDTHS))
+        csv_file = index["csv"]
+        if os.path.exists(csv_file):
+            assert os.path.getmtime(shards_dir) >= os.path.getmtime(csv_file), \
+                f"{csv_file} changed after {shards_dir} was packed, run pack_shards.py again"
+        self.teacher = TeacherCache(teacher_cache, csv_file, len(self)) if teacher_cache is not None else None
+        # opened by every worker on first use
+        self.shards = None
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def __getitem__(self, idx):
+        if self.shards is None:
+            # copy on write keeps the pages shared and the arrays writable, so torch accepts them without a copy
+            self.shards = [np.load(file, mmap_mode='c') for file in self.files]
+        shard = np.searchsorted(self.starts, idx, side='right') - 1
+        img = self.shards[shard][idx - self.starts[shard]]
+        flipped = self.flip and random.random() < 0.5
+        if flipped:
+            # flipping the image part in place equals letterboxing the flipped original
+            width = int(self.widths[idx])
+            left = (IMAGE_SIZE - width) // 2
+            img = img.copy()
+            img[:, left:left + width] = img[:, left:left + width][:, ::-1].copy()
+        img = torch.from_numpy(img).permute(2, 0, 1)
+        if self.teacher is None:
+            return img
+        return img, self.teacher.get(idx, flipped)
 
 
 class ImagesDataModule(L.LightningDataModule):
@@ -47,33 +177,42 @@ class ImagesDataModule(L.LightningDataModule):
         val_csv: str,
         batch_size: int,
         num_workers: int,
+        cached_teacher: bool = False,
+        shards: bool = False,
     ) -> None:
+        """
+            cached_teacher: batches are (images, teacher embeddings) read from the caches next to the csv files
+            shards: read images packed by pack_shards.py next to the csv files instead of decoding the jpgs,
+                    they are normalized after the transfer to the device
+        """
         super().__init__()
         self.train_csv = train_csv
         self.val_csv = val_csv
         self.batch_size = batch_size
         self.num_workers = num_workers
-
-        # mean and std taken from unicom.vision_transformer
-        mean = (0.48145466, 0.4578275, 0.40821073)
-        std = (0.26862954, 0.26130258, 0.27577711)
-        # image size is 224x224 because of the ViT-B/16 model
-        common_transform = [
-            A.LongestMaxSize(224),
-            A.PadIfNeeded(224, 224, border_mode=cv2.BORDER_CONSTANT, value=0),
-            A.Normalize(mean=mean, std=std),
-            ToTensorV2(),
-        ]
-        self.train_transform = A.Compose([
-            A.HorizontalFlip(),
-            *common_transform
-        ])
-        self.val_transform = A.Compose(common_transform)
+        self.cached_teacher = cached_teacher
+        self.shards = shards
+        self.transform = common_transform()
 
     def setup(self, stage: str = None) -> None:
         if stage == "fit" or stage is None:
-            self.train_dataset = CsvImagesDataset(self.train_csv, self.train_transform)
-            self.val_dataset = CsvImagesDataset(self.val_csv, self.val_transform)
+            train_cache = teacher_cache_path(self.train_csv) if self.cached_teacher else None
+            val_cache = teacher_cache_path(self.val_csv) if self.cached_teacher else None
+            # horizontal flip is the only augmentation
+            if self.shards:
+                self.train_dataset = ShardImagesDataset(shards_path(self.train_csv), True, train_cache)
+                self.val_dataset = ShardImagesDataset(shards_path(self.val_csv), False, val_cache)
+            else:
+                self.train_dataset = CsvImagesDataset(self.train_csv, self.transform, True, train_cache)
+                self.val_dataset = CsvImagesDataset(self.val_csv, self.transform, False, val_cache)
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        if not self.shards:
+            return batch
+        if self.cached_teacher:
+            images, targets = batch
+            return normalize_batch(images), targets
+        return normalize_batch(batch)
 
     def train_dataloader(self):
         return DataLoader(
@@ -0,0 +1,118 @@
+import json
+import os
+import sys
+import tempfile
+import time
+import fire
+import numpy as np
+import pandas as pd
+from sklearn.decomposition import PCA
+from sklearn.preprocessing import normalize
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+sys.path.insert(0, SERVER_DIR)
+from application import RESPONSE_LIMIT  # noqa: E402
+from embedder import Embedder, _SimpleImagesListDataset  # noqa: E402
+from embedder_backends import IMAGE_SIZE, Backend, UnicomBackend, make_backend  # noqa: E402
+from embeddings import Embeddings  # noqa: E402
+from numpy_sorter import find_close_to_many  # noqa: E402
+
+
+def embed(backend: Backend, paths: list[str]) -> tuple[np.ndarray, float]:
+    """
+        Embeddings of the images the way the server makes them: draft jpg decoding, L2 normalized features
+        and a PCA to Embedder.embedding_dim fitted on them. Returns them with the rate, decoding included
+    """
+    # the teacher gets its transform when loaded
+    backend.load()
+    dataset = _SimpleImagesListDataset("", paths, transform=backend.transform, draft_size=IMAGE_SIZE)
+    loader = DataLoader(dataset, batch_size=backend.batch_size, num_workers=backend.num_workers)
+    start = time.perf_counter()
+    features = [normalize(backend(data), axis=1, norm='l2') for data, _ in tqdm(loader, desc=backend.name)]
+    elapsed = time.perf_counter() - start
+    backend.unload()
+    features = np.concatenate(features)
+    if features.shape[1] > Embedder.embedding_dim:
+        pca = PCA(n_components=min(Embedder.embedding_dim, len(features))).fit(features)
+        features = normalize(pca.transform(features), axis=1, norm='l2')
+    return features.astype(np.float32), len(paths) / elapsed
+
+
+def make_student(path: str, tmp_dir: str) -> Backend:
+    """ Exported students are used as they are, lightning checkpoints are exported to TorchScript first """
+    if path.endswith(".ckpt"):
+        from export import export
+        exported = os.path.join(tmp_dir, os.path.basename(path)[:-len(".ckpt")] + ".pt")
+        export(path, exported)
+        path = exported
+    return make_backend(path)
+
+
+def sort_results(embeddings: Embeddings, queries: list[set[str]], k: int) -> list[list[str]]:
+    return [[name for name, _ in find_close_to_many(query, embeddings, k)] for query in queries]
+
+
+def recall(student: list[list[str]], teacher: list[list[str]], k: int) -> float:
+    """ Share of the teacher top `k` the student also returns in its top `k`, averaged over queries """
+    return float(np.mean([len(set(s[:k]) & set(t[:k])) / max(1, len(t[:k])) for s, t in zip(student, teacher)]))
+
+
+def evaluate(
+    *students: str,
+    csv_file: str = 'data/test.csv',
+    images: int = 5000,
+    teacher_device: str = 'cuda:0',
+    queries: int = 200,
+    selection: int = 5,
+    ks: tuple[int, ...] = (10, 100, RESPONSE_LIMIT),
+    seed: int = 0,
+    output: str | None = None,
+) -> None:
+    """
+        Sort quality and CPU speed of students against the ViT-B/16 teacher on held-out images.
+        Every model embeds up to `images` images of `csv_file` like server/embedder.py does,
+        then the same random requests of `selection` items are sorted by server/numpy_sorter.py in every space.
+        recall@k is the share of the teacher's top k sort results the student also returns in its top k,
+        images/s includes jpg decoding. Students are .onnx or .pt exports, or lightning .ckpt checkpoints
+    """
+    assert students, "Pass at least one student"
+    paths = pd.read_csv(csv_file, header=None, names=["image_path"])["image_path"].tolist()
+    rng = np.random.default_rng(seed)
+    if len(paths) > images:
+        paths = sorted(rng.choice(paths, size=images, replace=False).tolist())
+    # names are unique within the library, the sorter works with names
+    names = [str(i) for i in range(len(paths))]
+    requests = [set(rng.choice(names, size=min(selection, len(names)), replace=False).tolist())
+                for _ in range(queries)]
+    depth = max(ks)
+
+    teacher = UnicomBackend(device=teacher_device)
+    vectors, rate = embed(teacher, paths)
+    reference = sort_results(Embeddings(names, vectors), requests, depth)
+    results = {teacher.name: {"images_per_second": rate, "device": teacher_device}}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for path in students:
+            backend = make_student(path, tmp_dir)
+            vectors, rate = embed(backend, paths)
+            sorted_names = sort_results(Embeddings(names, vectors), requests, depth)
+            results[path] = {"images_per_second": rate, "device": "cpu"}
+            results[path].update({f"recall@{k}": recall(sorted_names, reference, k) for k in ks})
+
+    print(f"{len(paths)} images, {queries} requests of {selection} items")
+    header = f"{'model':>40} {'images/s':>9}" + "".join(f" {'recall@' + str(k):>11}" for k in ks)
+    print(header)
+    for name, result in results.items():
+        recalls = "".join(f" {result[f'recall@{k}']:>11.3f}" if f"recall@{k}" in result else f" {'-':>11}"
+                          for k in ks)
+        print(f"{name[-40:]:>40} {result['images_per_second']:>9.1f}{recalls}")
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump({"images": len(paths), "queries": queries, "selection": selection, "results": results},
+                      f, indent=2)
+        print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    fire.Fire(evaluate)
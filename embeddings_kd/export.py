@@ -0,0 +1,57 @@
+import fire
+import torch
+import torch.nn as nn
+
+from module import MobileEmbeddingNet
+
+
+def load_student(checkpoint: str) -> MobileEmbeddingNet:
+    """
+        Student weights from a lightning checkpoint of EmbeddingModule, the teacher is not needed
+    """
+    state_dict = torch.load(checkpoint, map_location='cpu')['state_dict']
+    prefix = 'student_model.'
+    state_dict = {k[len(prefix):]: v for k, v in state_dict.items() if k.startswith(prefix)}
+    embedding_size = state_dict['backbone.classifier.weight'].shape[0]
+    model = MobileEmbeddingNet(pretrained=False, embedding_size=embedding_size)
+    model.load_state_dict(state_dict)
+    return model.eval()
+
+
+def export(
+    checkpoint: str,
+    output: str,
+    quantize: bool = False,
+) -> None:
+    """
+        Export the student for CPU inference in server/embedder_backends.py
+        output: *.pt for TorchScript or *.onnx for ONNX Runtime
+        quantize: dynamic int8 quantization of the weights
+    """
+    model = load_student(checkpoint)
+    example = torch.randn(1, 3, 224, 224)
+    if output.endswith('.pt'):
+        if quantize:
+            model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example)
+        traced = torch.jit.freeze(traced)
+        traced.save(output)
+    elif output.endswith('.onnx'):
+        fp32_output = output[:-len('.onnx')] + '.fp32.onnx' if quantize else output
+        torch.onnx.export(
+            model, example, fp32_output,
+            input_names=['image'], output_names=['embedding'],
+            dynamic_axes={'image': {0: 'batch'}, 'embedding': {0: 'batch'}},
+            dynamo=False,
+        )
+        if quantize:
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            quantize_dynamic(fp32_output, output, weight_type=QuantType.QUInt8)
+    else:
+        raise ValueError(f"Unknown export format of {output}, expected .pt or .onnx")
+    print(f"Exported {checkpoint} to {output}")
+
+
+if __name__ == "__main__":
+    fire.Fire(export)
@@ -43,7 +43,12 @@ class EmbeddingModule(L.LightningModule):
         weight_decay: float,
         lr_scheduler: str | None,
         pretrained: bool,
+        cached_teacher: bool = False,
     ) -> None:
+        """
+            cached_teacher: batches carry teacher embeddings computed by teacher_cache.py,
+                            the teacher is not loaded at all
+        """
         super().__init__()
         self.save_hyperparameters()
         assert loss in losses, f'Unknown loss {loss}'
@@ -53,15 +58,19 @@ class EmbeddingModule(L.LightningModule):
         self.weight_decay = weight_decay
         self.lr_scheduler = lr_scheduler
         self.student_model = MobileEmbeddingNet(pretrained=pretrained)
+        self.cached_teacher = cached_teacher
 
-        teacher_model, _ = unicom.load("ViT-B/16")
-        teacher_model.eval()
-        teacher_model.requires_grad_(False) 
         # hack to prevent lightning from calling .train() and saving in checkpoints
-        self.teacher_model = [teacher_model]
+        self.teacher_model = []
+        if not cached_teacher:
+            teacher_model, _ = unicom.load("ViT-B/16")
+            teacher_model.eval()
+            teacher_model.requires_grad_(False) 
+            self.teacher_model = [teacher_model]
 
     def on_fit_start(self) -> None:
-        self.teacher_model[0].to(self.device)
+        if self.teacher_model:
+            self.teacher_model[0].to(self.device)
 
     def forward(self, x):
         return self.student_model(x)
@@ -86,10 +95,16 @@ class EmbeddingModule(L.LightningModule):
             assert self.lr_scheduler is None, f'Unknown lr_scheduler {self.lr_scheduler}'
         return config
 
-    def training_step(self, x, batch_idx):
-        student_embeddings = self(x)
+    def teacher_targets(self, batch):
+        """ Images of the batch and their teacher embeddings, from the cache or from the teacher """
+        if self.cached_teacher:
+            return batch
         with torch.no_grad():
-            teacher_embeddings = self.teacher_model[0](x)
+            return batch, self.teacher_model[0](batch)
+
+    def training_step(self, batch, batch_idx):
+        x, teacher_embeddings = self.teacher_targets(batch)
+        student_embeddings = self(x)
 
         if self.normalize:
             student_embeddings = F.normalize(student_embeddings, p=2, dim=1)
@@ -99,10 +114,9 @@ class EmbeddingModule(L.LightningModule):
         self.log('train_loss', loss, prog_bar=True)
         return loss
     
-    def validation_step(self, x, batch_idx):
+    def validation_step(self, batch, batch_idx):
+        x, teacher_embeddings = self.teacher_targets(batch)
         student_embeddings = self(x)
-        with torch.no_grad():
-            teacher_embeddings = self.teacher_model[0](x)
         loss_full = self.loss_function(student_embeddings, teacher_embeddings)
 
         student_embeddings = F.normalize(student_embeddings, p=2, dim=1)
@@ -0,0 +1,78 @@
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import fire
+import numpy as np
+from tqdm import tqdm
+
+from datasource import IMAGE_SIZE, SHARDS_INDEX, SHARDS_VERSION, SHARDS_WIDTHS, CsvImagesDataset, \
+    letterbox_transforms, shards_path
+
+
+def letterbox(path: str) -> tuple[np.ndarray, int]:
+    """ RGB letterboxed image and the width of the image part """
+    img = cv2.imread(path)
+    assert img is not None, f"Can't read {path}"
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    resize, pad = letterbox_transforms()
+    img = resize(image=img)['image']
+    width = img.shape[1]
+    return pad(image=img)['image'], width
+
+
+def pack(csv_file: str, output: str, shard_size: int, workers: int) -> None:
+    paths = CsvImagesDataset(csv_file).paths
+    tmp_output = output + ".tmp"
+    shutil.rmtree(tmp_output, ignore_errors=True)
+    os.makedirs(tmp_output)
+    widths = np.empty(len(paths), dtype=np.int16)
+    shards = []
+    start = time.time()
+    with ProcessPoolExecutor(workers) as pool:
+        images = pool.map(letterbox, paths, chunksize=64)
+        for shard_start in tqdm(range(0, len(paths), shard_size), desc=os.path.basename(csv_file)):
+            count = min(shard_size, len(paths) - shard_start)
+            file = f"{len(shards):05d}.npy"
+            shard = np.lib.format.open_memmap(
+                os.path.join(tmp_output, file), mode='w+', dtype=np.uint8, shape=(count, IMAGE_SIZE, IMAGE_SIZE, 3))
+            for i in range(count):
+                shard[i], widths[shard_start + i] = next(images)
+            shard.flush()
+            del shard
+            shards.append({"file": file, "count": count})
+    np.save(os.path.join(tmp_output, SHARDS_WIDTHS), widths)
+    index = {"version": SHARDS_VERSION, "size": IMAGE_SIZE, "csv": os.path.abspath(csv_file), "shards": shards}
+    with open(os.path.join(tmp_output, SHARDS_INDEX), 'w') as f:
+        json.dump(index, f)
+    shutil.rmtree(output, ignore_errors=True)
+    os.replace(tmp_output, output)
+    print(f"Packed {len(paths)} images into {len(shards)} shards in {output}, "
+          f"{len(paths) / (time.time() - start):.1f} images/s")
+
+
+def pack_shards(
+    dataset_root: str = 'data/',
+    shard_size: int = 4096,
+    workers: int | None = None,
+    overwrite: bool = False,
+) -> None:
+    """
+        Decodes and letterboxes every image of train.csv and test.csv once into shards of `shard_size`
+        uint8 (N, 224, 224, 3) .npy files, next to the csv files as train.shards/ and test.shards/,
+        for `train.py --shards`. 150 KB per image. Run it again whenever the csv files change
+    """
+    workers = workers or os.cpu_count()
+    for split in ("train", "test"):
+        csv_file = os.path.join(dataset_root, f"{split}.csv")
+        output = shards_path(csv_file)
+        if os.path.exists(output) and not overwrite:
+            print(f"{output} exists, pass --overwrite to pack it again")
+            continue
+        pack(csv_file, output, shard_size, workers)
+
+
+if __name__ == "__main__":
+    fire.Fire(pack_shards)
@@ -0,0 +1,74 @@
+import os
+import time
+import cv2
+import fire
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+import unicom
+
+from datasource import CsvImagesDataset, TEACHER_VIEWS, common_transform, teacher_cache_path
+
+
+class BothViewsDataset(CsvImagesDataset):
+    """ Original and horizontally flipped view of every image, in the order of TEACHER_VIEWS """
+    def __getitem__(self, idx):
+        img = self.read_rgb(idx)
+        views = [img, cv2.flip(img, 1)]
+        return torch.stack([self.transform(image=view)['image'] for view in views])
+
+
+def cache_split(teacher, csv_file: str, output: str, batch_size: int, num_workers: int, device: str) -> None:
+    dataset = BothViewsDataset(csv_file, common_transform())
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True)
+    tmp_output = output + ".tmp.npy"
+    cache = None
+    start = time.time()
+    row = 0
+    with torch.no_grad():
+        for views in tqdm(loader, desc=os.path.basename(csv_file)):
+            count = len(views)
+            embeddings = teacher(views.flatten(0, 1).to(device, non_blocking=True)).float().cpu().numpy()
+            if cache is None:
+                cache = np.lib.format.open_memmap(
+                    tmp_output, mode='w+', dtype=np.float32, shape=(len(dataset), TEACHER_VIEWS, embeddings.shape[1]))
+            cache[row:row + count] = embeddings.reshape(count, TEACHER_VIEWS, -1)
+            row += count
+    if cache is None:
+        print(f"{csv_file} is empty")
+        return
+    cache.flush()
+    del cache
+    os.replace(tmp_output, output)
+    print(f"Cached {len(dataset)} x {TEACHER_VIEWS} teacher embeddings to {output}, "
+          f"{len(dataset) / (time.time() - start):.1f} images/s")
+
+
+def cache_teacher(
+    dataset_root: str = 'data/',
+    batch_size: int = 128,
+    num_workers: int | None = None,
+    device: str = 'cuda:0',
+    overwrite: bool = False,
+) -> None:
+    """
+        Runs the unicom ViT-B/16 teacher once over the original and the flipped view of every image
+        in train.csv and test.csv. The embeddings are stored next to the csv files as memory mapped
+        float32 arrays (images, 2, 768), so `train.py --cached_teacher` never runs the teacher.
+        Run it again whenever the csv files change
+    """
+    teacher, _ = unicom.load("ViT-B/16")
+    teacher = teacher.to(device).eval()
+    num_workers = num_workers if num_workers is not None else max(4, os.cpu_count() // 2)
+    for split in ("train", "test"):
+        csv_file = os.path.join(dataset_root, f"{split}.csv")
+        output = teacher_cache_path(csv_file)
+        if os.path.exists(output) and not overwrite:
+            print(f"{output} exists, pass --overwrite to compute it again")
+            continue
+        cache_split(teacher, csv_file, output, batch_size, num_workers, device)
+
+
+if __name__ == "__main__":
+    fire.Fire(cache_teacher)
@@ -24,6 +24,8 @@ def train(
     weight_decay: float = 1e-5,
     lr_scheduler: str = "step",
     pretrained: bool = True,
+    cached_teacher: bool = False,
+    shards: bool = False,
 
     batch_size: int = 96,
     max_epochs: int = 64,
@@ -40,12 +42,15 @@ def train(
         weight_decay = weight_decay,
         lr_scheduler=lr_scheduler,
         pretrained=pretrained,
+        cached_teacher=cached_teacher,
     )
     datamodule = ImagesDataModule(
         train_csv=os.path.join(dataset_root, "train.csv"),
         val_csv=os.path.join(dataset_root, "test.csv"),
         batch_size=batch_size,
         num_workers=max(4, os.cpu_count() // 2),
+        cached_teacher=cached_teacher,
+        shards=shards,
     )
 
     stoping_cb = EarlyStopping(monitor="val_loss", patience=24, mode="min")
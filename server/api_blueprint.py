@@ -1,13 +1,37 @@
-from flask import Blueprint, send_from_directory, request
+import os
+import time
+from typing import Optional
+
+from flask import Blueprint, Response, g, jsonify, send_file, request
 from flask_cors import CORS
 
-from application import Application, UNSORTED_CLASS
+import metrics
+from application import Application, RESPONSE_LIMIT, UNSORTED_CLASS
+from metrics import span
+from profiler import SamplingProfiler
 
 
-def make_api(app: Application) -> Blueprint:
+def make_api(app: Application, profiler: Optional[SamplingProfiler] = None) -> Blueprint:
+    """ `profiler` enables /profiler to sample stacks of the running server on demand """
     api = Blueprint('Api', __name__, url_prefix='/api')
     CORS(api)
 
+    @api.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @api.before_request
+    def sync_membership():
+        app.sync()
+
+    @api.after_request
+    def record_request(response: Response) -> Response:
+        # the route template, not the path, keeps the number of series bounded
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, endpoint=endpoint, method=request.method)
+        metrics.REQUESTS.inc(endpoint=endpoint, method=request.method, status=str(response.status_code))
+        return response
+
     @api.route('/classes', methods = ["GET"])
     def get_classes():
         classes = [
@@ -26,35 +50,118 @@ def make_api(app: Application) -> Blueprint:
 
     @api.route('/classes/<class_id>', methods = ["GET"])
     def get_class_files(class_id: str):
-        return {"files" : app.get_cluster_items(class_id)} 
+        """ Pages through the class in random order, pass `next` back as `?cursor=` to get the following page """
+        try:
+            files, next_cursor = app.get_cluster_items(
+                class_id, request.args.get("cursor"), request.args.get("limit", RESPONSE_LIMIT, type=int))
+        except ValueError as e:
+            return {"status" : str(e)}, 400
+        return {"files" : files, "next" : next_cursor}
 
 
+    @api.route('/file/<item_id>', methods = ["GET"])
     @api.route('/file/<class_id>/<item_id>', methods = ["GET"])
-    def serve_file(class_id: str, item_id: str):
-        assert class_id in app.clusters
-        assert item_id in app.clusters[class_id].items
-        return send_from_directory(app.data_root, f'{class_id}/{item_id}', max_age=60*60*24)
+    def serve_file(item_id: str, class_id: Optional[str] = None):
+        """
+            Serves a thumbnail when they are enabled, `?original=1` always gets the full size image.
+            Items are found by name whatever class they are in, the class of the old route is ignored
+        """
+        source = app.item_path(item_id)
+        if source is None:
+            return {"status" : "unknown"}, 404
+        try:
+            if app.thumbnails is None or request.args.get("original"):
+                return send_file(source, max_age=60*60*24)
+            stat = os.stat(source)
+            etag = app.thumbnails.etag(stat)
+            if request.if_none_match.contains(etag):
+                return "", 304, {"ETag": f'"{etag}"'}
+            thumbnail = app.thumbnails.get(source, item_id, stat)
+        except FileNotFoundError:
+            # the file moved between resolving and opening it, the next try finds it
+            return {"status" : "moving"}, 503, {"Retry-After": "1"}
+        return send_file(thumbnail, mimetype="image/webp", etag=etag, conditional=True, max_age=60*60*24)
 
 
     @api.route('/sort', methods=["POST"])
     def sort_files():
+        """
+            `{"files": [...], "session": optional}`, requests of one annotator passing the same session id,
+            e.g. a random string picked by the client, are scored incrementally from the previous selection
+        """
         data = request.get_json()
-        result = app.sort(set(data["files"]))
-        return {"files" : result}
+        session = data.get("session")
+        if session is not None and not (isinstance(session, str) and 0 < len(session) <= 64):
+            return {"status" : "session must be a string of up to 64 characters"}, 400
+        result = app.sort(set(data["files"]), session)
+        with span("sort.encode"):
+            return jsonify({"files" : result})
     
     @api.route('/sort_by_class', methods=["POST"])
     def sort_files_by_class():
         data = request.get_json()
         result = app.sort_by_class(data["class"])
-        return {"files" : result}
+        with span("sort.encode"):
+            return jsonify({"files" : result})
+
+    @api.route('/classify', methods=["POST"])
+    def classify_files():
+        """ `{"limit": 768, "class": optional, "min_margin": 0.0}`, files carry a suggested class `c` and margin `m` """
+        data = request.get_json(silent=True) or {}
+        result = app.classify(int(data.get("limit", RESPONSE_LIMIT)), data.get("class"),
+                              float(data.get("min_margin", 0.0)))
+        with span("sort.encode"):
+            return jsonify({"files" : result})
 
     @api.route('/move', methods= ["POST"])
     def move_files():
+        """
+            With `"async": true` responds right away with a job id to poll at /jobs/<job_id>,
+            `"duplicates": true` also moves the unsorted near-duplicates of the files when dedup is enabled
+        """
         data = request.get_json()
         dest_class = data["class"]
         if dest_class not in app.clusters:
             app.create_cluster(dest_class)
-        app.unsorted2cluster(data["files"], dest_class)
+        job_id = app.unsorted2cluster(data["files"], dest_class, wait=not data.get("async", False),
+                                      duplicates=data.get("duplicates", False))
+        if job_id is not None:
+            return {"status" : "accepted", "job" : job_id}, 202
         return {"status" : "ok"}
-    
+
+    @api.route('/jobs/<job_id>', methods=["GET"])
+    def get_job(job_id: str):
+        status = app.jobs.status(job_id)
+        if status is None:
+            return {"status" : "unknown"}, 404
+        return status
+
+    @api.route('/cache', methods=["GET"])
+    def cache_stats():
+        return app.cache.stats()
+
+    @api.route('/metrics', methods=["GET"])
+    def get_metrics():
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    @api.route('/profiler', methods=["GET"])
+    def get_profile():
+        """ Collapsed stacks sampled so far, feed them to flamegraph.pl or speedscope """
+        if profiler is None:
+            return {"status" : "disabled"}, 404
+        return Response(profiler.collapsed(), mimetype="text/plain")
+
+    @api.route('/profiler', methods=["POST"])
+    def toggle_profiler():
+        """ `{"enabled": true, "interval": 0.01}` starts sampling from scratch, `{"enabled": false}` stops it """
+        if profiler is None:
+            return {"status" : "disabled"}, 404
+        data = request.get_json()
+        if data.get("enabled"):
+            profiler.reset()
+            profiler.start(float(data.get("interval", profiler.interval)))
+        else:
+            profiler.stop()
+        return {"status" : "ok", "running" : profiler.running}
+
     return api
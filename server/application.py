@@ -1,16 +1,43 @@
-from cluster import Cluster
+from cluster import Cluster, IndexedSet
+import numpy as np
 import os
-import random
-import shutil
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional, Union
 
-from numpy_sorter import find_close_to_many
-from embedder import Embedder, Embeddings
+from numpy_sorter import classify_rows, find_close_to_many, find_close_to_scores, find_close_to_vectors
+from embedder import Embedder
+from embeddings import Embeddings, append_embeddings, embeddings_uid, extend_mapped_vectors, extend_rows, \
+    read_embeddings, save_embeddings, upgrade_embeddings
+from ivf_index import IvfIndex
+from duplicates import Duplicates
+from sort_cache import BackgroundRefresher, SortCache
+from sort_session import SortSessions
+from thumbnails import ThumbnailCache
+from membership_log import MembershipLog
+from mover import Jobs
+from pagination import Cursor, random_positions
+from prototypes import ClassPrototypes
+from ingest import Ingestor
+from storage import Storage, make_storage
+import quantization
+import metrics
+from metrics import span
 
 
 UNSORTED_CLASS = "unsorted"
 FILE_FORMAT = ".jpg"
 EMBEDDINGS_FILENAME = "embeddings.h5"
+# features of an embedding run in progress, an interrupted run resumes from it
+EMBEDDINGS_SPOOL_FILENAME = ".embeddings.spool.h5"
+INGEST_SPOOL_FILENAME = ".ingest.spool.h5"
+THUMBNAILS_DIRNAME = ".thumbnails"
+MEMBERSHIP_LOG_FILENAME = ".membership.log"
+JOBS_DIRNAME = ".jobs"
 RESPONSE_LIMIT = 768
+# classes whose sort_by_class results are refreshed in the background after a move
+PRECOMPUTE_CLASSES = 4
 
 
 class Application():
@@ -21,99 +48,632 @@ class Application():
         ln -s /path/to/data unsorted
     """
 
-    def __init__(self, data_root: str) -> None:
+    def __init__(
+        self,
+        data_root: str,
+        mmap_embeddings: bool = False,
+        ann_index: bool = False,
+        precompute: bool = False,
+        thumbnails: bool = False,
+        shared_state: bool = False,
+        prototype_queries: bool = False,
+        compression: Optional[str] = None,
+        ingest: bool = False,
+        storage: str = "move",
+        dedup: bool = False,
+    ) -> None:
+        """
+            shared_state: several worker processes forked after init serve the same data root,
+                          they exchange membership changes through a log file
+            prototype_queries: sort_by_class scores the unsorted items against a few centroids of the class
+                               instead of all of its members
+            compression: keep vectors in memory as "float16", "int8" or "pq" codes, the full precision ones
+                         stay memory mapped on disk to re-rank the best candidates
+            ingest: embed files landing in cluster folders in the background and make them sortable right away,
+                    for a single process only
+            storage: "move" keeps every class in a folder of the data root and moves files between them,
+                     "virtual" leaves files where they are and records classes in a log, see storage.py
+            dedup: group near-duplicate items, sorting and classification score only one item of a group
+                   while the others are unsorted too, moves may carry the group along
+        """
         assert os.path.isdir(data_root)
+        assert not (ingest and shared_state), "Live ingestion needs a single process"
         self.data_root = data_root
+        self.mmap_embeddings = mmap_embeddings or compression is not None
+        # guards cluster membership, requests are served from several threads
+        self._lock = threading.RLock()
+        self.cache = SortCache()
+        self.sessions = SortSessions()
+        self._recent_classes: OrderedDict[str, None] = OrderedDict()
         # make sure unsorted class exists
         assert os.path.exists(os.path.join(data_root, UNSORTED_CLASS))
+        self.storage: Storage = make_storage(storage, data_root, FILE_FORMAT)
+        self.jobs = Jobs(os.path.join(data_root, JOBS_DIRNAME))
+        # items of moves in progress and the cluster they go to, they can't be moved again until the move is committed
+        self._moving: dict[str, str] = {}
         self.clusters: dict[str, Cluster] = {}
+        # every cluster gets a small integer id, `row_cluster[row]` is the id of the cluster an embeddings row is in
+        self.cluster_ids: dict[str, int] = {}
+        self.cluster_names: list[str] = []
+        self.ingestor: Optional[Ingestor] = None
         self._read_clusters()
         self.unsorted = self.clusters[UNSORTED_CLASS]
         self.embeddings: Embeddings = self._init_embeddings()
+        self.row_cluster = self._init_row_cluster()
+        self.ann_index: Optional[IvfIndex] = self._init_ann_index() if ann_index else None
+        if compression is not None:
+            self.embeddings = self._init_compression(compression)
+        self.duplicates: Optional[Duplicates] = self._init_duplicates() if dedup else None
+        self.prototype_queries = prototype_queries
+        # built on first use unless prototype queries need them right away, then kept up to date by every move
+        self.prototypes: Optional[ClassPrototypes] = None
+        if prototype_queries:
+            self._get_prototypes()
+        self.refresher = BackgroundRefresher(self._refresh_class) if precompute else None
+        self._init_metrics()
+        self.membership_log = MembershipLog(os.path.join(data_root, MEMBERSHIP_LOG_FILENAME)) if shared_state else None
+        self.thumbnails: Optional[ThumbnailCache] = None
+        if thumbnails:
+            self.thumbnails = ThumbnailCache(os.path.join(data_root, THUMBNAILS_DIRNAME))
+            self.thumbnails.schedule(
+                (os.path.join(data_root, self.storage.file(cluster.name, item)), item)
+                for cluster in self.clusters.values()
+                for item in cluster.items
+            )
+        if ingest:
+            self.ingestor = Ingestor(
+                data_root, [name for name in self.clusters if self._has_folder(name)], FILE_FORMAT,
+                lambda name: name not in self.embeddings.index, self.ingest)
 
     def _init_embeddings(self) -> Embeddings:
+        """
+            Brings embeddings.h5 in sync with the data root: only items missing from the store are embedded
+            and appended, vectors of deleted files are dropped. The whole library is embedded on the first run
+        """
         embeddings_path = os.path.join(self.data_root, EMBEDDINGS_FILENAME)
         if os.path.exists(embeddings_path):
-            embeddings = Embedder.read_embeddings(embeddings_path)
-            self._assert_embeddings(embeddings)
-            return embeddings
+            if upgrade_embeddings(embeddings_path):
+                print(f"Upgraded {embeddings_path} to the current format")
+            embeddings = read_embeddings(embeddings_path, mmap=self.mmap_embeddings)
         else:
-            all_items = []
-            for cluster in self.clusters.values():
-                all_items.extend([os.path.join(cluster.name, item) for item in cluster.items])
-            all_items = sorted(all_items)
-            embeddings = Embedder.generate_embeddings(self.data_root, all_items)
-            # remove cluster names from items
-            names = [os.path.basename(item) for item in embeddings.names]
+            # the store exists from the first run on, the ANN index, codes and groups saved next to it key on it
+            save_embeddings(embeddings_path, Embeddings([], np.empty((0, Embedder.embedding_dim), dtype=np.float32)))
+            embeddings = read_embeddings(embeddings_path, mmap=self.mmap_embeddings)
+
+        present: set[str] = set()
+        missing = []
+        for cluster in self.clusters.values():
+            present.update(cluster.items)
+            missing.extend([self.storage.file(cluster.name, item) for item in cluster.items
+                            if item not in embeddings.index])
+        deleted = set(embeddings.names) - present
+
+        if deleted:
+            print(f"Removing {len(deleted)} deleted items from {embeddings_path}")
+            embeddings = embeddings.without(deleted)
+            save_embeddings(embeddings_path, embeddings)
+        if missing:
+            print(f"Embedding {len(missing)} new items")
+            assert len(embeddings) == 0 or embeddings.model in (None, Embedder.backend.name), \
+                f"{embeddings_path} was produced by {embeddings.model}, not by {Embedder.backend.name}"
+            # stores upgraded from the legacy format lost the PCA they were made with, new items can't join them.
+            # Checked before embedding anything, a store made since records its model even without a projection
+            assert len(embeddings) == 0 or embeddings.projection is not None or embeddings.model is not None, \
+                f"{embeddings_path} has no stored projection, remove it to re-embed the whole library"
+            spool_path = os.path.join(self.data_root, EMBEDDINGS_SPOOL_FILENAME)
+            delta = Embedder.generate_embeddings(self.data_root, sorted(missing), spool_path, embeddings.projection)
+            # remove folders from items
+            names = [os.path.basename(item) for item in delta.names]
             assert len(names) == len(set(names)), "Items names are not unique"
-            embeddings = Embeddings(names, embeddings.vectors)
-            Embedder.save_embeddings(embeddings_path, embeddings)
-            return embeddings
+            delta = Embeddings(names, delta.vectors, delta.projection, delta.model)
+            embeddings = embeddings.extend(delta)
+            if len(embeddings) > len(delta):
+                append_embeddings(embeddings_path, delta)
+            else:
+                # the first rows bring the projection and the model
+                save_embeddings(embeddings_path, embeddings)
+            os.remove(spool_path)
+        if (deleted or missing) and self.mmap_embeddings:
+            embeddings = read_embeddings(embeddings_path, mmap=True)
+        return embeddings
+
+    def _init_ann_index(self) -> Optional[IvfIndex]:
+        """
+            Loads the index saved next to embeddings.h5 and brings it up to date with appended rows,
+            trains a new one if there is none. Small libraries don't need one
+        """
+        if len(self.embeddings) < IvfIndex.exact_threshold:
+            return None
+        embeddings_path = os.path.join(self.data_root, EMBEDDINGS_FILENAME)
+        index_path = IvfIndex.path_for(embeddings_path)
+        uid = embeddings_uid(embeddings_path)
+        if os.path.exists(index_path):
+            index = IvfIndex.load(index_path)
+            if index.uid != uid or len(index) > len(self.embeddings):
+                index.reassign(self._exact_vectors(), uid)
+            elif len(index) < len(self.embeddings):
+                index.add(self._exact_vectors()[len(index):])
+            else:
+                return index
+        else:
+            print(f"Building ANN index for {len(self.embeddings)} items")
+            index = IvfIndex.build(self._exact_vectors(), uid)
+        index.save(index_path)
+        return index
+
+    def _init_compression(self, mode: str) -> Embeddings:
+        """
+            Loads the codes saved next to embeddings.h5 and brings them up to date like the ANN index,
+            the parameters are only trained when there are no codes yet
+        """
+        embeddings_path = os.path.join(self.data_root, EMBEDDINGS_FILENAME)
+        codes_path = quantization.path_for(embeddings_path, mode)
+        uid = embeddings_uid(embeddings_path)
+        exact = self._exact_vectors()
+        if len(exact) == 0:
+            # codes are trained on the vectors, the next start compresses items added meanwhile
+            print(f"No vectors to compress to {mode} yet")
+            return self.embeddings
+        if os.path.exists(codes_path):
+            quantized, codes_uid = quantization.load_quantized(codes_path, exact)
+            if codes_uid != uid or len(quantized) > len(exact):
+                quantized.reencode(exact)
+                quantized.save(codes_path, uid)
+            elif len(quantized) < len(exact):
+                quantized.encode_more(exact[len(quantized):])
+                quantized.save(codes_path, uid)
+        else:
+            print(f"Compressing {len(exact)} vectors to {mode}")
+            quantized = quantization.quantize(exact, mode, exact)
+            quantized.save(codes_path, uid)
+        print(f"Vectors take {quantized.nbytes / 2**20:.1f} MB in memory instead of {exact.nbytes / 2**20:.1f} MB")
+        return Embeddings(self.embeddings.names, quantized, self.embeddings.projection, self.embeddings.model)
 
-    def _assert_embeddings(self, embeddings) -> None:
-        assert os.path.exists(os.path.join(self.data_root, EMBEDDINGS_FILENAME))
-        known = set(embeddings.names)
+    def _init_duplicates(self) -> Duplicates:
+        """ Loads the groups saved next to embeddings.h5 and groups appended rows, regroups all rows when needed """
+        embeddings_path = os.path.join(self.data_root, EMBEDDINGS_FILENAME)
+        duplicates_path = Duplicates.path_for(embeddings_path)
+        uid = embeddings_uid(embeddings_path)
+        vectors = self._exact_vectors()
+        if os.path.exists(duplicates_path):
+            duplicates = Duplicates.load(duplicates_path)
+            if duplicates.uid == uid and duplicates.threshold == Duplicates.threshold \
+                    and len(duplicates) <= len(vectors):
+                if len(duplicates) == len(vectors):
+                    return duplicates
+                duplicates = duplicates.extended(vectors)
+                duplicates.save(duplicates_path)
+                return duplicates
+        print(f"Grouping near-duplicates of {len(vectors)} items")
+        with span("dedup.build"):
+            duplicates = Duplicates.build(vectors, uid)
+        grouped = len(duplicates) - int(duplicates.is_representative.sum())
+        print(f"{grouped} items are near-duplicates of others")
+        duplicates.save(duplicates_path)
+        return duplicates
+
+    def _init_metrics(self) -> None:
+        metrics.EMBEDDINGS_ROWS.set_function(lambda: len(self.embeddings))
+        metrics.EMBEDDINGS_BYTES.set_function(lambda: self.embeddings.vectors.nbytes)
+        metrics.CACHE_HITS.set_function(lambda: self.cache.hits)
+        metrics.CACHE_MISSES.set_function(lambda: self.cache.misses)
+        metrics.CACHE_ENTRIES.set_function(lambda: self.cache.stats()["entries"])
+        metrics.SORT_SESSIONS.set_function(lambda: len(self.sessions))
+
+    def after_fork(self) -> None:
+        """
+            Called in every worker process, threads of the parent don't survive a fork.
+            Thumbnails of the startup pass keep being made by the parent, workers make missing ones on request
+        """
+        self._lock = threading.RLock()
+        self.cache = SortCache()
+        self.sessions = SortSessions()
+        self.jobs.after_fork()
+        if self.refresher is not None:
+            self.refresher = BackgroundRefresher(self._refresh_class)
+
+    def sync(self) -> None:
+        """ Applies membership changes made by other worker processes """
+        if self.membership_log is None or not self.membership_log.has_new():
+            return
+        with self._lock:
+            self._apply_records(self.membership_log.read_new())
+
+    @contextmanager
+    def _membership_change(self) -> Iterator[Callable[[dict[str, Any]], None]]:
+        """
+            Serializes membership changes of all threads and workers,
+            yields a callable recording the change for the other workers
+        """
+        with self._lock:
+            if self.membership_log is None:
+                yield lambda record: None
+                return
+            with self.membership_log.writer() as (records, append):
+                self._apply_records(records)
+                yield append
+
+    def _apply_records(self, records: list[dict[str, Any]]) -> None:
+        for record in records:
+            if record["op"] == "create":
+                self._add_cluster(Cluster(record["cluster"], os.path.join(self.data_root, record["cluster"])))
+            elif record["op"] == "move":
+                self._move_members(self.clusters[record["from"]], self.clusters[record["to"]], record["items"])
+        if records:
+            self.cache.invalidate()
+
+    def _init_row_cluster(self) -> np.ndarray:
+        row_cluster = np.empty(len(self.embeddings), dtype=np.int32)
         for cluster in self.clusters.values():
-            for item in cluster.items:
-                assert item in known, f"Item {item} from {cluster.name} is not in embeddings"
+            row_cluster[self.embeddings.rows(cluster.items)] = self.cluster_ids[cluster.name]
+        return row_cluster
+
+    def _add_cluster(self, cluster: Cluster) -> None:
+        self.cluster_ids[cluster.name] = len(self.cluster_ids)
+        self.cluster_names.append(cluster.name)
+        self.clusters[cluster.name] = cluster
+        if self.ingestor is not None and self._has_folder(cluster.name):
+            self.ingestor.watch(cluster.name)
+
+    def _has_folder(self, cluster_name: str) -> bool:
+        """ Classes of virtual storage created while sorting have no folder to watch """
+        return os.path.isdir(os.path.join(self.data_root, cluster_name))
 
     def _read_clusters(self) -> None:
-        for cluster_name in os.listdir(self.data_root):
-            cluster_path = os.path.join(self.data_root, cluster_name)
-            if os.path.isdir(cluster_path):
-                cluster = Cluster(cluster_name, cluster_path)
-                self._load_cluster_items(cluster)
-                self.clusters[cluster_name] = cluster
-
-    def _load_cluster_items(self, cluster: Cluster) -> None:
-        for item in os.listdir(cluster.path):
-            item_path = os.path.join(cluster.path, item)
-            if os.path.isfile(item_path) and item.endswith(FILE_FORMAT):
-                cluster.items.add(item)
-        if len(cluster.items) > 0:
-            cluster.preview = cluster.items.pop()
-            cluster.items.add(cluster.preview)
-
-    def get_cluster_items(self, cluster_name: str) -> list[str]:
+        for cluster_name, items in self.storage.scan().items():
+            cluster = Cluster(cluster_name, os.path.join(self.data_root, cluster_name), items=IndexedSet(items))
+            if len(cluster.items) > 0:
+                cluster.preview = cluster.items.pop()
+                cluster.items.add(cluster.preview)
+            self._add_cluster(cluster)
+
+    def get_cluster_items(
+        self, cluster_name: str, cursor: Optional[str] = None, limit: int = RESPONSE_LIMIT
+    ) -> tuple[list[dict[str, Any]], Optional[str]]:
+        """
+            A page of the class in random order and the cursor of the next page, None after the last one.
+            Without a cursor a new order is picked. The order is stable while the class doesn't change,
+            a move out of the class puts its last item into the freed position
+        """
         assert cluster_name in self.clusters
-        l = list(self.clusters[cluster_name].items)
-        random.shuffle(l)
-        l = [{'n': name, 's': 0.0} for name in l]
-        return l[:RESPONSE_LIMIT]
+        assert limit > 0
+        limit = min(limit, RESPONSE_LIMIT)
+        page = Cursor.decode(cursor) if cursor is not None else Cursor.first()
+        items = self.clusters[cluster_name].items
+        with self._lock:
+            size = len(items)
+            positions = random_positions(page.seed, size, page.offset, limit)
+            names = [items[position] for position in positions]
+        end = page.offset + len(names)
+        next_cursor = Cursor(page.seed, end).encode() if end < size else None
+        return [{'n': name, 's': 0.0} for name in names], next_cursor
 
-    def unsorted2cluster(self, items: list[str], cluster_name: str) -> None:
+    def unsorted2cluster(
+        self, items: list[str], cluster_name: str, wait: bool = True, duplicates: bool = False
+    ) -> Optional[str]:
+        """
+            With wait=False the move runs in the background, returns the id of the job reporting its status.
+            duplicates=True moves the unsorted near-duplicates of the items along with them
+        """
         assert cluster_name in self.clusters
-        self._move2cluster(self.unsorted, self.clusters[cluster_name], items)
+        to_cluster = self.clusters[cluster_name]
+        if duplicates and self.duplicates is not None:
+            items = self._with_duplicates(items)
+        self._reserve_items(self.unsorted, to_cluster, items)
+        if wait:
+            self._move2cluster(self.unsorted, to_cluster, items)
+            return None
+        description = {"class": cluster_name, "count": len(items)}
+        return self.jobs.submit(lambda: self._move2cluster(self.unsorted, to_cluster, items), description)
 
     def create_cluster(self, cluster_name: str) -> None:
-        assert cluster_name not in self.clusters
-        cluster_path = os.path.join(self.data_root, cluster_name)
-        os.mkdir(cluster_path)
-        self.clusters[cluster_name] = Cluster(cluster_name, cluster_path)
-
-    def sort(self, items: set[str]) -> list[(str, float)]:
-        result: list[(str, float)] = find_close_to_many(items, self.embeddings, RESPONSE_LIMIT)
-        filtered = []
-        for item in result:
-            if item[0] in self.unsorted.items:
-                filtered.append(item)
-        return [{'n': name, 's': float(score)} for (name, score) in filtered]
-    
-    def sort_by_class(self, cluster_name: str) -> list[str]:
+        # nothing cached can refer to a new empty cluster, so the sort cache stays valid
+        with self._membership_change() as record:
+            assert cluster_name not in self.clusters
+            self.storage.create(cluster_name)
+            self._add_cluster(Cluster(cluster_name, os.path.join(self.data_root, cluster_name)))
+            record({"op": "create", "cluster": cluster_name})
+
+    def ingest(self, paths: list[str]) -> list[str]:
+        """
+            Embeds new files given by paths relative to the data root and adds them to their clusters,
+            returns the paths added. Files are embedded and appended to embeddings.h5 outside of the lock,
+            then all in-memory state is swapped under it, so requests see either none or all of the new rows
+        """
+        with self._lock:
+            names: set[str] = set()
+            new = []
+            for path in paths:
+                cluster_name, name = os.path.split(path)
+                if cluster_name in self.clusters and name not in self.embeddings.index and name not in names \
+                        and os.path.exists(os.path.join(self.data_root, path)):
+                    names.add(name)
+                    new.append(path)
+            embeddings = self.embeddings
+        if not new:
+            return []
+        embeddings_path = os.path.join(self.data_root, EMBEDDINGS_FILENAME)
+        assert len(embeddings) == 0 or embeddings.projection is not None or embeddings.model is not None, \
+            f"{embeddings_path} has no stored projection, remove it to re-embed the whole library"
+        spool_path = os.path.join(self.data_root, INGEST_SPOOL_FILENAME)
+        delta = Embedder.generate_embeddings(self.data_root, new, spool_path, embeddings.projection)
+        new = delta.names
+        delta = Embeddings([os.path.basename(path) for path in new], delta.vectors, delta.projection, delta.model)
+        # freshly embedded rows are never compressed
+        assert isinstance(delta.vectors, np.ndarray)
+        if len(embeddings) > 0:
+            projection, model = embeddings.projection, embeddings.model
+            append_embeddings(embeddings_path, delta)
+        else:
+            # the first rows of a library started empty bring the projection and the model
+            projection, model = delta.projection, delta.model
+            save_embeddings(embeddings_path, delta)
+        os.remove(spool_path)
+
+        with span("ingest.swap"):
+            # only this thread adds rows, spare capacity after the current rows is not read by anyone
+            if self.mmap_embeddings:
+                exact = extend_mapped_vectors(embeddings_path, self._exact_vectors(), delta.vectors)
+            else:
+                exact = extend_rows(self._exact_vectors(), delta.vectors)
+            vectors: Union[np.ndarray, quantization.QuantizedVectors] = exact
+            if isinstance(embeddings.vectors, quantization.QuantizedVectors):
+                vectors = embeddings.vectors.extended(delta.vectors, exact)
+            ann_index = self.ann_index.extended(delta.vectors) if self.ann_index is not None else None
+            duplicates = self.duplicates.extended(exact) if self.duplicates is not None else None
+            extended = Embeddings(embeddings.names + delta.names, vectors, projection, model)
+            clusters = [self.clusters[os.path.dirname(path)] for path in new]
+            cluster_ids = np.array([self.cluster_ids[cluster.name] for cluster in clusters], dtype=np.int32)
+            rows = np.arange(len(embeddings), len(extended))
+            with self._lock:
+                self.embeddings = extended
+                self.ann_index = ann_index
+                self.duplicates = duplicates
+                self.row_cluster = extend_rows(self.row_cluster, cluster_ids)
+                self.storage.add(new)
+                if self.prototypes is not None:
+                    self.prototypes.extend(vectors, self.row_cluster, rows)
+                for cluster, name in zip(clusters, delta.names):
+                    cluster.items.add(name)
+                    if cluster.preview is None:
+                        cluster.preview = name
+                self.cache.invalidate()
+                recent = list(reversed(self._recent_classes))
+        if self.refresher is not None:
+            self.refresher.schedule(recent)
+        if self.thumbnails is not None:
+            self.thumbnails.schedule((os.path.join(self.data_root, path), os.path.basename(path)) for path in new)
+        return new
+
+    def item_path(self, item: str) -> Optional[str]:
+        """ File of a library item whatever class it is in, None for unknown items """
+        with self._lock:
+            row = self.embeddings.index.get(item)
+            if row is None:
+                return None
+            cluster_name = self.cluster_names[self.row_cluster[row]]
+            path = os.path.join(self.data_root, self.storage.file(cluster_name, item))
+            destination = self._moving.get(item)
+        if destination is not None and not os.path.exists(path):
+            # files of a move are moved before the move is committed in memory
+            path = os.path.join(self.data_root, self.storage.file(destination, item))
+        return path
+
+    def _exact_vectors(self) -> np.ndarray:
+        vectors = self.embeddings.vectors
+        if isinstance(vectors, quantization.QuantizedVectors):
+            # compressed libraries always keep the full precision rows memory mapped
+            assert vectors.exact is not None
+            return vectors.exact
+        return vectors
+
+    def sort(self, items: set[str], session: Optional[str] = None) -> list[dict[str, Any]]:
+        """
+            `session` names the selection of one annotator, its scores are kept between requests so a selection
+            grown or shrunk by a few items is sorted at the cost of those items. Sessions are ignored with an ANN
+            index, which only scores rows close to the request anyway
+        """
+        version = self.cache.version
+        key = frozenset(items)
+        result = self.cache.get(key)
+        if result is None:
+            if session is not None and self.ann_index is None:
+                result = self._sort_session(items, session)
+            else:
+                result = self._sort(items)
+            self.cache.put(key, result, version)
+        return result
+
+    def sort_by_class(self, cluster_name: str) -> list[dict[str, Any]]:
         assert cluster_name in self.clusters
-        cluster = self.clusters[cluster_name]
-        return self.sort(cluster.items)
+        with self._lock:
+            self._recent_classes[cluster_name] = None
+            self._recent_classes.move_to_end(cluster_name)
+            while len(self._recent_classes) > PRECOMPUTE_CLASSES:
+                self._recent_classes.popitem(last=False)
+        version = self.cache.version
+        key = ('class', cluster_name)
+        result = self.cache.get(key)
+        if result is None:
+            result = self._sort_class(cluster_name)
+            self.cache.put(key, result, version)
+        return result
 
-    def _move2cluster(self, from_cluster: Cluster, to_cluster: Cluster, items: list[str]) -> None:
+    def _unsorted_rows(self) -> tuple[Embeddings, np.ndarray]:
+        """
+            Embeddings and the rows of unsorted items in them, ingestion swaps both at once.
+            With dedup a near-duplicate is left out while the representative of its group is unsorted
+        """
+        with span("sort.unsorted_filter"), self._lock:
+            unsorted = self.row_cluster == self.cluster_ids[UNSORTED_CLASS]
+            if self.duplicates is not None:
+                unsorted &= self.duplicates.is_representative | ~unsorted[self.duplicates.representative]
+            return self.embeddings, np.flatnonzero(unsorted)
+
+    def _format(self, result: list[tuple[str, float]]) -> list[dict[str, Any]]:
+        """ With dedup every item carries the number `d` of its unsorted near-duplicates left out """
+        with span("sort.format"):
+            if self.duplicates is None:
+                return [{'n': name, 's': float(score)} for (name, score) in result]
+            with self._lock:
+                duplicates = self.duplicates
+                rows = self.embeddings.rows(name for name, _ in result)
+                counts = np.zeros(len(rows), dtype=np.int64)
+                unsorted_id = self.cluster_ids[UNSORTED_CLASS]
+                for i in np.flatnonzero(duplicates.group_sizes(rows) > 1):
+                    counts[i] = np.count_nonzero(self.row_cluster[duplicates.members(rows[i])] == unsorted_id) - 1
+            return [{'n': name, 's': float(score), 'd': int(count)} for (name, score), count in zip(result, counts)]
+
+    def _sort(self, items: set[str]) -> list[dict[str, Any]]:
+        """ Only unsorted rows are scored, so the response is a full page while enough unsorted items are left """
+        with self._lock:
+            ann_index = self.ann_index
+            embeddings, unsorted_rows = self._unsorted_rows()
+        result: list[tuple[str, float]] = find_close_to_many(
+            items, embeddings, RESPONSE_LIMIT, ann_index, unsorted_rows)
+        return self._format(result)
+
+    def _sort_session(self, items: set[str], session_id: str) -> list[dict[str, Any]]:
+        """ Same results as `_sort` without an index """
+        session = self.sessions.get(session_id)
+        embeddings, unsorted_rows = self._unsorted_rows()
+        with session.lock:
+            scores = session.update(embeddings, items)
+            result = find_close_to_scores(scores, items, embeddings, RESPONSE_LIMIT, unsorted_rows)
+        return self._format(result)
+
+    def _sort_class(self, cluster_name: str) -> list[dict[str, Any]]:
+        if self.prototype_queries:
+            with self._lock:
+                query = self._get_prototypes().of_cluster(self.cluster_ids[cluster_name])
+                embeddings, unsorted_rows = self._unsorted_rows()
+            result = find_close_to_vectors(query, embeddings, RESPONSE_LIMIT, unsorted_rows)
+            return self._format(result)
+        with self._lock:
+            items = set(self.clusters[cluster_name].items)
+        return self._sort(items)
+
+    def _get_prototypes(self) -> ClassPrototypes:
+        with self._lock:
+            if self.prototypes is None:
+                with span("prototypes.build"):
+                    self.prototypes = ClassPrototypes(
+                        self.embeddings.vectors, self.row_cluster, self.cluster_ids[UNSORTED_CLASS])
+            return self.prototypes
+
+    def classify(
+        self, limit: int = RESPONSE_LIMIT, cluster_name: Optional[str] = None, min_margin: float = 0.0
+    ) -> list[dict[str, Any]]:
+        """
+            Suggests a class for every unsorted item in one pass over the pool: the class of its closest prototype.
+            The margin to the second best class measures confidence, the most confident suggestions come first.
+            `cluster_name` keeps suggestions of that class only
+        """
+        assert cluster_name is None or cluster_name in self.clusters
+        version = self.cache.version
+        result = self.cache.get(('classify',))
+        if result is None:
+            with self._lock:
+                prototypes, prototype_cluster = self._get_prototypes().matrix()
+                embeddings, unsorted_rows = self._unsorted_rows()
+            with span("classify.score"):
+                best_cluster, best_score, margin = classify_rows(
+                    embeddings.vectors, unsorted_rows, prototypes, prototype_cluster)
+            order = np.argsort(-margin, kind='stable')
+            result = (embeddings, unsorted_rows[order], best_cluster[order], best_score[order], margin[order])
+            self.cache.put(('classify',), result, version)
+        embeddings, rows, best_cluster, best_score, margin = result
+        keep = margin >= min_margin
+        if cluster_name is not None:
+            keep &= best_cluster == self.cluster_ids[cluster_name]
+        selected = np.flatnonzero(keep)[:min(limit, RESPONSE_LIMIT)]
+        return [
+            {'n': embeddings.names[rows[i]], 'c': self.cluster_names[best_cluster[i]],
+             's': float(best_score[i]), 'm': float(margin[i])}
+            for i in selected
+        ]
+
+    def _refresh_class(self, cluster_name: str) -> None:
+        version = self.cache.version
+        self.cache.put(('class', cluster_name), self._sort_class(cluster_name), version)
+
+    def _with_duplicates(self, items: list[str]) -> list[str]:
+        self.sync()
+        with self._lock:
+            duplicates = self.duplicates
+            assert duplicates is not None
+            rows = self.embeddings.rows(item for item in items if item in self.embeddings.index)
+            unsorted_id = self.cluster_ids[UNSORTED_CLASS]
+            extra: list[str] = []
+            for row in rows[duplicates.group_sizes(rows) > 1]:
+                members = duplicates.members(row)
+                extra.extend(self.embeddings.names[member]
+                             for member in members[self.row_cluster[members] == unsorted_id])
+            names = set(items)
+            return items + [name for name in dict.fromkeys(extra) if name not in names and name not in self._moving]
+
+    def _reserve_items(self, from_cluster: Cluster, to_cluster: Cluster, items: list[str]) -> None:
+        """ Validates a move up front, so a background move fails on submission rather than later """
         assert len(items) > 0
+        self.sync()
+        with span("move.reserve"), self._lock:
+            invalid = [item for item in items if item not in from_cluster.items or item in self._moving]
+            assert not invalid, f"Items {invalid[:10]} are not in {from_cluster.name} or are being moved"
+            self._moving.update(dict.fromkeys(items, to_cluster.name))
+
+    def _move2cluster(self, from_cluster: Cluster, to_cluster: Cluster, items: list[str]) -> None:
+        """
+            Storage moves the items outside of the lock, so requests are served meanwhile. The in-memory move is
+            committed once storage recorded it durably, e.g. while the batch journal of moved files still exists,
+            a crash at any point is finished on the next startup.
+            Storage recording the move instead does so under the lock, once the moves of other workers are applied
+            and the items are known to be still in `from_cluster`, a record of a move that can't happen never lands
+        """
         assert from_cluster.name != to_cluster.name
+        try:
+            if self.storage.records_moves:
+                with self._membership_change() as record:
+                    self._check_members(from_cluster, items)
+                    with self.storage.move(from_cluster.name, to_cluster.name, items), span("move.commit"):
+                        recent = self._commit_move(from_cluster, to_cluster, items, record)
+            else:
+                with self.storage.move(from_cluster.name, to_cluster.name, items), span("move.commit"):
+                    with self._membership_change() as record:
+                        recent = self._commit_move(from_cluster, to_cluster, items, record)
+        finally:
+            with self._lock:
+                for item in items:
+                    self._moving.pop(item, None)
+        if self.refresher is not None:
+            self.refresher.schedule(recent)
+
+    def _commit_move(
+        self, from_cluster: Cluster, to_cluster: Cluster, items: list[str], record: Callable[[dict[str, Any]], None]
+    ) -> list[str]:
+        """ Called within _membership_change, returns the recently sorted classes to refresh """
+        self._move_members(from_cluster, to_cluster, items)
+        record({"op": "move", "from": from_cluster.name, "to": to_cluster.name, "items": items})
+        # every move changes the unsorted set which all cached results are filtered by
+        self.cache.invalidate()
+        return list(reversed(self._recent_classes))
+
+    def _check_members(self, from_cluster: Cluster, items: list[str]) -> None:
+        """ Another worker may have moved the items since they were reserved """
+        assert len(set(items)) == len(items), "Items are listed more than once"
+        invalid = [item for item in items if item not in from_cluster.items or item not in self.embeddings.index]
+        assert not invalid, f"Items {invalid[:10]} are no longer in {from_cluster.name}"
 
+    def _move_members(self, from_cluster: Cluster, to_cluster: Cluster, items: list[str]) -> None:
+        """ In-memory part of a move, storage is changed by the caller. Nothing changes if any item can't move """
+        self._check_members(from_cluster, items)
+        rows = self.embeddings.rows(items)
+        self.row_cluster[rows] = self.cluster_ids[to_cluster.name]
+        if self.prototypes is not None:
+            with span("move.prototypes"):
+                self.prototypes.move(rows, self.cluster_ids[from_cluster.name], self.cluster_ids[to_cluster.name])
         for item in items:
             from_cluster.items.remove(item)
             to_cluster.items.add(item)
-            from_path = os.path.join(from_cluster.path, item)
-            to_path = os.path.join(to_cluster.path, item)
-            shutil.move(from_path, to_path)
 
         # update previews if needed
         if from_cluster.preview in items:
@@ -0,0 +1,7 @@
+"""
+    CPU only benchmarks for the server hot paths, run from the `server` folder:
+        python -m benchmarks.sorter
+    benchmarks.suite times every hot path and writes JSON results to compare between commits:
+        python -m benchmarks.suite run --output=after.json
+        python -m benchmarks.suite compare before.json after.json
+"""
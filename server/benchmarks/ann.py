@@ -0,0 +1,52 @@
+import time
+
+import fire
+import numpy as np
+
+from ivf_index import IvfIndex
+from numpy_sorter import find_close_to_many
+from benchmarks.synthetic import clustered_embeddings, random_request
+
+
+def main(
+    rows: int = 1_000_000,
+    dim: int = 512,
+    clusters: int = 2000,
+    nprobe: tuple[int, ...] = (4, 8, 16, 32, 64),
+    request_sizes: tuple[int, ...] = (1, 10, 50),
+    target_count: int = 768,
+    queries: int = 10,
+) -> None:
+    """
+        recall@target_count and latency of the IVF index against exact scoring on clustered synthetic vectors
+    """
+    embeddings = clustered_embeddings(rows, dim, clusters)
+    assert isinstance(embeddings.vectors, np.ndarray)
+    start = time.perf_counter()
+    index = IvfIndex.build(embeddings.vectors, uid="benchmark")
+    print(f"{rows} rows, {len(index.centroids)} lists, built in {time.perf_counter() - start:.1f}s")
+
+    print(f"{'request':>8} {'nprobe':>7} {'recall':>7} {'exact, ms':>10} {'ivf, ms':>8}")
+    for request_size in request_sizes:
+        requests = [random_request(embeddings, request_size, seed) for seed in range(queries)]
+        exact_time = 0.0
+        exact = []
+        for request in requests:
+            start = time.perf_counter()
+            exact.append({name for name, _ in find_close_to_many(request, embeddings, target_count)})
+            exact_time += time.perf_counter() - start
+        for probes in nprobe:
+            IvfIndex.nprobe = probes
+            recalls = []
+            ivf_time = 0.0
+            for request, expected in zip(requests, exact):
+                start = time.perf_counter()
+                result = find_close_to_many(request, embeddings, target_count, index)
+                ivf_time += time.perf_counter() - start
+                recalls.append(len(expected.intersection(name for name, _ in result)) / len(expected))
+            print(f"{request_size:>8} {probes:>7} {np.mean(recalls):>7.3f} "
+                  f"{1000 * exact_time / queries:>10.1f} {1000 * ivf_time / queries:>8.1f}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,40 @@
+import time
+import tracemalloc
+
+import fire
+
+import numpy_sorter
+from numpy_sorter import find_close_to_many
+from benchmarks.synthetic import random_embeddings, random_request
+
+
+def main(
+    rows: int = 1_000_000,
+    dim: int = 512,
+    class_sizes: tuple[int, ...] = (100, 1_000, 10_000, 50_000),
+    memory_budget_mb: int = 256,
+    threads: int = 1,
+    target_count: int = 768,
+) -> None:
+    """
+        Peak temporary memory and latency of sort_by_class sized requests.
+        The unblocked product would need rows x class_size float32 scores at once
+    """
+    numpy_sorter.MEMORY_BUDGET = memory_budget_mb << 20
+    numpy_sorter.THREADS = threads
+    embeddings = random_embeddings(rows, dim)
+    print(f"{'class':>8} {'unblocked, MB':>14} {'peak, MB':>9} {'time, s':>8}")
+    for size in class_sizes:
+        request = random_request(embeddings, size)
+        tracemalloc.start()
+        start = time.perf_counter()
+        find_close_to_many(request, embeddings, target_count)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        unblocked = rows * size * 4 / 2**20
+        print(f"{size:>8} {unblocked:>14.0f} {peak / 2**20:>9.1f} {elapsed:>8.2f}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
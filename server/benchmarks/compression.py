@@ -0,0 +1,65 @@
+import os
+import tempfile
+import time
+
+import fire
+import numpy as np
+
+from embeddings import Embeddings
+from numpy_sorter import find_close_to_many
+from quantization import MODES, QuantizedVectors, quantize
+from benchmarks.synthetic import clustered_embeddings, random_request
+
+
+def main(
+    rows: int = 1_000_000,
+    dim: int = 512,
+    clusters: int = 2000,
+    modes: tuple[str, ...] = MODES,
+    rerank: tuple[int, ...] = (1, 4),
+    request_size: int = 10,
+    target_count: int = 768,
+    queries: int = 10,
+) -> None:
+    """
+        Memory, recall@target_count and latency of every compression mode against the float32 matrix.
+        The full precision vectors used to re-rank are memory mapped from a temporary .npy file like on the server,
+        rerank=1 is the compressed scoring alone
+    """
+    embeddings = clustered_embeddings(rows, dim, clusters)
+    assert isinstance(embeddings.vectors, np.ndarray)
+    requests = [random_request(embeddings, request_size, seed) for seed in range(queries)]
+    exact_time = 0.0
+    expected = []
+    for request in requests:
+        start = time.perf_counter()
+        expected.append({name for name, _ in find_close_to_many(request, embeddings, target_count)})
+        exact_time += time.perf_counter() - start
+    print(f"float32: {embeddings.vectors.nbytes >> 20} MB, {1000 * exact_time / queries:.1f} ms")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "vectors.npy")
+        np.save(path, embeddings.vectors)
+        exact = np.load(path, mmap_mode='r')
+        print(f"{'mode':>8} {'MB':>6} {'saved':>6} {'train, s':>9} {'rerank':>7} {'recall':>7} {'ms':>7}")
+        for mode in modes:
+            start = time.perf_counter()
+            quantized = quantize(embeddings.vectors, mode, exact)
+            train_time = time.perf_counter() - start
+            compressed = Embeddings(embeddings.names, quantized)
+            saved = 1 - quantized.nbytes / embeddings.vectors.nbytes
+            for factor in rerank:
+                QuantizedVectors.rerank = factor
+                recalls = []
+                elapsed = 0.0
+                for request, names in zip(requests, expected):
+                    start = time.perf_counter()
+                    result = find_close_to_many(request, compressed, target_count)
+                    elapsed += time.perf_counter() - start
+                    recalls.append(len(names.intersection(name for name, _ in result)) / len(names))
+                print(f"{mode:>8} {quantized.nbytes >> 20:>6} {saved:>6.0%} {train_time:>9.1f} {factor:>7} "
+                      f"{np.mean(recalls):>7.3f} {1000 * elapsed / queries:>7.1f}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,53 @@
+import os
+import tempfile
+import time
+
+import fire
+import numpy as np
+from PIL import Image
+from torch.utils.data import DataLoader
+
+from embedder import _SimpleImagesListDataset
+from embedder_backends import IMAGE_SIZE, make_backend
+
+
+def write_random_jpgs(root: str, count: int, size: tuple[int, int] = (640, 480), seed: int = 0) -> list[str]:
+    rng = np.random.default_rng(seed)
+    names = []
+    for i in range(count):
+        name = f"{i:08d}.jpg"
+        pixels = rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(os.path.join(root, name), quality=90)
+        names.append(name)
+    return names
+
+
+def main(model: str, images: int = 512, warmup_batches: int = 1, size: tuple[int, int] = (640, 480),
+         draft: bool = True) -> None:
+    """
+        Images per second of an embedder backend, jpg decoding included
+        model: "unicom" or a path to a student exported by embeddings_kd/export.py
+        draft: decode the jpgs downscaled like the server does, --nodraft decodes them at full size
+    """
+    backend = make_backend(model)
+    backend.load()
+    with tempfile.TemporaryDirectory() as root:
+        names = write_random_jpgs(root, images, size)
+        dataset = _SimpleImagesListDataset(
+            root, names, transform=backend.transform, draft_size=IMAGE_SIZE if draft else None)
+        dataloader = DataLoader(dataset, batch_size=backend.batch_size, num_workers=backend.num_workers)
+        for i, (data, _) in enumerate(dataloader):
+            if i >= warmup_batches:
+                break
+            backend(data)
+        start = time.perf_counter()
+        for data, _ in dataloader:
+            backend(data)
+        elapsed = time.perf_counter() - start
+    backend.unload()
+    print(f"{backend.name}: batch {backend.batch_size}, {backend.num_workers} workers, draft {draft}, "
+          f"{len(names) / elapsed:.1f} images/s")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
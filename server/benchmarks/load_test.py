@@ -0,0 +1,95 @@
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+
+import fire
+import numpy as np
+
+from benchmarks.synthetic import make_data_root
+
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _request(url: str, payload: Optional[dict[str, Any]] = None) -> dict[str, Any]:
+    data = None if payload is None else json.dumps(payload).encode()
+    headers = {"Content-Type": "application/json"}
+    with urllib.request.urlopen(urllib.request.Request(url, data=data, headers=headers)) as response:
+        result: dict[str, Any] = json.loads(response.read())
+    return result
+
+
+def _wait_ready(endpoint: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _request(endpoint + "/classes")
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+
+
+def _run_load(endpoint: str, names: list[str], selection: int, concurrency: int, duration: float) -> list[float]:
+    deadline = time.monotonic() + duration
+
+    def client(seed: int) -> list[float]:
+        rng = random.Random(seed)
+        latencies = []
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            _request(endpoint + "/sort", {"files": rng.sample(names, selection)})
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        return [latency for latencies in pool.map(client, range(concurrency)) for latency in latencies]
+
+
+def main(
+    workers: tuple[int, ...] = (1, 2, 4),
+    items: int = 100_000,
+    classes: int = 20,
+    selection: int = 5,
+    concurrency: int = 16,
+    duration: float = 20.0,
+    port: int = 3101,
+    data_root: Optional[str] = None,
+) -> None:
+    """
+        /api/sort throughput of the server for each worker count, on a synthetic data root.
+        Every request sorts by a new random `selection` of unsorted items, so it is never served from the cache.
+        One worker runs the Flask development server, more run gunicorn
+    """
+    with tempfile.TemporaryDirectory() as tmp_root:
+        if data_root is None:
+            data_root = tmp_root
+            make_data_root(data_root, items, classes)
+        endpoint = f"http://127.0.0.1:{port}/api"
+        print(f"{'workers':>8} {'req/s':>8} {'p50, ms':>8} {'p95, ms':>8}")
+        for count in workers:
+            server = subprocess.Popen(
+                [sys.executable, "main.py", "serve", data_root, f"--workers={count}", f"--port={port}"],
+                cwd=SERVER_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+            try:
+                _wait_ready(endpoint, timeout=600)
+                names = [item["n"] for item in _request(endpoint + "/classes/unsorted")["files"]]
+                latencies = np.array(_run_load(endpoint, names, selection, concurrency, duration))
+            finally:
+                server.terminate()
+                server.wait()
+            print(f"{count:>8} {len(latencies) / duration:>8.1f} "
+                  f"{1000 * np.median(latencies):>8.1f} {1000 * np.percentile(latencies, 95):>8.1f}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,55 @@
+import gc
+import time
+
+import fire
+import numpy as np
+
+from numpy_sorter import find_close_to_many, find_close_to_scores
+from sort_session import SortSession
+from benchmarks.synthetic import random_embeddings
+
+
+def main(
+    rows: tuple[int, ...] = (100_000, 1_000_000),
+    dim: int = 512,
+    start: int = 50,
+    step: int = 5,
+    steps: int = 20,
+    target_count: int = 768,
+    seed: int = 0,
+) -> None:
+    """
+        An annotator selecting `start` items and adding `step` more `steps` times, sorting after each change,
+        then removing the last `step` items again: seconds per sort without and with a session.
+        Both return the same items
+    """
+    print(f"{'rows':>10} {'change':>7} {'full, s':>9} {'session, s':>11} {'speedup':>8}")
+    for n in rows:
+        embeddings = random_embeddings(n, dim)
+        rng = np.random.default_rng(seed)
+        order = [embeddings.names[i] for i in rng.choice(n, size=start + step * steps, replace=False)]
+        selections = [set(order[:start + step * i]) for i in range(steps + 1)] + [set(order[:start + step * steps])]
+        selections[-1] -= set(order[start + step * (steps - 1):])
+        session = SortSession()
+        timings: dict[str, list[tuple[float, float]]] = {"add": [], "remove": []}
+        previous: set[str] = set()
+        for selection in selections:
+            begin = time.perf_counter()
+            expected = find_close_to_many(selection, embeddings, target_count)
+            full = time.perf_counter() - begin
+            begin = time.perf_counter()
+            actual = find_close_to_scores(session.update(embeddings, selection), selection, embeddings, target_count)
+            incremental = time.perf_counter() - begin
+            assert [name for name, _ in expected] == [name for name, _ in actual], "Session results differ"
+            # the first sort of a session scores the whole selection
+            if previous:
+                timings["add" if selection > previous else "remove"].append((full, incremental))
+            previous = selection
+        for change, pairs in timings.items():
+            full, incremental = np.mean(pairs, axis=0)
+            print(f"{n:>10} {change:>7} {full:>9.3f} {incremental:>11.3f} {full / incremental:>7.1f}x")
+        gc.collect()
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,70 @@
+import gc
+import time
+from typing import Any, Callable
+
+import fire
+import numpy as np
+
+from embeddings import Embeddings
+from numpy_sorter import find_close_to_many
+from benchmarks.synthetic import random_embeddings, random_request
+
+
+def _baseline_find_close_to_many(
+    request: set[str],
+    embeddings: Embeddings,
+    target_count: int
+) -> list[tuple[str, float]]:
+    """ Previous implementation: list.index lookups and full argsort """
+    indices = [embeddings.names.index(name) for name in request]
+    vectors = embeddings.vectors
+    assert isinstance(vectors, np.ndarray)
+    query = vectors[indices]
+    scores = np.dot(vectors, query.T)
+    scores[indices] = -np.inf
+    top_score = np.max(scores, axis=1)
+    top_items = np.argsort(top_score)[-target_count:][::-1]
+    return [(embeddings.names[i], top_score[i]) for i in top_items]
+
+
+def _timeit(fn: Callable[[], Any], repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _bench_rows(rows: int, dim: int, request_size: int, target_count: int, repeat: int) -> tuple[float, float]:
+    embeddings = random_embeddings(rows, dim)
+    request = random_request(embeddings, request_size)
+    expected = [name for name, _ in _baseline_find_close_to_many(request, embeddings, target_count)]
+    actual = [name for name, _ in find_close_to_many(request, embeddings, target_count)]
+    assert set(expected) == set(actual), "Results differ from the baseline"
+
+    baseline = _timeit(lambda: _baseline_find_close_to_many(request, embeddings, target_count), repeat)
+    current = _timeit(lambda: find_close_to_many(request, embeddings, target_count), repeat)
+    return baseline, current
+
+
+def main(
+    rows: tuple[int, ...] = (100_000, 1_000_000, 5_000_000),
+    dim: int = 512,
+    request_size: int = 500,
+    target_count: int = 768,
+    repeat: int = 3,
+) -> None:
+    """
+        Compare `find_close_to_many` against the baseline on random normalized vectors.
+        5M x 512 float32 rows need ~10GB of RAM, pass e.g. `--dim=128` on smaller machines
+    """
+    print(f"{'rows':>10} {'baseline, s':>12} {'current, s':>12} {'speedup':>8}")
+    for n in rows:
+        baseline, current = _bench_rows(n, dim, request_size, target_count, repeat)
+        print(f"{n:>10} {baseline:>12.3f} {current:>12.3f} {baseline / current:>7.1f}x")
+        gc.collect()
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
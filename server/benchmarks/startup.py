@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import time
+from typing import Callable
+
+import fire
+
+from application import FILE_FORMAT
+from manifest import DirectoryManifest
+from benchmarks.synthetic import item_names, make_file_tree
+
+
+def _listdir_scan(data_root: str) -> dict[str, set[str]]:
+    """ Folder scan of the server before the manifest: listdir and an isfile stat per item """
+    clusters = {}
+    for cluster_name in os.listdir(data_root):
+        cluster_path = os.path.join(data_root, cluster_name)
+        if os.path.isdir(cluster_path) and not cluster_name.startswith('.'):
+            clusters[cluster_name] = {
+                item for item in os.listdir(cluster_path)
+                if os.path.isfile(os.path.join(cluster_path, item)) and item.endswith(FILE_FORMAT)
+            }
+    return clusters
+
+
+def _timed(scan: Callable[[], dict[str, set[str]]]) -> tuple[float, dict[str, set[str]]]:
+    start = time.perf_counter()
+    clusters = scan()
+    return time.perf_counter() - start, clusters
+
+
+def main(sizes: tuple[int, ...] = (100_000, 1_000_000), classes: int = 100, threads: int = DirectoryManifest.threads,
+         root: str = "") -> None:
+    """
+        Startup folder scan on synthetic data roots of empty files.
+        The page cache is warm after the tree is written, on network mounts every listing and stat is a round trip,
+        so the gap between the stat per item baseline and the manifest grows there
+    """
+    DirectoryManifest.threads = threads
+    # the racy window would make every folder of a freshly written tree be listed again
+    DirectoryManifest.racy_seconds = 0
+    print(f"{'items':>9} {'listdir+isfile, s':>18} {'scandir, s':>11} {'manifest, s':>12} {'1 changed, s':>13}")
+    for size in sizes:
+        data_root = tempfile.mkdtemp(prefix="startup-", dir=root or None)
+        try:
+            make_file_tree(data_root, item_names(size), classes)
+            manifest = DirectoryManifest(os.path.join(data_root, ".manifest.json"))
+            baseline, expected = _timed(lambda: _listdir_scan(data_root))
+            cold, clusters = _timed(lambda: manifest.scan(data_root, FILE_FORMAT))
+            assert clusters == expected
+            warm, clusters = _timed(lambda: manifest.scan(data_root, FILE_FORMAT))
+            assert clusters == expected
+            open(os.path.join(data_root, "unsorted", f"new{FILE_FORMAT}"), 'w').close()
+            changed, clusters = _timed(lambda: manifest.scan(data_root, FILE_FORMAT))
+            assert len(clusters["unsorted"]) == len(expected["unsorted"]) + 1
+            print(f"{size:>9} {baseline:>18.2f} {cold:>11.2f} {warm:>12.2f} {changed:>13.2f}")
+        finally:
+            shutil.rmtree(data_root)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,169 @@
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+from typing import Any, Callable, Optional
+
+import fire
+import numpy as np
+from flask import Flask
+
+from application import Application, UNSORTED_CLASS
+from api_blueprint import make_api
+from benchmarks.synthetic import make_data_root
+
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_VERSION = 1
+
+
+def _stats(samples: list[float]) -> dict[str, float]:
+    values = np.array(samples)
+    return {
+        "n": len(values),
+        "min": float(values.min()),
+        "median": float(np.median(values)),
+        "p95": float(np.percentile(values, 95)),
+        "mean": float(values.mean()),
+    }
+
+
+def _measure(fn: Callable[[int], Any], repeat: int) -> dict[str, float]:
+    """ `fn` gets the repetition number so every call can work on different items """
+    samples = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn(i)
+        samples.append(time.perf_counter() - start)
+    return _stats(samples)
+
+
+def _quiet(fn: Callable[[], Any]) -> Any:
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn()
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=SERVER_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _bench_scale(data_root: str, repeat: int, selection: int, move_batch: int, seed: int) -> dict[str, Any]:
+    rng = random.Random(seed)
+    results = {}
+    # the first start lists every folder, the second one reuses the manifest
+    results["startup_cold"] = _measure(lambda i: _quiet(lambda: Application(data_root)), 1)
+    results["startup"] = _measure(lambda i: _quiet(lambda: Application(data_root)), repeat)
+    app = _quiet(lambda: Application(data_root))
+    flask_app = Flask(__name__)
+    flask_app.register_blueprint(make_api(app))
+    client = flask_app.test_client()
+
+    unsorted = list(app.unsorted.items)
+    classes = sorted((c for c in app.clusters.values() if c.name != UNSORTED_CLASS), key=lambda c: -len(c.items))
+    largest = classes[0].name
+
+    # new random selections, so the sort cache never answers
+    results["sort"] = _measure(lambda i: app.sort(set(rng.sample(unsorted, selection))), repeat)
+
+    def sort_by_class(i: int) -> None:
+        app.cache.invalidate()
+        app.sort_by_class(largest)
+    results["sort_by_class"] = _measure(sort_by_class, repeat)
+
+    results["prototypes_build"] = _measure(lambda i: app._get_prototypes(), 1)
+
+    def classify(i: int) -> None:
+        app.cache.invalidate()
+        app.classify()
+    results["classify"] = _measure(classify, repeat)
+
+    results["get_cluster_items"] = _measure(lambda i: app.get_cluster_items(UNSORTED_CLASS), repeat)
+
+    moved = rng.sample(unsorted, move_batch * repeat)
+    results["move"] = _measure(
+        lambda i: app.unsorted2cluster(moved[i * move_batch:(i + 1) * move_batch], largest), repeat)
+
+    files = rng.sample(list(app.unsorted.items), repeat)
+
+    def serve_file(i: int) -> None:
+        response = client.get(f"/api/file/{UNSORTED_CLASS}/{files[i]}")
+        assert response.status_code == 200
+        response.close()
+    results["serve_file"] = _measure(serve_file, repeat)
+    return results
+
+
+def run(
+    items: tuple[int, ...] = (10_000, 100_000),
+    classes: int = 20,
+    dim: int = 512,
+    repeat: int = 10,
+    selection: int = 5,
+    move_batch: int = 100,
+    seed: int = 0,
+    output: str = "benchmark.json",
+) -> None:
+    """
+        Times the server hot paths on synthetic data roots of each size and writes the results to `output`.
+        Runs on CPU only: embeddings.h5 of the data root already covers every placeholder jpg.
+        Every value is in seconds, compare two result files with `compare`
+    """
+    results = {}
+    for size in items:
+        with tempfile.TemporaryDirectory() as data_root:
+            make_data_root(data_root, size, classes, dim=dim, seed=seed)
+            results[str(size)] = _bench_scale(data_root, repeat, selection, move_batch, seed)
+        for name, stats in results[str(size)].items():
+            print(f"{size:>9} {name:>18} {1000 * stats['median']:>10.2f} ms")
+
+    report = {
+        "version": RESULTS_VERSION,
+        "commit": _commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "cpus": os.cpu_count(),
+        "config": {"classes": classes, "dim": dim, "repeat": repeat, "selection": selection,
+                   "move_batch": move_batch, "seed": seed},
+        "results": results,
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+
+def compare(baseline: str, current: str, threshold: float = 0.1) -> None:
+    """ Median of every measurement in `current` relative to `baseline`, slower by more than `threshold` is flagged """
+    with open(baseline) as f:
+        before = json.load(f)
+    with open(current) as f:
+        after = json.load(f)
+    if before["config"] != after["config"]:
+        print(f"Warning: configs differ, {before['config']} vs {after['config']}")
+    print(f"{before['commit']} -> {after['commit']}")
+    print(f"{'items':>9} {'measurement':>18} {'before, ms':>11} {'after, ms':>10} {'ratio':>6}")
+    regressions = 0
+    for size, measurements in after["results"].items():
+        for name, stats in measurements.items():
+            previous = before["results"].get(size, {}).get(name)
+            if previous is None:
+                continue
+            ratio = stats["median"] / previous["median"]
+            flag = " slower" if ratio > 1 + threshold else ""
+            regressions += bool(flag)
+            print(f"{size:>9} {name:>18} {1000 * previous['median']:>11.2f} {1000 * stats['median']:>10.2f} "
+                  f"{ratio:>6.2f}{flag}")
+    print(f"{regressions} measurements slower by more than {threshold:.0%}")
+
+
+if __name__ == "__main__":
+    fire.Fire({"run": run, "compare": compare})
@@ -0,0 +1,86 @@
+import io
+import os
+
+import numpy as np
+from PIL import Image
+
+from embeddings import Embeddings, save_embeddings
+
+
+def random_vectors(rows: int, dim: int = 512, seed: int = 0, chunk: int = 1 << 18) -> np.ndarray:
+    """
+        L2 normalized float32 gaussian vectors, generated chunk by chunk to keep peak memory at one matrix
+    """
+    rng = np.random.default_rng(seed)
+    vectors = np.empty((rows, dim), dtype=np.float32)
+    for start in range(0, rows, chunk):
+        block = vectors[start:start + chunk]
+        block[:] = rng.standard_normal(block.shape, dtype=np.float32)
+        block /= np.linalg.norm(block, axis=1, keepdims=True)
+    return vectors
+
+
+def clustered_vectors(rows: int, dim: int = 512, clusters: int = 1000, spread: float = 0.5, seed: int = 0,
+                      chunk: int = 1 << 18) -> np.ndarray:
+    """
+        L2 normalized points around random class centers, closer to real image embeddings than pure noise
+        which has no neighbourhood structure at all
+    """
+    rng = np.random.default_rng(seed)
+    centers = random_vectors(clusters, dim, seed + 1)
+    vectors = np.empty((rows, dim), dtype=np.float32)
+    for start in range(0, rows, chunk):
+        block = vectors[start:start + chunk]
+        block[:] = rng.standard_normal(block.shape, dtype=np.float32)
+        block *= spread / np.sqrt(dim)
+        block += centers[rng.integers(0, clusters, len(block))]
+        block /= np.linalg.norm(block, axis=1, keepdims=True)
+    return vectors
+
+
+def item_names(rows: int) -> list[str]:
+    return [f"{i:08d}.jpg" for i in range(rows)]
+
+
+def random_embeddings(rows: int, dim: int = 512, seed: int = 0) -> Embeddings:
+    return Embeddings(item_names(rows), random_vectors(rows, dim, seed))
+
+
+def clustered_embeddings(rows: int, dim: int = 512, clusters: int = 1000, seed: int = 0) -> Embeddings:
+    return Embeddings(item_names(rows), clustered_vectors(rows, dim, clusters, seed=seed))
+
+
+def random_request(embeddings: Embeddings, size: int, seed: int = 1) -> set[str]:
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(embeddings), size=size, replace=False)
+    return {embeddings.names[i] for i in rows}
+
+
+def placeholder_jpg() -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8), (127, 127, 127)).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+def make_file_tree(root: str, names: list[str], classes: int = 10, sorted_share: float = 0.2, data: bytes = b"",
+                   seed: int = 0) -> None:
+    """ Files with the given content spread over `classes` cluster folders and `unsorted` """
+    rng = np.random.default_rng(seed)
+    folders = ["unsorted"] + [f"class_{i:03d}" for i in range(classes)]
+    for folder in folders:
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+    assignment = np.where(rng.random(len(names)) < sorted_share, rng.integers(1, len(folders), len(names)), 0)
+    for name, folder in zip(names, assignment):
+        with open(os.path.join(root, folders[folder], name), 'wb') as f:
+            f.write(data)
+
+
+def make_data_root(root: str, items: int, classes: int = 10, sorted_share: float = 0.2, dim: int = 512,
+                   seed: int = 0) -> None:
+    """
+        Data root the server starts on without the unicom model: tiny placeholder jpgs spread over
+        `classes` cluster folders and `unsorted`, with embeddings.h5 already covering all of them
+    """
+    embeddings = clustered_embeddings(items, dim, clusters=max(1, classes * 4), seed=seed)
+    make_file_tree(root, embeddings.names, classes, sorted_share, placeholder_jpg(), seed)
+    save_embeddings(os.path.join(root, "embeddings.h5"), embeddings)
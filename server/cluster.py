@@ -1,5 +1,49 @@
 from dataclasses import dataclass, field
-from typing import Optional
+from typing import Iterable, Iterator, Optional
+
+
+class IndexedSet():
+    """
+        Set of item names that can also be read by position.
+        Removal moves the last item into the freed position, so add, remove and lookup by position are O(1)
+    """
+    def __init__(self, items: Iterable[str] = ()) -> None:
+        self._items: list[str] = []
+        self._positions: dict[str, int] = {}
+        self.update(items)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, item: object) -> bool:
+        return item in self._positions
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._items)
+
+    def __getitem__(self, position: int) -> str:
+        return self._items[position]
+
+    def add(self, item: str) -> None:
+        if item not in self._positions:
+            self._positions[item] = len(self._items)
+            self._items.append(item)
+
+    def update(self, items: Iterable[str]) -> None:
+        for item in items:
+            self.add(item)
+
+    def remove(self, item: str) -> None:
+        position = self._positions.pop(item)
+        last = self._items.pop()
+        if position < len(self._items):
+            self._items[position] = last
+            self._positions[last] = position
+
+    def pop(self) -> str:
+        item = self._items.pop()
+        del self._positions[item]
+        return item
 
 
 @dataclass
@@ -7,4 +51,4 @@ class Cluster():
     name: str
     path: str
     preview: Optional[str] = None
-    items: set[str] = field(default_factory=set)
+    items: IndexedSet = field(default_factory=IndexedSet)
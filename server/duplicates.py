@@ -0,0 +1,237 @@
+import os
+
+import numpy as np
+
+
+DUPLICATES_SUFFIX = ".duplicates.npz"
+# rows whose signatures are computed per step, bounds the float32 temporaries
+SIGNATURE_BLOCK = 1 << 16
+# first similar rows kept per row while grouping, a row whose candidates all joined groups is looked up again
+CANDIDATES = 4
+NO_CANDIDATE = np.iinfo(np.int64).max
+# buckets up to this size are compared pair by pair all at once, larger ones block by block
+PAIRWISE_BUCKET = 32
+# pairs scored per step, bounds the gathered float32 rows
+PAIR_BLOCK = 1 << 14
+
+
+class Duplicates():
+    """
+        Groups of near-identical library rows, e.g. frames of one burst, each led by its representative row.
+        Candidates are found with random hyperplane LSH: a row gets `tables` signatures of `bits` signs of its
+        projections on random hyperplanes, and only rows sharing a signature are compared. A row joins the group
+        of the first earlier representative in any of its buckets with a cosine of at least `threshold`, so every
+        member is that close to its representative, groups never chain and rows added later never regroup earlier
+        ones. `representative[row]` is the row itself outside groups
+    """
+    threshold: float = 0.97
+    bits: int = 16
+    tables: int = 8
+    # rows of one bucket compared at once, a larger bucket is compared block against block
+    max_bucket: int = 4096
+
+    def __init__(self, planes: np.ndarray, keys: np.ndarray, representative: np.ndarray, threshold: float,
+                 uid: str) -> None:
+        # (tables * bits, dim) hyperplanes and the (tables, N) signatures of the rows
+        self.planes = planes
+        self.keys = keys
+        self.threshold = threshold
+        self.uid = uid
+        self._set_representative(representative)
+
+    def __len__(self) -> int:
+        return len(self.representative)
+
+    def _set_representative(self, representative: np.ndarray) -> None:
+        self.representative = representative.astype(np.int64, copy=False)
+        self.is_representative = self.representative == np.arange(len(representative))
+        # CSR layout: rows of the group led by row i are order[offsets[i]:offsets[i + 1]]
+        self.order = np.argsort(self.representative, kind='stable')
+        counts = np.bincount(self.representative, minlength=len(representative))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    def members(self, row: int) -> np.ndarray:
+        """ Rows of the group led by `row`, the row itself included """
+        return self.order[self.offsets[row]:self.offsets[row + 1]]
+
+    def group_sizes(self, rows: np.ndarray) -> np.ndarray:
+        return self.offsets[rows + 1] - self.offsets[rows]
+
+    @staticmethod
+    def build(vectors: np.ndarray, uid: str, seed: int = 0) -> 'Duplicates':
+        rng = np.random.default_rng(seed)
+        planes = rng.standard_normal((Duplicates.tables * Duplicates.bits, vectors.shape[1])).astype(np.float32)
+        keys = _signatures(vectors, planes, Duplicates.tables)
+        representative = np.arange(len(vectors), dtype=np.int64)
+        _group(vectors, keys, representative, 0, Duplicates.threshold, Duplicates.max_bucket)
+        return Duplicates(planes, keys, representative, Duplicates.threshold, uid)
+
+    def extended(self, vectors: np.ndarray) -> 'Duplicates':
+        """
+            Groups rows len(self).. of the full `vectors` added since, with the existing hyperplanes.
+            Leaves this one as it is for the requests using it
+        """
+        start = len(self)
+        keys = np.concatenate([self.keys, _signatures(vectors[start:], self.planes, self.keys.shape[0])], axis=1)
+        representative = np.concatenate([self.representative, np.arange(start, len(vectors), dtype=np.int64)])
+        _group(vectors, keys, representative, start, self.threshold, self.max_bucket)
+        return Duplicates(self.planes, keys, representative, self.threshold, self.uid)
+
+    @staticmethod
+    def path_for(embeddings_path: str) -> str:
+        return os.path.splitext(embeddings_path)[0] + DUPLICATES_SUFFIX
+
+    def save(self, path: str) -> None:
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, planes=self.planes, keys=self.keys, representative=self.representative,
+                 threshold=self.threshold, uid=self.uid)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str) -> 'Duplicates':
+        with np.load(path) as data:
+            return Duplicates(data["planes"], data["keys"], data["representative"], float(data["threshold"]),
+                              str(data["uid"]))
+
+
+def _signatures(vectors: np.ndarray, planes: np.ndarray, tables: int) -> np.ndarray:
+    bits = len(planes) // tables
+    weights = np.int64(1) << np.arange(bits, dtype=np.int64)
+    keys = np.empty((tables, len(vectors)), dtype=np.int64)
+    for start in range(0, len(vectors), SIGNATURE_BLOCK):
+        block = np.asarray(vectors[start:start + SIGNATURE_BLOCK], dtype=np.float32)
+        signs = (block @ planes.T > 0).reshape(len(block), tables, bits)
+        keys[:, start:start + len(block)] = (signs @ weights).T
+    return keys
+
+
+def _group(
+    vectors: np.ndarray, keys: np.ndarray, representative: np.ndarray, start: int, threshold: float, max_bucket: int
+) -> None:
+    """
+        Groups rows from `start` on in place and in row order: a row joins the group of the first earlier
+        representative it shares a bucket with and is similar to, or leads a group itself. Earlier rows never
+        depend on later ones, so grouping rows 0..n and then the rest gives the groups of grouping all at once
+    """
+    candidates = _candidates(vectors, keys, representative, start, threshold, max_bucket)
+    rows = np.flatnonzero(candidates[:, 0] != NO_CANDIDATE)
+    first = candidates[rows, 0]
+    # the first candidate surely leads a group when it was grouped before or has no candidates itself
+    sure = first < start
+    sure[~sure] = candidates[first[~sure] - start, 0] == NO_CANDIDATE
+    representative[rows[sure] + start] = first[sure]
+    for row in rows[~sure] + start:
+        for candidate in candidates[row - start]:
+            if candidate == NO_CANDIDATE:
+                break
+            if representative[candidate] == candidate:
+                representative[row] = candidate
+                break
+        else:
+            # every remembered candidate joined a group, look further
+            representative[row] = _first_representative(vectors, keys, representative, row, threshold)
+
+
+def _candidates(
+    vectors: np.ndarray, keys: np.ndarray, representative: np.ndarray, start: int, threshold: float, max_bucket: int
+) -> np.ndarray:
+    """
+        The CANDIDATES first earlier rows similar to every row from `start` on and sharing a bucket with it,
+        members of groups excluded, padded with NO_CANDIDATE. Only buckets holding a row from `start` on are
+        compared, those of up to PAIRWISE_BUCKET rows all at once, larger ones `max_bucket` rows at a time
+    """
+    count = len(representative)
+    candidates = np.full((count - start, CANDIDATES), NO_CANDIDATE, dtype=np.int64)
+    eligible = np.flatnonzero(representative == np.arange(count))
+    for table_keys in keys:
+        # stable sort keeps the rows of a bucket in ascending order
+        order = eligible[np.argsort(table_keys[eligible], kind='stable')]
+        sorted_keys = table_keys[order]
+        bucket = np.cumsum(np.diff(sorted_keys, prepend=sorted_keys[:1]) != 0)
+        fresh = np.zeros(len(order), dtype=bool)
+        fresh[bucket[order >= start]] = True
+        order, bucket = order[fresh[bucket]], bucket[fresh[bucket]]
+        sizes = np.bincount(bucket, minlength=len(fresh))[bucket]
+        small = (sizes > 1) & (sizes <= PAIRWISE_BUCKET)
+        slots, found = _pairwise_similar(vectors, order[small], bucket[small], start, threshold)
+        large = sizes > PAIRWISE_BUCKET
+        for rows in np.split(order[large], np.flatnonzero(np.diff(bucket[large])) + 1):
+            if len(rows) > 0:
+                bucket_slots, bucket_found = _blockwise_similar(vectors, rows, start, threshold, max_bucket)
+                slots, found = np.concatenate([slots, bucket_slots]), np.concatenate([found, bucket_found])
+        _merge_candidates(candidates, slots, found, count)
+    return candidates
+
+
+def _pairwise_similar(
+    vectors: np.ndarray, order: np.ndarray, bucket: np.ndarray, start: int, threshold: float
+) -> tuple[np.ndarray, np.ndarray]:
+    """ Similar (later row - start, earlier row) pairs of small buckets, rows `distance` apart at a time """
+    slots: list[np.ndarray] = [np.empty(0, dtype=np.int64)]
+    found: list[np.ndarray] = [np.empty(0, dtype=np.int64)]
+    for distance in range(1, PAIRWISE_BUCKET):
+        same = bucket[distance:] == bucket[:-distance]
+        later, earlier = order[distance:][same], order[:-distance][same]
+        if len(later) == 0:
+            break
+        fresh = later >= start
+        later, earlier = later[fresh], earlier[fresh]
+        for pair_start in range(0, len(later), PAIR_BLOCK):
+            block_later = later[pair_start:pair_start + PAIR_BLOCK]
+            block_earlier = earlier[pair_start:pair_start + PAIR_BLOCK]
+            scores = np.einsum('ij,ij->i', np.asarray(vectors[block_later], dtype=np.float32),
+                               np.asarray(vectors[block_earlier], dtype=np.float32))
+            similar = scores >= threshold
+            slots.append(block_later[similar] - start)
+            found.append(block_earlier[similar])
+    return np.concatenate(slots), np.concatenate(found)
+
+
+def _blockwise_similar(
+    vectors: np.ndarray, rows: np.ndarray, start: int, threshold: float, max_bucket: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """ Like `_pairwise_similar` for one large bucket, only the CANDIDATES first similar rows of a block are kept """
+    slots: list[np.ndarray] = [np.empty(0, dtype=np.int64)]
+    found: list[np.ndarray] = [np.empty(0, dtype=np.int64)]
+    queries = rows[rows >= start]
+    for query_start in range(0, len(queries), max_bucket):
+        query_rows = queries[query_start:query_start + max_bucket]
+        query = np.asarray(vectors[query_rows], dtype=np.float32)
+        earlier = rows[rows < query_rows[-1]]
+        for block_start in range(0, len(earlier), max_bucket):
+            block_rows = earlier[block_start:block_start + max_bucket]
+            similar = query @ np.asarray(vectors[block_rows], dtype=np.float32).T >= threshold
+            similar &= block_rows < query_rows[:, None]
+            similar &= np.cumsum(similar, axis=1, dtype=np.uint16) <= CANDIDATES
+            query_index, block_index = np.nonzero(similar)
+            slots.append(query_rows[query_index] - start)
+            found.append(block_rows[block_index])
+    return np.concatenate(slots), np.concatenate(found)
+
+
+def _merge_candidates(candidates: np.ndarray, slots: np.ndarray, rows: np.ndarray, count: int) -> None:
+    """ Keeps the CANDIDATES first rows of every slot among its candidates and the `rows` found for it """
+    known = candidates != NO_CANDIDATE
+    slots = np.concatenate([np.nonzero(known)[0], slots])
+    rows = np.concatenate([candidates[known], rows])
+    # sorted by slot then row, a row sharing buckets of several tables is found once per table
+    pairs = np.sort(slots * count + rows)
+    pairs = pairs[np.diff(pairs, prepend=-1) != 0]
+    slots, rows = pairs // count, pairs % count
+    rank = np.arange(len(pairs)) - np.searchsorted(slots, slots)
+    keep = rank < CANDIDATES
+    candidates[slots[keep], rank[keep]] = rows[keep]
+
+
+def _first_representative(
+    vectors: np.ndarray, keys: np.ndarray, representative: np.ndarray, row: int, threshold: float
+) -> int:
+    """ First earlier representative similar to `row` in any of its buckets, the row itself if there is none """
+    shared = np.zeros(row, dtype=bool)
+    for table_keys in keys:
+        shared |= table_keys[:row] == table_keys[row]
+    rows = np.flatnonzero(shared)
+    rows = rows[representative[rows] == rows]
+    scores = np.asarray(vectors[rows], dtype=np.float32) @ np.asarray(vectors[row], dtype=np.float32)
+    similar = rows[scores >= threshold]
+    return int(similar[0]) if len(similar) > 0 else row
@@ -1,31 +1,33 @@
 import numpy as np
 import os
-import h5py
-from dataclasses import dataclass
-import torch
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterator, Optional
 from torch.utils.data import DataLoader, Dataset
 from tqdm import tqdm
 from PIL import Image
-import unicom
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
 from sklearn.preprocessing import normalize
 
-
-@dataclass(frozen=True)
-class Embeddings:
-    names: list[str]
-    vectors: np.ndarray
+from embeddings import Embeddings, Projection, append_embeddings, embeddings_model, iter_embeddings, read_names, \
+    save_embeddings
+from embedder_backends import IMAGE_SIZE, Backend, UnicomBackend
+from metrics import EMBEDDED_IMAGES, EMBEDDING_RATE, span
 
 
 class _SimpleImagesListDataset(Dataset):
-    def __init__(self, data_root: str, images: list[str], transform=None):
+    def __init__(self, data_root: str, images: list[str], transform=None, draft_size: Optional[int] = None):
+        """ draft_size: decode jpgs at the smallest DCT scale that still covers draft_size x draft_size """
         self.data_root = data_root
         self.images = images
         self.transform = transform
+        self.draft_size = draft_size
 
     def __getitem__(self, idx):
         image_name = self.images[idx]
         image = Image.open(os.path.join(self.data_root, image_name))
+        if self.draft_size is not None:
+            image.draft('RGB', (self.draft_size, self.draft_size))
         if self.transform is not None:
             image = self.transform(image)
         return image, image_name
@@ -36,42 +38,143 @@ class _SimpleImagesListDataset(Dataset):
 
 class Embedder():
     embedding_dim: int = 512
-    batch_size: int = 256
-    num_workers: int = 12
-    device: str = 'cuda:0'
+    backend: Backend = UnicomBackend()
+    # downscaled jpg decoding, several times faster on photos much larger than the network input
+    draft: bool = True
+    # images embedded between two checkpoints of the spool
+    checkpoint_images: int = 8192
+    # rows of spooled features per IncrementalPCA step and per projected chunk
+    projection_chunk: int = 16384
+    # keep the model loaded between runs, live ingestion embeds small batches all day
+    keep_loaded: bool = False
+    _loaded: bool = False
+
+    def generate_embeddings(
+        data_root: str, images: list[str], spool_path: str, projection: Optional[Projection] = None
+    ) -> Embeddings:
+        """
+            Network features are appended to the HDF5 file `spool_path` every `checkpoint_images` images,
+            a run interrupted by a crash resumes from its last checkpoint when called again with the same spool.
+            Without `projection` a PCA is fitted on the spooled features chunk by chunk and returned with the
+            embeddings, pass the stored one when embedding new items for an existing library.
+            The spool is kept, remove it once the embeddings are stored
+        """
+        backend = Embedder.backend
+        remaining = Embedder._resume(spool_path, images)
+        if remaining:
+            start = time.perf_counter()
+            Embedder._embed(data_root, remaining, spool_path)
+            elapsed = time.perf_counter() - start
+            print(f"Embedded {len(remaining)} images with {backend.name} at {len(remaining) / elapsed:.1f} images/s")
+            EMBEDDED_IMAGES.inc(len(remaining))
+            EMBEDDING_RATE.set(len(remaining) / elapsed)
 
-    def generate_embeddings(data_root: str, images: list[str]) -> Embeddings:
-        model, preprocess = unicom.load("ViT-B/16")
-        model = model.to(Embedder.device)
-        dataset = _SimpleImagesListDataset(data_root, images, transform=preprocess)
+        with span("embed.projection"):
+            if projection is None:
+                projection = Embedder._fit_projection(spool_path)
+            wanted = set(images)
+            names: list[str] = []
+            chunks = []
+            for chunk_names, features in iter_embeddings(spool_path, Embedder.projection_chunk):
+                # the spool of an interrupted run may hold images deleted since
+                keep = [i for i, name in enumerate(chunk_names) if name in wanted]
+                names.extend(chunk_names[i] for i in keep)
+                features = features[keep]
+                chunks.append(projection.apply(features) if projection is not None else features)
+        vectors = np.concatenate(chunks) if chunks else np.empty((0, Embedder.embedding_dim), dtype=np.float32)
+        return Embeddings(names, vectors, projection, backend.name)
 
-        with torch.no_grad():
-            all_features = []
-            dataloader = DataLoader(dataset, batch_size=Embedder.batch_size, num_workers=Embedder.num_workers)
-            for data, _ in tqdm(dataloader):
-                features = model(data.to(Embedder.device))
-                all_features.append(features)
-            torch_embedding = torch.cat(all_features)
-            embeddings = torch_embedding.cpu().numpy()
-            embeddings = normalize(embeddings, axis=1, norm='l2')
-            assert Embedder.embedding_dim <= embeddings.shape[1], "Embedder network output dimension is too small"
-            if Embedder.embedding_dim < embeddings.shape[1]:
-                pca = PCA(n_components=Embedder.embedding_dim)
-                embeddings = pca.fit_transform(embeddings)
-                embeddings = normalize(embeddings, axis=1, norm='l2')
-        del model, dataset
-        return Embeddings(images, embeddings)
+    @staticmethod
+    def _resume(spool_path: str, images: list[str]) -> list[str]:
+        """ Images not embedded yet, a spool made by another model is discarded """
+        if not os.path.exists(spool_path):
+            return images
+        if embeddings_model(spool_path) != Embedder.backend.name:
+            print(f"Discarding {spool_path} made by {embeddings_model(spool_path)}")
+            os.remove(spool_path)
+            return images
+        done = set(read_names(spool_path))
+        remaining = [image for image in images if image not in done]
+        print(f"Resuming from {spool_path}: {len(images) - len(remaining)} of {len(images)} images already embedded")
+        return remaining
 
     @staticmethod
-    def save_embeddings(path: str, data: Embeddings) -> None:
-        with h5py.File(path, 'w') as f:
-            for k, v in zip(data.names, data.vectors):
-                f.create_dataset(k, data=v)
+    def _embed(data_root: str, images: list[str], spool_path: str) -> None:
+        backend = Embedder.backend
+        if not Embedder._loaded:
+            with span("embed.load"):
+                backend.load()
+            Embedder._loaded = True
+        draft_size = IMAGE_SIZE if Embedder.draft else None
+        dataset = _SimpleImagesListDataset(data_root, images, transform=backend.transform, draft_size=draft_size)
+        # pinned batches are copied to the GPU asynchronously while the previous batch is computed
+        dataloader = DataLoader(dataset, batch_size=backend.batch_size, num_workers=backend.num_workers,
+                                pin_memory=backend.pin_memory)
+        # checkpoints are written by another thread so the model never waits for the disk
+        writer = ThreadPoolExecutor(1, thread_name_prefix="spool")
+        pending: Optional[Future] = None
+        features: list[np.ndarray] = []
+        names: list[str] = []
+        try:
+            with span("embed.inference"):
+                for data, batch_names in tqdm(dataloader):
+                    features.append(normalize(backend(data), axis=1, norm='l2'))
+                    names.extend(batch_names)
+                    if len(names) >= Embedder.checkpoint_images:
+                        if pending is not None:
+                            pending.result()
+                        pending = writer.submit(Embedder._checkpoint, spool_path, names, features)
+                        features, names = [], []
+            if pending is not None:
+                pending.result()
+            if names:
+                Embedder._checkpoint(spool_path, names, features)
+        finally:
+            writer.shutdown()
+            if not Embedder.keep_loaded:
+                backend.unload()
+                Embedder._loaded = False
 
     @staticmethod
-    def read_embeddings(path: str) -> Embeddings:
-        assert os.path.exists(path), f"File {path} does not exist"
-        with h5py.File(path, 'r') as f:
-            keys = list(f.keys())
-            values = [f[k][()] for k in keys]
-        return Embeddings(keys, np.array(values))
+    def _checkpoint(spool_path: str, names: list[str], features: list[np.ndarray]) -> None:
+        data = Embeddings(names, np.concatenate(features), model=Embedder.backend.name)
+        if os.path.exists(spool_path):
+            append_embeddings(spool_path, data)
+        else:
+            save_embeddings(spool_path, data)
+
+    @staticmethod
+    def _fit_projection(spool_path: str) -> Optional[Projection]:
+        """
+            PCA to `embedding_dim` fitted on the spooled features, IncrementalPCA keeps memory at one chunk.
+            None when the network output already has `embedding_dim` dimensions
+        """
+        chunks = iter_embeddings(spool_path, Embedder.projection_chunk)
+        first = next(chunks, None)
+        assert first is not None, "No features to fit the projection on"
+        dim = first[1].shape[1]
+        assert Embedder.embedding_dim <= dim, "Embedder network output dimension is too small"
+        if Embedder.embedding_dim == dim:
+            return None
+        pca = IncrementalPCA(n_components=Embedder.embedding_dim)
+        fitted = False
+        for features in _merge_small_tail(first[1], (features for _, features in chunks), Embedder.embedding_dim):
+            if not fitted and len(features) < Embedder.projection_chunk:
+                # the whole spool fits in one chunk
+                pca = PCA(n_components=Embedder.embedding_dim).fit(features)
+            else:
+                pca.partial_fit(features)
+            fitted = True
+        return Projection(pca.mean_.astype(np.float32), pca.components_.astype(np.float32))
+
+
+def _merge_small_tail(first: np.ndarray, rest: Iterator[np.ndarray], min_rows: int) -> Iterator[np.ndarray]:
+    """ IncrementalPCA needs at least n_components rows per step, a short last chunk joins the one before """
+    previous = first
+    for chunk in rest:
+        if len(chunk) < min_rows:
+            previous = np.concatenate([previous, chunk])
+            continue
+        yield previous
+        previous = chunk
+    yield previous
@@ -0,0 +1,137 @@
+import os
+from typing import Callable, Optional
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms as tvt
+
+from system_info import available_cores
+
+
+# mean and std taken from unicom.vision_transformer, the student is trained with the same normalization
+MEAN = (0.48145466, 0.4578275, 0.40821073)
+STD = (0.26862954, 0.26130258, 0.27577711)
+# image size is 224x224 because of the ViT-B/16 model
+IMAGE_SIZE = 224
+
+
+class Backend():
+    """
+        Turns batches of preprocessed images into network features.
+        `load` must be called before use and `unload` releases the model
+    """
+    name: str
+    batch_size: int
+    num_workers: int
+    # page-locked batches let the host to device copy run asynchronously
+    pin_memory: bool = False
+    transform: Optional[Callable[[Image.Image], torch.Tensor]] = None
+
+    def load(self) -> None:
+        raise NotImplementedError
+
+    def unload(self) -> None:
+        pass
+
+    def __call__(self, batch: torch.Tensor) -> np.ndarray:
+        raise NotImplementedError
+
+
+class UnicomBackend(Backend):
+    """ The original unicom ViT-B/16 teacher, meant for GPU """
+    name = "unicom-ViT-B/16"
+
+    def __init__(self, device: str = 'cuda:0', batch_size: int = 256, num_workers: int = 12) -> None:
+        self.device = device
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.pin_memory = device.startswith('cuda')
+        self.model: Optional[torch.nn.Module] = None
+
+    def load(self) -> None:
+        import unicom
+        model, self.transform = unicom.load("ViT-B/16")
+        self.model = model.to(self.device).eval()
+
+    def unload(self) -> None:
+        self.model = None
+        if self.device.startswith('cuda'):
+            torch.cuda.empty_cache()
+
+    def __call__(self, batch: torch.Tensor) -> np.ndarray:
+        assert self.model is not None, "Load the model first"
+        with torch.no_grad():
+            features: np.ndarray = self.model(batch.to(self.device, non_blocking=self.pin_memory)).float().cpu().numpy()
+        return features
+
+
+class _Letterbox():
+    """ PIL version of LongestMaxSize + centered PadIfNeeded used to train the student in embeddings_kd """
+    def __call__(self, image: Image.Image) -> Image.Image:
+        image = image.convert('RGB')
+        scale = IMAGE_SIZE / max(image.size)
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.Resampling.BILINEAR)
+        canvas = Image.new('RGB', (IMAGE_SIZE, IMAGE_SIZE))
+        canvas.paste(image, ((IMAGE_SIZE - size[0]) // 2, (IMAGE_SIZE - size[1]) // 2))
+        return canvas
+
+
+class _CpuBackend(Backend):
+    """
+        Distilled student exported by embeddings_kd/export.py, runs on CPU.
+        Cores are split between the data loader workers decoding jpgs and the intra-op threads of the model,
+        batch size grows with the thread count
+    """
+    def __init__(self, path: str, threads: Optional[int] = None) -> None:
+        assert os.path.isfile(path), f"Model {path} does not exist"
+        self.path = path
+        self.name = f"student:{os.path.basename(path)}"
+        cores = available_cores()
+        self.num_workers = max(1, cores // 4) if cores > 2 else 0
+        self.threads = threads or max(1, cores - self.num_workers)
+        self.batch_size = min(256, 8 * self.threads)
+        self.transform = tvt.Compose([_Letterbox(), tvt.ToTensor(), tvt.Normalize(MEAN, STD)])
+
+
+class TorchScriptBackend(_CpuBackend):
+    def load(self) -> None:
+        torch.set_num_threads(self.threads)
+        self.model = torch.jit.load(self.path, map_location='cpu').eval()
+
+    def unload(self) -> None:
+        self.model = None
+
+    def __call__(self, batch: torch.Tensor) -> np.ndarray:
+        with torch.inference_mode():
+            return self.model(batch).float().numpy()
+
+
+class OnnxBackend(_CpuBackend):
+    def load(self) -> None:
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = self.threads
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(self.path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def unload(self) -> None:
+        self.session = None
+
+    def __call__(self, batch: torch.Tensor) -> np.ndarray:
+        return self.session.run(None, {self.input_name: batch.numpy()})[0]
+
+
+def make_backend(model: str) -> Backend:
+    """
+        "unicom" for the ViT-B/16 teacher on GPU, a path to a .pt TorchScript or .onnx student for CPU
+    """
+    if model == "unicom":
+        return UnicomBackend()
+    if model.endswith(".onnx"):
+        return OnnxBackend(model)
+    if model.endswith(".pt"):
+        return TorchScriptBackend(model)
+    raise ValueError(f"Unknown embedder model {model}")
@@ -0,0 +1,262 @@
+import os
+import uuid
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Iterable, Iterator, Optional, Union
+
+import h5py
+import numpy as np
+
+if TYPE_CHECKING:
+    # quantization imports this module
+    from quantization import QuantizedVectors
+
+
+# On disk layout, format_version = 2:
+#   /vectors  float32 (N, dim), chunked by rows and resizable along N
+#   /names    utf-8 strings (N,)
+#   /projection/mean, /projection/components  optional PCA fitted on the network output
+#   attrs["model"]  name of the embedder backend that produced the vectors
+#   attrs["count"]  number of committed rows, written last so a crash during append is ignored
+#   attrs["uid"]  changes whenever the file is rewritten and rows may be reindexed, appends keep it
+# Legacy files (version 1) store one dataset per item, named after the item
+FORMAT_VERSION = 2
+VECTORS_DATASET = "vectors"
+NAMES_DATASET = "names"
+PROJECTION_GROUP = "projection"
+CHUNK_ROWS = 4096
+MMAP_SUFFIX = ".vectors.npy"
+# spare rows allocated when rows are added to a live library, relative to its size
+GROWTH = 0.5
+
+
+def _normalize(x: np.ndarray) -> np.ndarray:
+    norm = np.linalg.norm(x, axis=1, keepdims=True)
+    return x / np.maximum(norm, np.finfo(np.float32).eps)
+
+
+@dataclass(frozen=True)
+class Projection:
+    """
+        PCA from the network output to the stored embedding space,
+        kept with the vectors so new items land in the same space as existing ones
+    """
+    mean: np.ndarray
+    components: np.ndarray
+
+    def apply(self, features: np.ndarray) -> np.ndarray:
+        features = _normalize(features)
+        return _normalize((features - self.mean) @ self.components.T)
+
+
+@dataclass(frozen=True)
+class Embeddings:
+    """
+        Library embeddings: `vectors[i]` is the L2 normalized embedding of `names[i]`
+
+        Vectors are kept as a C-contiguous float32 matrix so BLAS can score them without
+        conversion, and `index` maps an item name to its row so lookups are O(1).
+        Compressed libraries hold a QuantizedVectors instead, which decodes rows to float32 when indexed
+    """
+    names: list[str]
+    vectors: Union[np.ndarray, 'QuantizedVectors']
+    projection: Optional[Projection] = None
+    # embedder backend that produced the vectors, spaces of different models are not comparable
+    model: Optional[str] = None
+    index: dict[str, int] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        assert len(self.names) == len(self.vectors), "Names and vectors count mismatch"
+        if isinstance(self.vectors, np.ndarray):
+            object.__setattr__(self, 'vectors', np.ascontiguousarray(self.vectors, dtype=np.float32))
+        object.__setattr__(self, 'index', {name: i for i, name in enumerate(self.names)})
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def rows(self, names: Iterable[str]) -> np.ndarray:
+        return np.fromiter((self.index[name] for name in names), dtype=np.int64)
+
+    def extend(self, other: 'Embeddings') -> 'Embeddings':
+        if len(self) == 0:
+            return Embeddings(other.names, other.vectors, other.projection or self.projection, other.model)
+        assert self.model is None or other.model == self.model, f"Can't mix {self.model} and {other.model} embeddings"
+        vectors = np.concatenate([self.vectors, other.vectors])
+        return Embeddings(self.names + other.names, vectors, self.projection, self.model)
+
+    def without(self, names: set[str]) -> 'Embeddings':
+        keep = np.array([i for i, name in enumerate(self.names) if name not in names], dtype=np.int64)
+        return Embeddings([self.names[i] for i in keep], self.vectors[keep], self.projection, self.model)
+
+
+def save_embeddings(path: str, data: Embeddings) -> None:
+    """ Writes to a temporary file first, so a crash never leaves a truncated file behind """
+    tmp_path = path + ".tmp"
+    with h5py.File(tmp_path, 'w') as f:
+        f.attrs["format_version"] = FORMAT_VERSION
+        f.attrs["uid"] = uuid.uuid4().hex
+        _create_datasets(f, data)
+    os.replace(tmp_path, path)
+
+
+def read_embeddings(path: str, mmap: bool = False) -> Embeddings:
+    """
+        mmap=False reads the whole matrix in one call
+        mmap=True maps a flat .npy copy of the vectors stored next to the file, rows are paged in on demand
+        and the pages are shared by every process mapping the same file
+    """
+    assert os.path.exists(path), f"File {path} does not exist"
+    assert not is_legacy_embeddings(path), f"File {path} uses legacy format, upgrade it first"
+    with h5py.File(path, 'r') as f:
+        count = int(f.attrs["count"])
+        names = list(f[NAMES_DATASET].asstr()[:count])
+        if mmap:
+            vectors = _mmap_vectors(path, f[VECTORS_DATASET], count)
+        else:
+            vectors = f[VECTORS_DATASET][:count]
+        projection = None
+        if PROJECTION_GROUP in f:
+            group = f[PROJECTION_GROUP]
+            projection = Projection(group["mean"][()], group["components"][()])
+        model = f.attrs.get("model")
+    return Embeddings(names, vectors, projection, model)
+
+
+def append_embeddings(path: str, data: Embeddings) -> None:
+    """ Appends rows in place, the projection of `data` is ignored """
+    with h5py.File(path, 'a') as f:
+        model = f.attrs.get("model")
+        assert model is None or data.model == model, f"Can't append {data.model} embeddings to {model} ones"
+        count = int(f.attrs["count"])
+        for name, values in ((VECTORS_DATASET, data.vectors), (NAMES_DATASET, data.names)):
+            dataset = f[name]
+            dataset.resize(count + len(data), axis=0)
+            dataset[count:] = values
+        f.attrs["count"] = count + len(data)
+
+
+def read_names(path: str) -> list[str]:
+    """ Names of the committed rows, without reading any vectors """
+    with h5py.File(path, 'r') as f:
+        return list(f[NAMES_DATASET].asstr()[:int(f.attrs["count"])])
+
+
+def iter_embeddings(path: str, chunk_rows: int = CHUNK_ROWS) -> Iterator[tuple[list[str], np.ndarray]]:
+    """ Names and vectors of the committed rows, `chunk_rows` at a time """
+    with h5py.File(path, 'r') as f:
+        count = int(f.attrs["count"])
+        for start in range(0, count, chunk_rows):
+            stop = min(start + chunk_rows, count)
+            yield list(f[NAMES_DATASET].asstr()[start:stop]), f[VECTORS_DATASET][start:stop]
+
+
+def embeddings_model(path: str) -> Optional[str]:
+    with h5py.File(path, 'r') as f:
+        return f.attrs.get("model")
+
+
+def embeddings_uid(path: str) -> str:
+    with h5py.File(path, 'r') as f:
+        return str(f.attrs.get("uid", ""))
+
+
+def is_legacy_embeddings(path: str) -> bool:
+    with h5py.File(path, 'r') as f:
+        return f.attrs.get("format_version", 1) < FORMAT_VERSION
+
+
+def upgrade_embeddings(path: str) -> bool:
+    """ Converts a legacy per-item file to the current format in place, returns False if nothing to do """
+    if not is_legacy_embeddings(path):
+        return False
+    with h5py.File(path, 'r') as f:
+        names = list(f.keys())
+        vectors = np.empty((len(names), f[names[0]].shape[0] if names else 0), dtype=np.float32)
+        for i, name in enumerate(names):
+            f[name].read_direct(vectors, dest_sel=np.s_[i])
+    save_embeddings(path, Embeddings(names, vectors))
+    return True
+
+
+def extend_rows(array: np.ndarray, more: np.ndarray) -> np.ndarray:
+    """
+        `array` followed by `more`. Rows are written into spare capacity of the buffer `array` starts,
+        the array is copied to a GROWTH times larger buffer only when it is full, so adding rows is amortized
+        O(rows added). Arrays returned before stay valid, rows they cover are never written by this function,
+        only the latest array may be extended
+    """
+    count = len(array)
+    total = count + len(more)
+    buffer = array.base
+    if not (isinstance(buffer, np.ndarray) and buffer.flags.writeable and buffer.flags.c_contiguous and
+            buffer.dtype == array.dtype and buffer.shape[1:] == array.shape[1:] and len(buffer) >= total and
+            buffer.ctypes.data == array.ctypes.data):
+        buffer = np.empty((max(total, int(count * (1 + GROWTH))),) + array.shape[1:], dtype=array.dtype)
+        buffer[:count] = array
+    buffer[count:total] = more
+    return buffer[:total]
+
+
+def extend_mapped_vectors(path: str, vectors: np.ndarray, more: np.ndarray) -> np.ndarray:
+    """
+        `extend_rows` for the vectors of `path` mapped with read_embeddings(mmap=True),
+        the .npy file gets the spare capacity. Call after appending the rows to `path`, the file must stay newer
+    """
+    mmap_path = _mmap_path(path)
+    count = len(vectors)
+    total = count + len(more)
+    mapped = np.load(mmap_path, mmap_mode='r+')
+    if len(mapped) < total:
+        del mapped
+        _write_mmap(mmap_path, vectors, count, max(total, int(count * (1 + GROWTH))))
+        mapped = np.load(mmap_path, mmap_mode='r+')
+    mapped[count:total] = more
+    mapped.flush()
+    del mapped
+    os.utime(mmap_path)
+    return np.load(mmap_path, mmap_mode='r')[:total]
+
+
+def _create_datasets(f: h5py.File, data: Embeddings) -> None:
+    count, dim = data.vectors.shape
+    f.attrs["count"] = count
+    if data.model is not None:
+        f.attrs["model"] = data.model
+    f.create_dataset(
+        VECTORS_DATASET,
+        data=data.vectors,
+        chunks=(max(1, min(CHUNK_ROWS, count)), dim),
+        maxshape=(None, dim),
+    )
+    f.create_dataset(NAMES_DATASET, data=data.names, dtype=h5py.string_dtype(), maxshape=(None,))
+    if data.projection is not None:
+        group = f.create_group(PROJECTION_GROUP)
+        group.create_dataset("mean", data=data.projection.mean)
+        group.create_dataset("components", data=data.projection.components)
+
+
+def _mmap_path(path: str) -> str:
+    return os.path.splitext(path)[0] + MMAP_SUFFIX
+
+
+def _write_mmap(mmap_path: str, source: np.ndarray, count: int, capacity: int) -> None:
+    """ .npy file of `capacity` rows starting with the first `count` rows of the dataset or array `source` """
+    tmp_path = mmap_path + ".tmp"
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(capacity, source.shape[1]))
+    for start in range(0, count, CHUNK_ROWS):
+        rows = np.s_[start:min(start + CHUNK_ROWS, count)]
+        if isinstance(source, h5py.Dataset):
+            source.read_direct(out, rows, rows)
+        else:
+            out[rows] = source[rows]
+    out.flush()
+    del out
+    os.replace(tmp_path, mmap_path)
+
+
+def _mmap_vectors(path: str, dataset: h5py.Dataset, count: int) -> np.ndarray:
+    """ The .npy file may have spare rows after `count` left by rows added to a live library """
+    mmap_path = _mmap_path(path)
+    if not os.path.exists(mmap_path) or os.path.getmtime(mmap_path) < os.path.getmtime(path) \
+            or len(np.load(mmap_path, mmap_mode='r')) < count:
+        _write_mmap(mmap_path, dataset, count, count)
+    return np.load(mmap_path, mmap_mode='r')[:count]
@@ -0,0 +1,268 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from typing import Callable, Optional, Union
+
+from metrics import INGEST_FAILURES, INGEST_LAG, INGEST_OLDEST, INGEST_QUEUE, INGESTED_IMAGES
+
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_CLOEXEC = 0o2000000
+# struct inotify_event without the name following it: wd, mask, cookie, len
+_EVENT = struct.Struct("iIII")
+
+
+class _InotifyWatcher():
+    """
+        Files closed after writing or moved into the watched folders, reported by the kernel right away.
+        Linux only, and blind to files written by other hosts to a network mount
+    """
+    def __init__(self) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._fd = libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._folders: dict[int, str] = {}
+
+    def add(self, folder: str, path: str) -> None:
+        wd = self._add_watch(self._fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"Can't watch {path}: {os.strerror(errno)}")
+        self._folders[wd] = folder
+
+    def changes(self, timeout: float) -> list[tuple[str, Optional[str]]]:
+        """ (folder, file name) of new files, the name is None when the folder has to be listed """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self._fd, 1 << 16)
+        changes: list[tuple[str, Optional[str]]] = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b"\0")
+            offset += _EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                # the kernel queue was full and events were lost
+                changes.extend((folder, None) for folder in self._folders.values())
+            elif mask & IN_IGNORED:
+                self._folders.pop(wd, None)
+            elif wd in self._folders and name:
+                changes.append((self._folders[wd], os.fsdecode(name)))
+        return changes
+
+
+class _PollingWatcher():
+    """ Folders whose mtime changed, checked every `interval` seconds """
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self._paths: dict[str, str] = {}
+        self._mtimes: dict[str, Optional[int]] = {}
+        self._next_poll = time.monotonic() + interval
+
+    def add(self, folder: str, path: str) -> None:
+        """ The caller lists the folder right after adding it """
+        self._paths[folder] = path
+        self._mtimes[folder] = self._stable_mtime(path)
+
+    def _stable_mtime(self, path: str) -> Optional[int]:
+        """ None when a file added within the timestamp granularity could have kept the mtime """
+        mtime_ns = os.stat(path).st_mtime_ns
+        return None if mtime_ns > (time.time() - self.interval) * 1e9 else mtime_ns
+
+    def changes(self, timeout: float) -> list[tuple[str, Optional[str]]]:
+        time.sleep(max(0.0, min(timeout, self._next_poll - time.monotonic())))
+        if time.monotonic() < self._next_poll:
+            return []
+        self._next_poll = time.monotonic() + self.interval
+        changes: list[tuple[str, Optional[str]]] = []
+        for folder, path in self._paths.items():
+            try:
+                mtime_ns = self._stable_mtime(path)
+            except FileNotFoundError:
+                continue
+            if mtime_ns is None or mtime_ns != self._mtimes[folder]:
+                self._mtimes[folder] = mtime_ns
+                changes.append((folder, None))
+        return changes
+
+
+class Ingestor():
+    """
+        Daemon thread making files that appear in cluster folders sortable without a restart.
+        New files are reported by inotify, or found by listing folders whose mtime changed every `poll_interval`
+        seconds where inotify is not available. They are queued and handed to `ingest` in micro-batches of up to
+        `batch_size` files, a batch waits at most `max_delay` seconds for more files to arrive
+    """
+    batch_size: int = 256
+    max_delay: float = 2.0
+    poll_interval: float = 5.0
+    # files found by listing and modified more recently may still be written, they are checked again later
+    settle_seconds: float = 2.0
+    # poll even where inotify works, it doesn't see files written by other hosts to a network mount
+    polling: bool = False
+
+    def __init__(
+        self,
+        data_root: str,
+        folders: list[str],
+        suffix: str,
+        is_new: Callable[[str], bool],
+        ingest: Callable[[list[str]], list[str]],
+    ) -> None:
+        """
+            is_new: whether a file name is not part of the library yet
+            ingest: embeds files given by paths relative to `data_root` and returns the ones it added
+        """
+        self.data_root = data_root
+        self.suffix = suffix
+        self._is_new = is_new
+        self._ingest = ingest
+        self._lock = threading.Lock()
+        # path relative to the data root -> (time it landed, monotonic time it was found)
+        self._queue: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        self._unsettled: dict[str, None] = {}
+        self._folders: list[str] = []
+        self._added: list[str] = list(folders)
+        self._watcher = self._make_watcher()
+        INGEST_QUEUE.set_function(self.queued)
+        INGEST_OLDEST.set_function(self.oldest)
+        self._thread = threading.Thread(target=self._run, name="ingest", daemon=True)
+        self._thread.start()
+
+    def _make_watcher(self) -> Union[_InotifyWatcher, _PollingWatcher]:
+        if not self.polling:
+            try:
+                return _InotifyWatcher()
+            except (OSError, AttributeError) as e:
+                print(f"inotify is not available ({e}), polling folders every {self.poll_interval}s")
+        return _PollingWatcher(self.poll_interval)
+
+    def watch(self, folder: str) -> None:
+        """ Watches a cluster folder created after the start """
+        with self._lock:
+            self._added.append(folder)
+
+    def queued(self) -> int:
+        with self._lock:
+            return len(self._queue) + len(self._unsettled)
+
+    def oldest(self) -> float:
+        """ Seconds the oldest queued file has been waiting since it landed """
+        with self._lock:
+            landed = min((landed for landed, _ in self._queue.values()), default=None)
+        return 0.0 if landed is None else max(0.0, time.time() - landed)
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self._step()
+            except Exception:
+                traceback.print_exc()
+                time.sleep(self.poll_interval)
+
+    def _step(self) -> None:
+        with self._lock:
+            added, self._added = self._added, []
+        for folder in added:
+            self._watch(folder)
+            # files that landed before the watch, e.g. while the server was starting
+            self._list(folder)
+        timeout = self.poll_interval
+        if self._unsettled:
+            timeout = min(timeout, self.settle_seconds)
+        if self._queue:
+            _, found = next(iter(self._queue.values()))
+            timeout = min(timeout, max(0.0, found + self.max_delay - time.monotonic()))
+        for folder, name in self._watcher.changes(timeout):
+            if name is None:
+                self._list(folder)
+            elif name.endswith(self.suffix) and self._is_new(name):
+                try:
+                    self._enqueue(os.path.join(folder, name), os.stat(os.path.join(self.data_root, folder, name)))
+                except FileNotFoundError:
+                    pass
+        self._check_unsettled()
+        if self._queue:
+            _, found = next(iter(self._queue.values()))
+            if len(self._queue) >= self.batch_size or time.monotonic() - found >= self.max_delay:
+                self._flush()
+
+    def _watch(self, folder: str) -> None:
+        path = os.path.join(self.data_root, folder)
+        try:
+            self._watcher.add(folder, path)
+        except OSError as e:
+            if isinstance(self._watcher, _PollingWatcher):
+                raise
+            # usually the limit of inotify watches per user
+            print(f"{e}, polling folders every {self.poll_interval}s instead")
+            self._watcher = _PollingWatcher(self.poll_interval)
+            for known in self._folders:
+                self._watcher.add(known, os.path.join(self.data_root, known))
+            self._watcher.add(folder, path)
+        self._folders.append(folder)
+
+    def _list(self, folder: str) -> None:
+        try:
+            with os.scandir(os.path.join(self.data_root, folder)) as entries:
+                for entry in entries:
+                    if entry.name.endswith(self.suffix) and entry.is_file() and self._is_new(entry.name):
+                        self._enqueue_settled(os.path.join(folder, entry.name), entry.stat())
+        except FileNotFoundError:
+            pass
+
+    def _check_unsettled(self) -> None:
+        for path in list(self._unsettled):
+            del self._unsettled[path]
+            try:
+                self._enqueue_settled(path, os.stat(os.path.join(self.data_root, path)))
+            except FileNotFoundError:
+                pass
+
+    def _enqueue_settled(self, path: str, stat: os.stat_result) -> None:
+        if stat.st_mtime > time.time() - self.settle_seconds:
+            with self._lock:
+                self._unsettled[path] = None
+        else:
+            self._enqueue(path, stat)
+
+    def _enqueue(self, path: str, stat: os.stat_result) -> None:
+        # ctime changes when a file is created or renamed, so it is the time the file landed in the folder
+        with self._lock:
+            if path not in self._queue:
+                self._queue[path] = (stat.st_ctime, time.monotonic())
+
+    def _flush(self) -> None:
+        with self._lock:
+            batch = [self._queue.popitem(last=False) for _ in range(min(self.batch_size, len(self._queue)))]
+        landed = dict((path, landed) for path, (landed, _) in batch)
+        ingested = self._ingest_batch([path for path, _ in batch])
+        now = time.time()
+        for path in ingested:
+            INGEST_LAG.observe(max(0.0, now - landed[path]))
+        INGESTED_IMAGES.inc(len(ingested))
+
+    def _ingest_batch(self, paths: list[str]) -> list[str]:
+        """ A failing batch is split until the files that can't be embedded, e.g. corrupted ones, are isolated """
+        try:
+            return self._ingest(paths)
+        except Exception:
+            if len(paths) > 1:
+                return self._ingest_batch(paths[:len(paths) // 2]) + self._ingest_batch(paths[len(paths) // 2:])
+            print(f"Failed to ingest {paths[0]}, it is retried on the next start")
+            traceback.print_exc()
+            INGEST_FAILURES.inc()
+            return []
@@ -0,0 +1,118 @@
+import os
+from typing import Optional
+
+import numpy as np
+
+
+INDEX_SUFFIX = ".ivf.npz"
+
+
+def nearest_centroid(vectors: np.ndarray, centroids: np.ndarray, block: int = 1 << 16) -> np.ndarray:
+    """ Inner product assignment, vectors and centroids are L2 normalized """
+    assign = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), block):
+        assign[start:start + block] = np.argmax(vectors[start:start + block] @ centroids.T, axis=1)
+    return assign
+
+
+def spherical_kmeans(sample: np.ndarray, k: int, iterations: int, rng: np.random.Generator) -> np.ndarray:
+    centroids = sample[rng.choice(len(sample), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = nearest_centroid(sample, centroids)
+        order = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=k)
+        filled = counts > 0
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        # empty lists have zero length, so segments between starts of filled lists are exactly their rows
+        centroids[filled] = np.add.reduceat(sample[order], starts[filled], axis=0)
+        # reseed empty lists from random points so every list stays useful
+        empty = np.flatnonzero(~filled)
+        centroids[empty] = sample[rng.choice(len(sample), size=len(empty), replace=False)]
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), np.finfo(np.float32).eps)
+    return centroids
+
+
+class IvfIndex():
+    """
+        Inverted file index: library rows are bucketed by the nearest of `nlist` k-means centroids,
+        a query scores only the rows of its `nprobe` closest buckets.
+        `nprobe` is the recall/latency knob, libraries below `exact_threshold` rows are always scored exactly
+    """
+    nprobe: int = 16
+    exact_threshold: int = 50_000
+    # fall back to exact scoring when probing would touch more than this share of the library
+    max_candidates_share: float = 0.5
+
+    def __init__(self, centroids: np.ndarray, assignments: np.ndarray, uid: str) -> None:
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.uid = uid
+        self._set_assignments(assignments)
+
+    def __len__(self) -> int:
+        return len(self.assignments)
+
+    def _set_assignments(self, assignments: np.ndarray) -> None:
+        self.assignments = assignments.astype(np.int32, copy=False)
+        # CSR layout: rows of list i are order[offsets[i]:offsets[i + 1]]
+        self.order = np.argsort(self.assignments, kind='stable').astype(np.int64)
+        counts = np.bincount(self.assignments, minlength=len(self.centroids))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    @staticmethod
+    def build(vectors: np.ndarray, uid: str, nlist: Optional[int] = None, points_per_list: int = 64,
+              max_sample: int = 1 << 18, iterations: int = 10, seed: int = 0) -> 'IvfIndex':
+        """ nlist defaults to 2 * sqrt(N), centroids are trained on a sample of `points_per_list` points per list """
+        rng = np.random.default_rng(seed)
+        nlist = nlist or max(1, int(2 * np.sqrt(len(vectors))))
+        nlist = min(nlist, len(vectors))
+        sample_size = min(len(vectors), nlist * points_per_list, max(nlist, max_sample))
+        sample_rows = rng.choice(len(vectors), size=sample_size, replace=False)
+        sample = np.asarray(vectors[np.sort(sample_rows)], dtype=np.float32)
+        centroids = spherical_kmeans(sample, nlist, iterations, rng)
+        return IvfIndex(centroids, nearest_centroid(vectors, centroids), uid)
+
+    def add(self, vectors: np.ndarray) -> None:
+        """ Appends rows len(self)..len(self) + len(vectors) using the existing centroids """
+        self._set_assignments(np.concatenate([self.assignments, nearest_centroid(vectors, self.centroids)]))
+
+    def extended(self, vectors: np.ndarray) -> 'IvfIndex':
+        """ Like `add`, but leaves this index as it is for the requests using it """
+        assignments = np.concatenate([self.assignments, nearest_centroid(vectors, self.centroids)])
+        return IvfIndex(self.centroids, assignments, self.uid)
+
+    def reassign(self, vectors: np.ndarray, uid: str) -> None:
+        """ Rows were reindexed, keep the trained centroids and bucket every row again """
+        self.uid = uid
+        self._set_assignments(nearest_centroid(vectors, self.centroids))
+
+    def probe(self, query: np.ndarray, nprobe: Optional[int] = None) -> np.ndarray:
+        """ Lists closest to any of the query vectors """
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        centroid_scores = query @ self.centroids.T
+        return np.unique(np.argpartition(centroid_scores, -nprobe, axis=1)[:, -nprobe:])
+
+    def rows_of(self, lists: np.ndarray) -> Optional[np.ndarray]:
+        """
+            Sorted rows of the given lists,
+            None when they would cover too much of the library to be worth it
+        """
+        sizes = self.offsets[lists + 1] - self.offsets[lists]
+        if sizes.sum() > self.max_candidates_share * len(self):
+            return None
+        rows = np.concatenate([self.order[self.offsets[i]:self.offsets[i + 1]] for i in lists])
+        rows.sort()
+        return rows
+
+    @staticmethod
+    def path_for(embeddings_path: str) -> str:
+        return os.path.splitext(embeddings_path)[0] + INDEX_SUFFIX
+
+    def save(self, path: str) -> None:
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, centroids=self.centroids, assignments=self.assignments, uid=self.uid)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str) -> 'IvfIndex':
+        with np.load(path) as data:
+            return IvfIndex(data["centroids"], data["assignments"], str(data["uid"]))
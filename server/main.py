@@ -1,21 +1,138 @@
 import os
+from typing import Optional
 import fire
 from flask import Flask
 
-from application import Application
+import numpy_sorter
+from application import FILE_FORMAT, Application
 from api_blueprint import make_api
+from embedder import Embedder
+from embedder_backends import make_backend
+from embeddings import upgrade_embeddings
+from duplicates import Duplicates
+from ingest import Ingestor
+from ivf_index import IvfIndex
+from manifest import DirectoryManifest
+from profiler import SamplingProfiler
+from quantization import QuantizedVectors
+from sort_session import SortSessions
+from storage import EXPORT_LINKS, VirtualStorage
+from thumbnails import ThumbnailCache
 
 
 class CliEntryPoint:
-    def serve(self, data_root: str) -> None:
+    def serve(
+        self,
+        data_root: str,
+        mmap_embeddings: bool = False,
+        embedder: str = "unicom",
+        ann_index: bool = False,
+        nprobe: int = IvfIndex.nprobe,
+        precompute: bool = False,
+        prototype_queries: bool = False,
+        compression: Optional[str] = None,
+        rerank: int = QuantizedVectors.rerank,
+        scoring_memory_mb: int = numpy_sorter.MEMORY_BUDGET >> 20,
+        scoring_threads: int = numpy_sorter.THREADS,
+        thumbnails: bool = False,
+        thumbnail_size: int = ThumbnailCache.size,
+        scan_threads: int = DirectoryManifest.threads,
+        sort_sessions: int = SortSessions.max_sessions,
+        session_ttl: float = SortSessions.ttl,
+        ingest: bool = False,
+        ingest_batch: int = Ingestor.batch_size,
+        ingest_polling: bool = Ingestor.polling,
+        storage: str = "move",
+        dedup: bool = False,
+        dedup_threshold: float = Duplicates.threshold,
+        profiler: bool = False,
+        workers: int = 1,
+        threads: int = 4,
+        port: int = 3001,
+    ) -> None:
+        """
+            embedder: "unicom" for the ViT-B/16 teacher on GPU,
+                      or a .pt / .onnx student exported by embeddings_kd/export.py to embed on CPU
+            ann_index: score only rows close to the request with an IVF index, nprobe trades recall for latency
+            precompute: refresh sort_by_class results of recently used classes in the background after each move
+            prototype_queries: score sort_by_class requests against a few centroids of the class instead of
+                               all of its members, much faster for large classes
+            compression: "float16", "int8" or "pq" to keep compressed vectors in memory and score them approximately,
+                         the best `rerank` x 768 candidates are re-scored with the full precision vectors on disk,
+                         rerank=1 disables re-ranking
+            scoring_memory_mb, scoring_threads: temporary memory and threads of a single sort request
+            thumbnails: serve downscaled WebP images from a cache made by background processes
+            sort_sessions: selections kept to sort them incrementally when the annotator adds or removes items,
+                           each holds 4 bytes per library item and expires after `session_ttl` seconds unused
+            scan_threads: folders listed in parallel at startup, only folders changed since the last start are listed
+            ingest: embed files landing in cluster folders while the server runs, in batches of up to `ingest_batch`.
+                    New files are reported by inotify, ingest_polling lists changed folders every few seconds
+                    instead, for network mounts written by other hosts. Needs a single worker
+            storage: "move" moves the files of sorted items to class folders, "virtual" leaves them in place
+                     and records classes in a log of the data root, for read-only or slow archives.
+                     `export` turns a virtually sorted data root into class folders
+            dedup: group items whose embeddings have a cosine of at least `dedup_threshold`, e.g. frames of a burst.
+                   Sort pages show one item per group with the count `d` of the others, a move with
+                   `"duplicates": true` takes them along
+            profiler: allow sampling stacks of the running server through /api/profiler, metrics are always
+                      served at /api/metrics
+            workers: with more than one, serve from that many gunicorn processes with `threads` threads each,
+                     they share memory mapped embeddings and keep clusters in sync through a log file
+        """
         if not os.path.isdir(data_root):
             raise ValueError(f"Data root {data_root} is not a directory")
-        application = Application(data_root)
-        api = make_api(application)
+        if ingest and workers > 1:
+            raise ValueError("Live ingestion needs a single worker")
+        Embedder.backend = make_backend(embedder)
+        Embedder.keep_loaded = ingest
+        IvfIndex.nprobe = nprobe
+        QuantizedVectors.rerank = rerank
+        numpy_sorter.MEMORY_BUDGET = scoring_memory_mb << 20
+        numpy_sorter.THREADS = scoring_threads
+        ThumbnailCache.size = thumbnail_size
+        DirectoryManifest.threads = scan_threads
+        SortSessions.max_sessions = sort_sessions
+        SortSessions.ttl = session_ttl
+        Duplicates.threshold = dedup_threshold
+        Ingestor.batch_size = ingest_batch
+        Ingestor.polling = ingest_polling
+        shared = workers > 1
+        application = Application(
+            data_root, mmap_embeddings or shared, ann_index, precompute, thumbnails, shared, prototype_queries,
+            compression, ingest, storage, dedup)
+        api = make_api(application, SamplingProfiler() if profiler else None)
 
         flask_app = Flask(__name__)
         flask_app.register_blueprint(api)
-        flask_app.run(host = "0.0.0.0", port = 3001)
+        if shared:
+            from production import ProductionServer
+            options = {"bind": f"0.0.0.0:{port}", "workers": workers, "threads": threads, "worker_class": "gthread"}
+            ProductionServer(flask_app, application, options).run()
+        else:
+            flask_app.run(host = "0.0.0.0", port = port)
+
+    def export(self, data_root: str, output: Optional[str] = None, link: str = "symlink") -> None:
+        """
+            Materializes the classes of a data root sorted with storage="virtual" as folders of `output`,
+            with a "symlink", "hardlink" or "copy" of every file. Without `output` the files are moved
+            into class folders of the data root itself, which is served with storage="move" afterwards.
+            Stop the server first
+        """
+        if not os.path.isdir(data_root):
+            raise ValueError(f"Data root {data_root} is not a directory")
+        if link not in EXPORT_LINKS:
+            raise ValueError(f"Unknown link {link}, expected one of {EXPORT_LINKS}")
+        count = VirtualStorage(data_root, FILE_FORMAT).export(output, link)
+        print(f"Exported {count} files to {output or data_root}")
+
+    def upgrade_embeddings(self, path: str) -> None:
+        """ Converts a legacy one-dataset-per-item embeddings file to the single matrix format """
+        if not os.path.isfile(path):
+            raise ValueError(f"Embeddings file {path} does not exist")
+        if upgrade_embeddings(path):
+            print(f"Upgraded {path}")
+        else:
+            print(f"{path} is already up to date")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,87 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+
+MANIFEST_VERSION = 1
+
+
+def _list_folder(path: str, suffix: str) -> tuple[Optional[int], set[str]]:
+    """ mtime of the folder taken before listing it and the files in it with the given suffix """
+    mtime_ns = os.stat(path).st_mtime_ns
+    with os.scandir(path) as entries:
+        # the file type comes with the directory entry, is_file only stats when the filesystem doesn't report it
+        items = {entry.name for entry in entries if entry.name.endswith(suffix) and entry.is_file()}
+    return mtime_ns, items
+
+
+class DirectoryManifest():
+    """
+        Items of every cluster folder with the mtime of the folder when it was listed.
+        Adding, removing or renaming a file changes the mtime of its folder, so a start with a manifest
+        only lists folders whose mtime changed. Folders are listed in parallel by `threads`,
+        which mostly wait on the filesystem, network mounts in particular
+    """
+    threads: int = 16
+    # a folder changed within the filesystem timestamp granularity of its listing could keep its mtime,
+    # such folders are not trusted on the next start
+    racy_seconds: float = 2.0
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def _load(self, suffix: str) -> dict[str, dict]:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                manifest = json.load(f)
+        except ValueError:
+            print(f"Ignoring corrupted {self.path}")
+            return {}
+        if manifest.get("version") != MANIFEST_VERSION or manifest.get("suffix") != suffix:
+            return {}
+        folders: dict[str, dict] = manifest["folders"]
+        return folders
+
+    def _save(self, suffix: str, folders: dict[str, dict]) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"version": MANIFEST_VERSION, "suffix": suffix, "folders": folders}, f)
+        os.replace(tmp_path, self.path)
+
+    def scan(self, data_root: str, suffix: str) -> dict[str, set[str]]:
+        """ Items of every non-hidden folder of `data_root`, listing only the folders changed since the last scan """
+        start = time.time()
+        cached = self._load(suffix)
+        folders = {}
+        with os.scandir(data_root) as entries:
+            for entry in entries:
+                # hidden folders hold server caches, not clusters
+                if entry.is_dir() and not entry.name.startswith('.'):
+                    folders[entry.name] = entry.stat().st_mtime_ns
+
+        stale = [name for name, mtime_ns in folders.items()
+                 if name not in cached or cached[name]["mtime_ns"] != mtime_ns]
+        with ThreadPoolExecutor(self.threads, thread_name_prefix="scan") as pool:
+            listed = dict(zip(stale, pool.map(lambda name: _list_folder(os.path.join(data_root, name), suffix), stale)))
+
+        clusters = {}
+        updated = {}
+        racy_ns = int((start - self.racy_seconds) * 1e9)
+        for name in folders:
+            if name in listed:
+                mtime_ns, items = listed[name]
+                if mtime_ns is not None and mtime_ns >= racy_ns:
+                    mtime_ns = None
+                updated[name] = {"mtime_ns": mtime_ns, "items": sorted(items)}
+            else:
+                items = set(cached[name]["items"])
+                updated[name] = cached[name]
+            clusters[name] = items
+        if stale or folders.keys() != cached.keys():
+            self._save(suffix, updated)
+        print(f"Listed {len(stale)} of {len(folders)} folders in {time.time() - start:.2f}s")
+        return clusters
@@ -0,0 +1,59 @@
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+
+class MembershipLog():
+    """
+        Append-only log of cluster membership changes shared by the worker processes of one server.
+        A worker appends its changes under an exclusive lock and replays the changes of the others before
+        serving each request, so all workers see the same clusters.
+        Every record is one json line, the files on disk stay the source of truth between restarts
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # the log only covers changes made since the server started
+        with open(path, 'w'):
+            pass
+        self._offset = 0
+
+    @contextmanager
+    def _locked(self, operation: int) -> Iterator[Any]:
+        with open(self.path, 'a+b') as f:
+            fcntl.flock(f, operation)
+            try:
+                yield f
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def has_new(self) -> bool:
+        return os.path.getsize(self.path) > self._offset
+
+    def read_new(self) -> list[dict[str, Any]]:
+        """ Records appended by other workers since the last read """
+        with self._locked(fcntl.LOCK_SH) as f:
+            return self._read(f)
+
+    @contextmanager
+    def writer(self) -> Iterator[tuple[list[dict[str, Any]], Any]]:
+        """
+            Holds the exclusive lock, yields records of other workers to apply before changing anything
+            and an `append(record)` callable
+        """
+        with self._locked(fcntl.LOCK_EX) as f:
+            def append(record: dict[str, Any]) -> None:
+                f.seek(0, os.SEEK_END)
+                f.write(json.dumps(record).encode() + b"\n")
+                f.flush()
+                self._offset = f.tell()
+            yield self._read(f), append
+
+    def _read(self, f: Any) -> list[dict[str, Any]]:
+        f.seek(self._offset)
+        data = f.read()
+        # never apply a line cut short by a crashed writer
+        complete = data[:data.rfind(b"\n") + 1]
+        self._offset += len(complete)
+        return [json.loads(line) for line in complete.splitlines()]
@@ -0,0 +1,165 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+
+from system_info import process_rss
+
+
+# seconds, from a cached page to embedding a whole library
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 120.0)
+
+_metrics: list['_Metric'] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != float('inf') else "+Inf"
+
+
+class _Metric():
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        assert len(labels) == len(self.labels), f"{self.name} needs labels {self.labels}"
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"] + self._samples()
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, labels)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in values]
+
+
+class Gauge(_Metric):
+    """ Either set explicitly or read from a function on every scrape """
+    type = "gauge"
+
+    def __init__(self, name: str, help: str) -> None:
+        super().__init__(name, help)
+        self._value: Optional[float] = None
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float) -> None:
+        self._value = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._function = function
+
+    def _samples(self) -> list[str]:
+        value = self._function() if self._function is not None else self._value
+        return [] if value is None else [f"{self.name} {_format_value(value)}"]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # per label values: observations per bucket, the last one is +Inf, and their sum
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = [(key, list(counts), total[0]) for key, (counts, total) in self._values.items()]
+        samples = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                samples.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            samples.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            samples.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return samples
+
+
+REQUEST_SECONDS = Histogram(
+    "clusterator_request_seconds", "Latency of API requests", ("endpoint", "method"))
+REQUESTS = Counter(
+    "clusterator_requests_total", "API requests by response status", ("endpoint", "method", "status"))
+STAGE_SECONDS = Histogram(
+    "clusterator_stage_seconds", "Time spent in stages of sorting, moving and embedding", ("stage",))
+EMBEDDED_IMAGES = Counter("clusterator_embedded_images_total", "Images embedded since the server started")
+EMBEDDING_RATE = Gauge("clusterator_embedding_images_per_second", "Throughput of the last embedding run")
+PROCESS_RSS = Gauge("clusterator_process_resident_memory_bytes", "Resident memory of the process")
+PROCESS_RSS.set_function(process_rss)
+EMBEDDINGS_ROWS = Gauge("clusterator_embeddings_rows", "Rows of the embeddings matrix")
+EMBEDDINGS_BYTES = Gauge(
+    "clusterator_embeddings_bytes", "Size of the embeddings matrix, memory mapped pages are shared between workers")
+CACHE_HITS = Gauge("clusterator_sort_cache_hits", "Sort requests answered from the cache")
+CACHE_MISSES = Gauge("clusterator_sort_cache_misses", "Sort requests computed")
+CACHE_ENTRIES = Gauge("clusterator_sort_cache_entries", "Sort results in the cache")
+SORT_SESSIONS = Gauge("clusterator_sort_sessions", "Sort sessions keeping scores of a selection")
+INGEST_QUEUE = Gauge("clusterator_ingest_queue_files", "New files found in cluster folders and waiting to be embedded")
+INGEST_OLDEST = Gauge("clusterator_ingest_oldest_seconds", "Time the oldest queued new file has been waiting")
+INGEST_LAG = Histogram(
+    "clusterator_ingest_lag_seconds", "Time from a file landing in a cluster folder to it being sortable")
+INGESTED_IMAGES = Counter("clusterator_ingested_images_total", "New files made sortable without a restart")
+INGEST_FAILURES = Counter("clusterator_ingest_failed_images_total", "New files whose batch failed to embed")
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """ Records the duration of the block as a `clusterator_stage_seconds` observation """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+
+def render() -> str:
+    """
+        Every metric in the Prometheus text exposition format.
+        Metrics are kept per process, with several workers each scrape is answered by one of them
+    """
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
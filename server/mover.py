@@ -0,0 +1,143 @@
+import json
+import os
+import shutil
+import threading
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+from metrics import span
+
+
+def _write_durable(path: str, data: dict[str, Any]) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    dir_fd = os.open(os.path.dirname(path), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class BulkMover():
+    """
+        Moves batches of files between cluster folders.
+        A batch is written to a journal before the first file moves and removed once the caller committed it,
+        `recover` finishes batches interrupted by a crash. Within one filesystem files are renamed,
+        across filesystems they are copied by a pool of `threads`
+    """
+    threads: int = 8
+
+    def __init__(self, journal_dir: str) -> None:
+        self.journal_dir = journal_dir
+        os.makedirs(journal_dir, exist_ok=True)
+
+    def recover(self) -> int:
+        """
+            Rolls interrupted batches forward, or back if the destination folder is gone.
+            Must run before the clusters are read, returns the number of batches recovered
+        """
+        journals = sorted(f for f in os.listdir(self.journal_dir) if f.endswith(".json"))
+        for journal in journals:
+            path = os.path.join(self.journal_dir, journal)
+            with open(path) as f:
+                batch = json.load(f)
+            source, target = batch["from"], batch["to"]
+            if not os.path.isdir(target):
+                source, target = target, source
+            for item in batch["items"]:
+                from_path, to_path = os.path.join(source, item), os.path.join(target, item)
+                if os.path.exists(from_path) and not os.path.exists(to_path):
+                    shutil.move(from_path, to_path)
+            os.remove(path)
+        return len(journals)
+
+    @contextmanager
+    def batch(self, from_dir: str, to_dir: str, items: list[str]) -> Iterator[None]:
+        """
+            Moves the files on enter, the body commits the move in memory.
+            If moving or the body fails, files already moved are moved back
+        """
+        journal = os.path.join(self.journal_dir, f"{uuid.uuid4().hex}.json")
+        _write_durable(journal, {"from": from_dir, "to": to_dir, "items": items})
+        moved: list[str] = []
+        try:
+            with span("move.files"):
+                self._move_files(from_dir, to_dir, items, moved)
+            yield
+        except BaseException:
+            # if moving back fails too the journal stays and the batch is finished by `recover`
+            self._move_files(to_dir, from_dir, moved, [])
+            os.remove(journal)
+            raise
+        os.remove(journal)
+
+    def _move_files(self, from_dir: str, to_dir: str, items: list[str], moved: list[str]) -> None:
+        if os.stat(from_dir).st_dev == os.stat(to_dir).st_dev:
+            for item in items:
+                os.rename(os.path.join(from_dir, item), os.path.join(to_dir, item))
+                moved.append(item)
+            return
+
+        lock = threading.Lock()
+
+        def move(item: str) -> None:
+            shutil.move(os.path.join(from_dir, item), os.path.join(to_dir, item))
+            with lock:
+                moved.append(item)
+
+        with ThreadPoolExecutor(self.threads, thread_name_prefix="mover") as pool:
+            # consume the results to raise the first failure, the pool waits for the running moves on exit
+            for _ in pool.map(move, items):
+                pass
+
+
+class Jobs():
+    """
+        Runs background jobs one at a time in submission order.
+        The status of each job is a file, so any worker process of the server can report it
+    """
+    def __init__(self, jobs_dir: str) -> None:
+        self.jobs_dir = jobs_dir
+        shutil.rmtree(jobs_dir, ignore_errors=True)
+        os.makedirs(jobs_dir)
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def after_fork(self) -> None:
+        self._executor = None
+
+    def submit(self, job: Callable[[], None], description: dict[str, Any]) -> str:
+        job_id = uuid.uuid4().hex
+        self._set_status(job_id, {**description, "status": "running"})
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(1, thread_name_prefix="jobs")
+        self._executor.submit(self._run, job_id, job, description)
+        return job_id
+
+    def status(self, job_id: str) -> Optional[dict[str, Any]]:
+        path = os.path.join(self.jobs_dir, f"{job_id}.json")
+        if not job_id.isalnum() or not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def _run(self, job_id: str, job: Callable[[], None], description: dict[str, Any]) -> None:
+        try:
+            job()
+            self._set_status(job_id, {**description, "status": "done"})
+        except Exception as e:
+            traceback.print_exc()
+            self._set_status(job_id, {**description, "status": "failed", "error": str(e)})
+
+    def _set_status(self, job_id: str, status: dict[str, Any]) -> None:
+        path = os.path.join(self.jobs_dir, f"{job_id}.json")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(status, f)
+        os.replace(tmp_path, path)
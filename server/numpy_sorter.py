@@ -1,17 +1,270 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Union
+
 import numpy as np
-from embedder import Embeddings
+from embeddings import Embeddings
+from ivf_index import IvfIndex
+from metrics import span
+from quantization import QuantizedVectors
+
+
+# bytes of temporary buffers used by scoring, split between the threads
+MEMORY_BUDGET = 256 << 20
+# threads scoring row blocks in parallel, numpy releases the GIL inside the matrix product
+THREADS = 1
+# request items scored per matrix product
+MAX_QUERY_BLOCK = 4096
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_threads = 0
 
 
 def find_close_to_many(
     request: set[str],
     embeddings: Embeddings,
-    target_count: int
+    target_count: int,
+    index: Optional[IvfIndex] = None,
+    rows: Optional[np.ndarray] = None,
+) -> list[tuple[str, float]]:
+    """
+        Library items with the highest max cosine similarity to any of the request items.
+        `rows` restricts scoring to these sorted library rows, request items are never returned.
+        With an `index` only rows of the probed buckets are scored, unless that leaves less than
+        `target_count` candidates. Small libraries are always scored exactly.
+        Scoring streams over row and request blocks, so memory stays within MEMORY_BUDGET whatever the request size.
+        Compressed vectors are scored approximately, the best candidates are re-ranked with the full precision ones
+    """
+    with span("sort.lookup"):
+        indices = embeddings.rows(request)
+    if len(indices) == 0:
+        return []
+    vectors = embeddings.vectors
+    candidates = rows
+    if index is not None and len(vectors) >= index.exact_threshold:
+        with span("sort.probe"):
+            probed = _probe(index, vectors, indices)
+            if probed is not None and rows is not None:
+                probed = np.intersect1d(probed, rows, assume_unique=True)
+        if probed is not None and len(probed) >= target_count + len(indices):
+            candidates = probed
+
+    with span("sort.score"):
+        top_score = _max_scores(vectors, vectors, indices, candidates)
+    return _best_rows(embeddings, top_score, indices, candidates, target_count)
+
+
+def max_scores(embeddings: Embeddings, indices: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+    """ Max similarity of every library row, or of every row in `rows`, to the library rows `indices` """
+    count = len(embeddings) if rows is None else len(rows)
+    if len(indices) == 0:
+        return np.full(count, -np.inf, dtype=np.float32)
+    return _max_scores(embeddings.vectors, embeddings.vectors, indices, rows)
+
+
+def find_close_to_scores(
+    scores: np.ndarray,
+    request: set[str],
+    embeddings: Embeddings,
+    target_count: int,
+    rows: Optional[np.ndarray] = None,
 ) -> list[tuple[str, float]]:
-    indices = [embeddings.names.index(name) for name in request]
+    """
+        `find_close_to_many` for max scores of every library row to the request computed beforehand,
+        e.g. kept up to date by a SortSession. `scores` is not modified
+    """
+    indices = embeddings.rows(request)
+    if len(indices) == 0:
+        return []
+    top_score = scores.copy() if rows is None else scores[rows]
+    return _best_rows(embeddings, top_score, indices, rows, target_count)
+
+
+def _best_rows(
+    embeddings: Embeddings,
+    top_score: np.ndarray,
+    indices: np.ndarray,
+    candidates: Optional[np.ndarray],
+    target_count: int,
+) -> list[tuple[str, float]]:
+    """ Best scored candidates that are not request items, `top_score` is overwritten """
     vectors = embeddings.vectors
-    query = vectors[indices]
-    scores = np.dot(vectors, query.T)
-    scores[indices] = -np.inf
-    top_score = np.max(scores, axis=1)
-    top_items = np.argsort(top_score)[-target_count:][::-1]
+    exact: Optional[np.ndarray] = None
+    rerank = 1
+    if isinstance(vectors, QuantizedVectors) and vectors.exact is not None and vectors.rerank > 1:
+        exact, rerank = vectors.exact, vectors.rerank
+    with span("sort.top_k"):
+        if candidates is None:
+            top_score[indices] = -np.inf
+        else:
+            top_score[np.isin(candidates, indices)] = -np.inf
+        top_items = _top_k(top_score, target_count * rerank)
+        top_items = top_items[np.isfinite(top_score[top_items])]
+        top_rows = top_items if candidates is None else candidates[top_items]
+        top_scores = top_score[top_items]
+    if exact is not None:
+        with span("sort.rerank"):
+            # sorted rows read the memory mapped file front to back
+            top_rows = np.sort(top_rows)
+            top_scores = _max_scores(exact, exact, indices, top_rows)
+            best = _top_k(top_scores, target_count)
+            top_rows, top_scores = top_rows[best], top_scores[best]
+    return [(embeddings.names[row], score) for row, score in zip(top_rows, top_scores)]
+
+
+def find_close_to_vectors(
+    query: np.ndarray,
+    embeddings: Embeddings,
+    target_count: int,
+    rows: Optional[np.ndarray] = None,
+) -> list[tuple[str, float]]:
+    """ Like `find_close_to_many` for query vectors that are not library items, e.g. class prototypes """
+    if len(query) == 0:
+        return []
+    with span("sort.score"):
+        top_score = _max_scores(embeddings.vectors, query, np.arange(len(query)), rows)
+    with span("sort.top_k"):
+        top_items = _top_k(top_score, target_count)
+    if rows is not None:
+        return [(embeddings.names[rows[i]], top_score[i]) for i in top_items]
     return [(embeddings.names[i], top_score[i]) for i in top_items]
+
+
+def classify_rows(
+    vectors: Union[np.ndarray, QuantizedVectors],
+    rows: np.ndarray,
+    prototypes: np.ndarray,
+    prototype_class: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+        Best class of every row in `rows`: the class of its most similar prototype.
+        `prototype_class` is sorted, a class scores the max similarity over its prototypes.
+        Returns the best class, its score and the margin to the second best class, whose score is taken as -1
+        when there is only one class. Rows are scored in blocks fitting MEMORY_BUDGET
+    """
+    classes, starts = np.unique(prototype_class, return_index=True)
+    assert np.all(np.diff(prototype_class) >= 0), "Prototypes must be grouped by class"
+    best_class = np.empty(len(rows), dtype=np.int32)
+    best_score = np.empty(len(rows), dtype=np.float32)
+    margin = np.empty(len(rows), dtype=np.float32)
+    if len(rows) == 0 or len(classes) == 0:
+        return best_class[:0], best_score[:0], margin[:0]
+    itemsize = np.dtype(np.float32).itemsize
+    threads = max(1, min(THREADS, len(rows)))
+    block_rows = max(256, MEMORY_BUDGET // threads // (itemsize * (vectors.shape[1] + len(prototypes) + len(classes))))
+
+    def classify_block(start: int) -> None:
+        stop = min(start + block_rows, len(rows))
+        class_scores = np.maximum.reduceat(vectors[rows[start:stop]] @ prototypes.T, starts, axis=1)
+        if len(classes) == 1:
+            best_class[start:stop] = classes[0]
+            best_score[start:stop] = class_scores[:, 0]
+            margin[start:stop] = class_scores[:, 0] + 1
+            return
+        top2 = np.argpartition(class_scores, -2, axis=1)[:, -2:]
+        top2_scores = np.take_along_axis(class_scores, top2, axis=1)
+        first = np.argmax(top2_scores, axis=1)
+        best_class[start:stop] = classes[top2[np.arange(stop - start), first]]
+        best_score[start:stop] = top2_scores.max(axis=1)
+        margin[start:stop] = best_score[start:stop] - top2_scores.min(axis=1)
+
+    starts_of_blocks = range(0, len(rows), block_rows)
+    if threads == 1 or len(starts_of_blocks) == 1:
+        for start in starts_of_blocks:
+            classify_block(start)
+    else:
+        list(_get_executor().map(classify_block, starts_of_blocks))
+    return best_class, best_score, margin
+
+
+def _probe(index: IvfIndex, vectors: Union[np.ndarray, QuantizedVectors], indices: np.ndarray) -> Optional[np.ndarray]:
+    lists = [
+        index.probe(vectors[indices[start:start + MAX_QUERY_BLOCK]])
+        for start in range(0, len(indices), MAX_QUERY_BLOCK)
+    ]
+    return index.rows_of(np.unique(np.concatenate(lists)))
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor, _executor_threads
+    if _executor is None or _executor_threads != THREADS:
+        _executor = ThreadPoolExecutor(max_workers=THREADS, thread_name_prefix="scoring")
+        _executor_threads = THREADS
+    return _executor
+
+
+def _max_scores(
+    vectors: Union[np.ndarray, QuantizedVectors],
+    queries: Union[np.ndarray, QuantizedVectors],
+    indices: np.ndarray,
+    rows: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+        Max similarity of every library row, or of every row in `rows`, to `queries[indices]`.
+        Each row block keeps a running max over request blocks, block sizes are picked so the gathered rows
+        and the score buffer of every thread fit into its share of MEMORY_BUDGET
+    """
+    count = len(vectors) if rows is None else len(rows)
+    dim = vectors.shape[1]
+    itemsize = np.dtype(np.float32).itemsize
+    query_block = min(len(indices), MAX_QUERY_BLOCK)
+    budget = MEMORY_BUDGET
+    # gather the whole query once if it is small, otherwise one block at a time
+    query: Optional[np.ndarray] = None
+    if len(indices) * dim * itemsize <= budget // 4:
+        query = queries[indices]
+        if isinstance(vectors, QuantizedVectors):
+            query = vectors.scoring_query(query)
+        budget -= query.nbytes
+    threads = max(1, min(THREADS, count))
+    block_rows = max(256, budget // threads // (itemsize * (query_block + dim)))
+    result = np.empty(count, dtype=np.float32)
+    # compressed rows are decoded into one reused buffer per thread
+    buffers = threading.local()
+
+    def score_block(start: int) -> None:
+        stop = min(start + block_rows, count)
+        selection = slice(start, stop) if rows is None else rows[start:stop]
+        if isinstance(vectors, QuantizedVectors):
+            if not hasattr(buffers, "block"):
+                buffers.block = np.empty((block_rows, dim), dtype=np.float32)
+            block = vectors.scoring_rows(selection, buffers.block)
+        else:
+            block = vectors[selection]
+        scores = np.empty((stop - start, query_block), dtype=np.float32)
+        out = result[start:stop]
+        out.fill(-np.inf)
+        for q_start in range(0, len(indices), query_block):
+            q_stop = min(q_start + query_block, len(indices))
+            if query is not None:
+                query_part = query[q_start:q_stop]
+            else:
+                query_part = queries[indices[q_start:q_stop]]
+                if isinstance(vectors, QuantizedVectors):
+                    query_part = vectors.scoring_query(query_part)
+            block_scores = scores[:, :q_stop - q_start]
+            np.matmul(block, query_part.T, out=block_scores)
+            np.maximum(out, block_scores.max(axis=1), out=out)
+
+    starts = range(0, count, block_rows)
+    if threads == 1 or len(starts) == 1:
+        for start in starts:
+            score_block(start)
+    else:
+        list(_get_executor().map(score_block, starts))
+    return result
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+        Indices of the `k` largest scores in descending order.
+        argpartition is O(N), only the selected `k` rows get fully sorted
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        top = np.argpartition(scores, len(scores) - k)[-k:]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(scores[top])[::-1]]
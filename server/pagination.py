@@ -0,0 +1,66 @@
+import base64
+import secrets
+from dataclasses import dataclass
+
+import numpy as np
+
+
+_ROUNDS = 4
+_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _mix(values: np.ndarray, key: np.uint64) -> np.ndarray:
+    values = (values ^ key) * _MULTIPLIER
+    return values ^ (values >> np.uint64(29))
+
+
+def random_positions(seed: int, size: int, start: int, count: int) -> np.ndarray:
+    """
+        Positions start..start + count of a random permutation of range(size) picked by `seed`.
+        A Feistel network is a bijection on 2^bits values, positions past `size` are walked through again
+        until they land inside it, so a page costs O(count) whatever the size
+    """
+    count = max(0, min(count, size - start))
+    if count == 0:
+        return np.empty(0, dtype=np.int64)
+    half_bits = max(1, (int(size - 1).bit_length() + 1) // 2)
+    mask = np.uint64((1 << half_bits) - 1)
+    keys = [np.uint64(key) for key in np.random.default_rng(seed).integers(0, 1 << 63, _ROUNDS)]
+
+    def permute(values: np.ndarray) -> np.ndarray:
+        left, right = values >> np.uint64(half_bits), values & mask
+        for key in keys:
+            left, right = right, left ^ (_mix(right, key) & mask)
+        return (left << np.uint64(half_bits)) | right
+
+    positions = permute(np.arange(start, start + count, dtype=np.uint64))
+    outside = positions >= size
+    while outside.any():
+        positions[outside] = permute(positions[outside])
+        outside = positions >= size
+    return positions.astype(np.int64)
+
+
+@dataclass(frozen=True)
+class Cursor():
+    """ Position in a seeded random order of a class, opaque to clients """
+    seed: int
+    offset: int
+
+    @staticmethod
+    def first() -> 'Cursor':
+        return Cursor(secrets.randbits(32), 0)
+
+    def encode(self) -> str:
+        return base64.urlsafe_b64encode(f"{self.seed:x}.{self.offset:x}".encode()).decode()
+
+    @staticmethod
+    def decode(cursor: str) -> 'Cursor':
+        try:
+            seed, offset = base64.urlsafe_b64decode(cursor.encode()).decode().split(".")
+            decoded = Cursor(int(seed, 16), int(offset, 16))
+        except ValueError:
+            raise ValueError(f"Invalid cursor {cursor!r}")
+        if decoded.seed < 0 or decoded.offset < 0:
+            raise ValueError(f"Invalid cursor {cursor!r}")
+        return decoded
@@ -0,0 +1,28 @@
+from typing import Any
+
+from flask import Flask
+from gunicorn.app.base import BaseApplication
+
+from application import Application
+
+
+class ProductionServer(BaseApplication):
+    """
+        Gunicorn pre-fork server. Application is built once in the parent process and inherited by the workers:
+        memory mapped embeddings are shared through the page cache, membership changes go through the
+        application membership log
+    """
+    def __init__(self, flask_app: Flask, application: Application, options: dict[str, Any]) -> None:
+        self.flask_app = flask_app
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self) -> None:
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+        self.cfg.set("preload_app", True)
+        self.cfg.set("post_fork", lambda server, worker: self.application.after_fork())
+
+    def load(self) -> Flask:
+        return self.flask_app
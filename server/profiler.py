@@ -0,0 +1,66 @@
+import os
+import sys
+import threading
+from collections import Counter
+from types import FrameType
+from typing import Optional
+
+
+class SamplingProfiler():
+    """
+        Samples the stacks of all threads every `interval` seconds while running, waiting threads included.
+        Results are in the collapsed stack format of flamegraph.pl and speedscope,
+        cheap enough to run on a production server for a while
+    """
+    def __init__(self) -> None:
+        self._counts: Counter[str] = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.interval = 0.01
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval: float = 0.01) -> None:
+        assert interval > 0
+        self.stop()
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(self._stop,), name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counts.clear()
+
+    def collapsed(self) -> str:
+        with self._lock:
+            counts = self._counts.most_common()
+        return "".join(f"{stack} {count}\n" for stack, count in counts)
+
+    def _run(self, stop: threading.Event) -> None:
+        me = threading.get_ident()
+        while not stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            samples: list[str] = []
+            for ident, current in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                frame: Optional[FrameType] = current
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                samples.append(";".join(reversed(stack)))
+            with self._lock:
+                self._counts.update(samples)
@@ -0,0 +1,127 @@
+from typing import Optional, Union
+
+import numpy as np
+
+from ivf_index import nearest_centroid, spherical_kmeans
+from quantization import QuantizedVectors
+
+
+def _group_sums(vectors: np.ndarray, assignments: np.ndarray, k: int) -> np.ndarray:
+    """ Sum of the vectors assigned to each of `k` groups, k is small so a loop beats np.add.at """
+    sums = np.zeros((k, vectors.shape[1]), dtype=np.float64)
+    for group in np.unique(assignments):
+        sums[group] = vectors[assignments == group].sum(axis=0, dtype=np.float64)
+    return sums
+
+
+def _normalized(sums: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(sums, axis=1, keepdims=True)
+    return (sums / np.maximum(norms, np.finfo(np.float32).eps)).astype(np.float32)
+
+
+class ClassPrototypes():
+    """
+        A few centroids per class summarizing its members, so a query against a class scores a handful of vectors
+        instead of thousands. Centroids are kept as sums of their member vectors, moving items adds and
+        subtracts their vectors. A class is clustered again once its size doubled since it was last clustered,
+        so it gets up to `max_prototypes` centroids as it grows, at an amortized O(1) cost per moved item
+    """
+    max_prototypes: int = 4
+    # members per centroid before another one is added
+    points_per_prototype: int = 32
+    # members sampled to train the centroids of large classes
+    max_sample: int = 1 << 14
+    iterations: int = 10
+
+    def __init__(
+        self, vectors: Union[np.ndarray, QuantizedVectors], row_cluster: np.ndarray, skip_cluster: int, seed: int = 0
+    ) -> None:
+        """ `row_cluster` is the array owned by the caller, it must be updated before `move` is called """
+        self.vectors = vectors
+        self.row_cluster = row_cluster
+        self.skip_cluster = skip_cluster
+        self._rng = np.random.default_rng(seed)
+        # centroid of every row within its class, -1 for rows of the skipped cluster
+        self.row_prototype = np.full(len(vectors), -1, dtype=np.int32)
+        self._sums: dict[int, np.ndarray] = {}
+        self._counts: dict[int, np.ndarray] = {}
+        self._clustered_size: dict[int, int] = {}
+        order = np.argsort(row_cluster, kind='stable')
+        clusters, starts = np.unique(row_cluster[order], return_index=True)
+        for cluster_id, members in zip(clusters, np.split(order, starts[1:])):
+            if cluster_id != skip_cluster:
+                self._cluster(int(cluster_id), np.sort(members))
+
+    def _cluster(self, cluster_id: int, members: np.ndarray) -> None:
+        k = min(self.max_prototypes, max(1, len(members) // self.points_per_prototype))
+        if k == 1:
+            assignments = np.zeros(len(members), dtype=np.int32)
+        else:
+            sample = members
+            if len(members) > self.max_sample:
+                sample = np.sort(self._rng.choice(members, size=self.max_sample, replace=False))
+            centroids = spherical_kmeans(
+                np.asarray(self.vectors[sample], dtype=np.float32), k, self.iterations, self._rng)
+            assignments = nearest_centroid(np.asarray(self.vectors[members], dtype=np.float32), centroids)
+        self._sums[cluster_id] = _group_sums(np.asarray(self.vectors[members]), assignments, k)
+        self._counts[cluster_id] = np.bincount(assignments, minlength=k)
+        self._clustered_size[cluster_id] = len(members)
+        self.row_prototype[members] = assignments
+
+    def move(self, rows: np.ndarray, from_cluster: int, to_cluster: int) -> None:
+        """ Members at `rows` moved from one cluster to the other """
+        if len(rows) == 0:
+            return
+        if from_cluster != self.skip_cluster and from_cluster in self._sums:
+            assignments = self.row_prototype[rows]
+            k = len(self._counts[from_cluster])
+            self._sums[from_cluster] -= _group_sums(np.asarray(self.vectors[rows]), assignments, k)
+            self._counts[from_cluster] -= np.bincount(assignments, minlength=k)
+            if self._counts[from_cluster].sum() == 0:
+                self._drop(from_cluster)
+        self.row_prototype[rows] = -1
+        if to_cluster == self.skip_cluster:
+            return
+        size = len(rows) + (int(self._counts[to_cluster].sum()) if to_cluster in self._counts else 0)
+        if to_cluster not in self._sums or size >= 2 * self._clustered_size[to_cluster]:
+            self._cluster(to_cluster, np.flatnonzero(self.row_cluster == to_cluster))
+            return
+        vectors = np.asarray(self.vectors[rows], dtype=np.float32)
+        assignments = nearest_centroid(vectors, _normalized(self._sums[to_cluster]))
+        k = len(self._counts[to_cluster])
+        self._sums[to_cluster] += _group_sums(vectors, assignments, k)
+        self._counts[to_cluster] += np.bincount(assignments, minlength=k)
+        self.row_prototype[rows] = assignments
+
+    def extend(
+        self, vectors: Union[np.ndarray, QuantizedVectors], row_cluster: np.ndarray, rows: np.ndarray
+    ) -> None:
+        """ `rows` were added to the library, `vectors` and `row_cluster` replace the ones given so far """
+        self.vectors = vectors
+        self.row_cluster = row_cluster
+        added = np.full(len(vectors) - len(self.row_prototype), -1, dtype=np.int32)
+        self.row_prototype = np.concatenate([self.row_prototype, added])
+        for cluster_id in np.unique(row_cluster[rows]):
+            self.move(rows[row_cluster[rows] == cluster_id], self.skip_cluster, int(cluster_id))
+
+    def _drop(self, cluster_id: int) -> None:
+        del self._sums[cluster_id]
+        del self._counts[cluster_id]
+        del self._clustered_size[cluster_id]
+
+    def of_cluster(self, cluster_id: int) -> np.ndarray:
+        """ Normalized centroids of a cluster, empty for clusters without members """
+        if cluster_id not in self._sums:
+            return np.empty((0, self.vectors.shape[1]), dtype=np.float32)
+        return _normalized(self._sums[cluster_id][self._counts[cluster_id] > 0])
+
+    def matrix(self, cluster_ids: Optional[list[int]] = None) -> tuple[np.ndarray, np.ndarray]:
+        """ Normalized centroids of all clusters, or of `cluster_ids`, and the cluster of each, grouped by cluster """
+        cluster_ids = sorted(self._sums if cluster_ids is None else set(cluster_ids) & self._sums.keys())
+        prototypes = [self.of_cluster(cluster_id) for cluster_id in cluster_ids]
+        prototype_cluster = [
+            np.full(len(vectors), cluster_id, dtype=np.int32) for cluster_id, vectors in zip(cluster_ids, prototypes)
+        ]
+        if not prototypes:
+            return np.empty((0, self.vectors.shape[1]), dtype=np.float32), np.empty(0, dtype=np.int32)
+        return np.concatenate(prototypes), np.concatenate(prototype_cluster)
@@ -0,0 +1,259 @@
+import copy
+import os
+from typing import Any, Optional, Union
+
+import numpy as np
+
+from embeddings import extend_rows
+
+
+MODES = ("float16", "int8", "pq")
+# rows encoded and decoded per step, bounds the float32 temporaries
+ENCODE_BLOCK = 1 << 16
+
+
+class QuantizedVectors():
+    """
+        Compressed stand-in for the float32 embeddings matrix. Indexing with a slice or row array decodes those rows
+        to float32, so scoring streams over blocks exactly as it does over the full precision matrix.
+        `exact` is the full precision matrix memory mapped from disk, its pages are only read to re-rank
+        the best candidates, `rerank` times the requested count
+    """
+    mode = ""
+    rerank: int = 4
+
+    def __init__(self, codes: np.ndarray, exact: Optional[np.ndarray] = None) -> None:
+        self.codes = codes
+        self.exact = exact
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return (len(self.codes), self.dim)
+
+    @property
+    def dim(self) -> int:
+        return int(self.codes.shape[1])
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes
+
+    def __getitem__(self, rows: Union[slice, np.ndarray]) -> np.ndarray:
+        return self._decode(self.codes[rows])
+
+    def _decode(self, codes: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    def scoring_rows(self, rows: Union[slice, np.ndarray], out: np.ndarray) -> np.ndarray:
+        """
+            Rows decoded into the float32 buffer `out`, up to factors shared by all rows which `scoring_query`
+            applies to the query instead. Reusing the buffer saves an allocation and its page faults per block
+        """
+        codes = self.codes[rows]
+        out = out[:len(codes)]
+        out[:] = self._decode(codes)
+        return out
+
+    def scoring_query(self, query: np.ndarray) -> np.ndarray:
+        return query
+
+    def encode_more(self, vectors: np.ndarray) -> None:
+        """ Appends codes of new rows using the trained parameters """
+        self.codes = np.concatenate([self.codes, self._encode_blocks(vectors)])
+
+    def extended(self, vectors: np.ndarray, exact: Optional[np.ndarray] = None) -> 'QuantizedVectors':
+        """ Copy with codes of new rows appended, readers of this one keep seeing the rows it had """
+        result = copy.copy(self)
+        result.codes = extend_rows(self.codes, self._encode_blocks(vectors))
+        result.exact = exact
+        return result
+
+    def reencode(self, vectors: np.ndarray) -> None:
+        """ Rows were reindexed, encode all of them again with the trained parameters """
+        self.codes = self._encode_blocks(vectors)
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    def _encode_blocks(self, vectors: np.ndarray) -> np.ndarray:
+        return np.concatenate(
+            [self._encode(np.asarray(vectors[start:start + ENCODE_BLOCK], dtype=np.float32))
+             for start in range(0, len(vectors), ENCODE_BLOCK)] or
+            [self._encode(np.empty((0, vectors.shape[1]), dtype=np.float32))])
+
+    def _parameters(self) -> dict[str, np.ndarray]:
+        return {}
+
+    def save(self, path: str, uid: str) -> None:
+        tmp_path = path + ".tmp.npz"
+        # Any values, a dict of arrays could also bind the `allow_pickle` flag of np.savez
+        arrays: dict[str, Any] = {"mode": self.mode, "uid": uid, "codes": self.codes, **self._parameters()}
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+
+class Float16Vectors(QuantizedVectors):
+    """ Half precision, 2x smaller, scores are within ~1e-3 of the exact ones """
+    mode = "float16"
+
+    @staticmethod
+    def train(vectors: np.ndarray, exact: Optional[np.ndarray] = None) -> 'Float16Vectors':
+        result = Float16Vectors(np.empty((0, vectors.shape[1]), dtype=np.float16), exact)
+        result.encode_more(vectors)
+        return result
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        return vectors.astype(np.float16)
+
+    def _decode(self, codes: np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32)
+
+    def scoring_rows(self, rows: Union[slice, np.ndarray], out: np.ndarray) -> np.ndarray:
+        codes = self.codes[rows]
+        out = out[:len(codes)]
+        np.copyto(out, codes)
+        return out
+
+
+class Int8Vectors(QuantizedVectors):
+    """ Scalar quantization with one scale per dimension, 4x smaller """
+    mode = "int8"
+
+    def __init__(self, codes: np.ndarray, scale: np.ndarray, exact: Optional[np.ndarray] = None) -> None:
+        super().__init__(codes, exact)
+        self.scale = scale.astype(np.float32)
+
+    @staticmethod
+    def train(vectors: np.ndarray, exact: Optional[np.ndarray] = None) -> 'Int8Vectors':
+        peak = np.zeros(vectors.shape[1], dtype=np.float32)
+        for start in range(0, len(vectors), ENCODE_BLOCK):
+            np.maximum(peak, np.abs(np.asarray(vectors[start:start + ENCODE_BLOCK])).max(axis=0), out=peak)
+        result = Int8Vectors(np.empty((0, vectors.shape[1]), dtype=np.int8), np.maximum(peak, 1e-6) / 127, exact)
+        result.encode_more(vectors)
+        return result
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.clip(np.rint(vectors / self.scale), -127, 127).astype(np.int8)
+
+    def _decode(self, codes: np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32) * self.scale
+
+    def scoring_rows(self, rows: Union[slice, np.ndarray], out: np.ndarray) -> np.ndarray:
+        codes = self.codes[rows]
+        out = out[:len(codes)]
+        np.copyto(out, codes)
+        return out
+
+    def scoring_query(self, query: np.ndarray) -> np.ndarray:
+        # rows are scored as raw codes, (codes * scale) @ q == codes @ (q * scale)
+        return query * self.scale
+
+    def _parameters(self) -> dict[str, np.ndarray]:
+        return {"scale": self.scale}
+
+
+class PqVectors(QuantizedVectors):
+    """
+        Product quantization: every vector is split into `subspaces` parts, each part is replaced by the index
+        of the nearest of 256 centroids trained for that part. One byte per part, 512 dims in 64 parts are 32x smaller
+    """
+    mode = "pq"
+
+    def __init__(self, codes: np.ndarray, codebooks: np.ndarray, exact: Optional[np.ndarray] = None) -> None:
+        super().__init__(codes, exact)
+        # (subspaces, 256, dim / subspaces)
+        self.codebooks = codebooks.astype(np.float32)
+
+    @property
+    def dim(self) -> int:
+        return int(self.codebooks.shape[0] * self.codebooks.shape[2])
+
+    @staticmethod
+    def train(vectors: np.ndarray, exact: Optional[np.ndarray] = None, subspaces: Optional[int] = None,
+              sample: int = 1 << 14, iterations: int = 10, seed: int = 0) -> 'PqVectors':
+        """ Parts of 8 dimensions by default, codebooks are trained on `sample` rows, 64 per centroid """
+        dim = vectors.shape[1]
+        subspaces = subspaces or max(1, dim // 8)
+        assert dim % subspaces == 0, f"{dim} dimensions can't be split into {subspaces} subspaces"
+        rng = np.random.default_rng(seed)
+        rows = np.sort(rng.choice(len(vectors), size=min(sample, len(vectors)), replace=False))
+        training = np.asarray(vectors[rows], dtype=np.float32).reshape(len(rows), subspaces, dim // subspaces)
+        codebooks = np.stack([_kmeans(training[:, i], 256, iterations, rng) for i in range(subspaces)])
+        result = PqVectors(np.empty((0, subspaces), dtype=np.uint8), codebooks, exact)
+        result.encode_more(vectors)
+        return result
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        subspaces, _, sub_dim = self.codebooks.shape
+        parts = vectors.reshape(len(vectors), subspaces, sub_dim)
+        codes = np.empty((len(vectors), subspaces), dtype=np.uint8)
+        for i in range(subspaces):
+            codes[:, i] = _nearest(parts[:, i], self.codebooks[i])
+        return codes
+
+    def _decode(self, codes: np.ndarray) -> np.ndarray:
+        subspaces = self.codebooks.shape[0]
+        decoded: np.ndarray = self.codebooks[np.arange(subspaces), codes].reshape(len(codes), self.dim)
+        return decoded
+
+    def scoring_rows(self, rows: Union[slice, np.ndarray], out: np.ndarray) -> np.ndarray:
+        subspaces, centroids, sub_dim = self.codebooks.shape
+        codes = self.codes[rows]
+        out = out[:len(codes)]
+        # codes of part i index rows i * 256.. of the flattened codebooks
+        flat_codes = codes + np.arange(subspaces, dtype=np.intp) * centroids
+        flat_codebooks = self.codebooks.reshape(-1, sub_dim)
+        np.take(flat_codebooks, flat_codes, axis=0, out=out.reshape(len(codes), subspaces, sub_dim))
+        return out
+
+    def _parameters(self) -> dict[str, np.ndarray]:
+        return {"codebooks": self.codebooks}
+
+
+def _nearest(points: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """ Nearest centroid in L2, PQ parts are not normalized so inner product assignment doesn't apply """
+    nearest: np.ndarray = np.argmin((centroids ** 2).sum(axis=1) - 2 * points @ centroids.T, axis=1)
+    return nearest
+
+
+def _kmeans(points: np.ndarray, k: int, iterations: int, rng: np.random.Generator) -> np.ndarray:
+    centroids = points[rng.choice(len(points), size=k, replace=len(points) < k)].copy()
+    for _ in range(iterations):
+        assign = _nearest(points, centroids)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        for j in range(points.shape[1]):
+            sums[:, j] = np.bincount(assign, weights=points[:, j], minlength=k)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # reseed empty centroids from random points
+        empty = np.flatnonzero(~filled)
+        centroids[empty] = points[rng.choice(len(points), size=len(empty))]
+    return centroids
+
+
+def quantize(vectors: np.ndarray, mode: str, exact: Optional[np.ndarray] = None) -> QuantizedVectors:
+    assert mode in MODES, f"Unknown compression {mode}, expected one of {MODES}"
+    if mode == "float16":
+        return Float16Vectors.train(vectors, exact)
+    if mode == "int8":
+        return Int8Vectors.train(vectors, exact)
+    return PqVectors.train(vectors, exact)
+
+
+def load_quantized(path: str, exact: Optional[np.ndarray] = None) -> tuple[QuantizedVectors, str]:
+    """ Quantized vectors saved by `QuantizedVectors.save` and the uid of the embeddings they were made from """
+    with np.load(path) as data:
+        mode, uid, codes = str(data["mode"]), str(data["uid"]), data["codes"]
+        if mode == "float16":
+            return Float16Vectors(codes, exact), uid
+        if mode == "int8":
+            return Int8Vectors(codes, data["scale"], exact), uid
+        return PqVectors(codes, data["codebooks"], exact), uid
+
+
+def path_for(embeddings_path: str, mode: str) -> str:
+    return os.path.splitext(embeddings_path)[0] + f".{mode}.npz"
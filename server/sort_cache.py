@@ -0,0 +1,79 @@
+import threading
+import traceback
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class SortCache():
+    """
+        LRU cache of sort responses. Every membership change bumps `version` and drops all entries,
+        a result computed before the change is never stored. Memory is bounded by
+        `max_entries` responses of at most RESPONSE_LIMIT items each
+    """
+    max_entries: int = 256
+
+    def __init__(self) -> None:
+        self._entries: OrderedDict[Hashable, Any] = OrderedDict()
+        self._lock = threading.Lock()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any, version: int) -> None:
+        """ `version` is the one read before computing `value` """
+        with self._lock:
+            if version != self.version:
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "version": self.version}
+
+
+class BackgroundRefresher():
+    """
+        Daemon thread calling `refresh(key)` for scheduled keys.
+        Keys scheduled again before being processed are refreshed once
+    """
+    def __init__(self, refresh: Callable[[str], None]) -> None:
+        self._refresh = refresh
+        self._pending: OrderedDict[str, None] = OrderedDict()
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="sort-refresher", daemon=True)
+        self._thread.start()
+
+    def schedule(self, keys: list[str]) -> None:
+        with self._condition:
+            for key in keys:
+                self._pending[key] = None
+            self._condition.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                key, _ = self._pending.popitem(last=False)
+            try:
+                self._refresh(key)
+            except Exception:
+                traceback.print_exc()
@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+from embeddings import Embeddings
+from metrics import span
+from numpy_sorter import max_scores
+
+
+# scores of the same pair may differ in the last bits between matrix products of different shapes,
+# rows within this of their max are recomputed when a request item is removed
+REMOVAL_TOLERANCE = 1e-5
+
+
+class SortSession():
+    """
+        Max similarity of every library row to the selection of an annotator, kept from one sort to the next.
+        Adding k items scores the library against those k only. Removing items rescores only the rows whose max
+        may have come from a removed item, against the items kept. Rows added to the library are scored
+        against the whole selection
+    """
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.items: set[str] = set()
+        self.scores: Optional[np.ndarray] = None
+        self.used = time.monotonic()
+
+    def update(self, embeddings: Embeddings, items: set[str]) -> np.ndarray:
+        """ Scores for the selection `items`, call with the lock held """
+        items = {item for item in items if item in embeddings.index}
+        removed = self.items - items
+        added = items - self.items
+        kept = self.items & items
+        if self.scores is None or len(self.scores) > len(embeddings) or len(removed) >= len(kept):
+            # rows were reindexed, or rescoring the kept items costs more than scoring the selection from scratch
+            with span("session.full"):
+                self.scores = max_scores(embeddings, embeddings.rows(items))
+            self.items = items
+            return self.scores
+        if len(self.scores) < len(embeddings):
+            with span("session.new_rows"):
+                new_rows = np.arange(len(self.scores), len(embeddings))
+                self.scores = np.concatenate(
+                    [self.scores, max_scores(embeddings, embeddings.rows(self.items), new_rows)])
+        if removed:
+            with span("session.remove"):
+                affected = np.flatnonzero(
+                    max_scores(embeddings, embeddings.rows(removed)) >= self.scores - REMOVAL_TOLERANCE)
+                self.scores[affected] = max_scores(embeddings, embeddings.rows(kept), affected)
+        if added:
+            with span("session.add"):
+                np.maximum(self.scores, max_scores(embeddings, embeddings.rows(added)), out=self.scores)
+        self.items = items
+        return self.scores
+
+
+class SortSessions():
+    """
+        Sessions by id, the least recently used one is dropped beyond `max_sessions`
+        and any unused for `ttl` seconds. Every session holds one float32 score per library row
+    """
+    max_sessions: int = 16
+    ttl: float = 15 * 60
+
+    def __init__(self) -> None:
+        self._sessions: OrderedDict[str, SortSession] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+    def get(self, session_id: str) -> SortSession:
+        """ The session, a new one if it is unknown or expired """
+        now = time.monotonic()
+        with self._lock:
+            while self._sessions:
+                oldest_id, oldest = next(iter(self._sessions.items()))
+                if now - oldest.used <= self.ttl:
+                    break
+                del self._sessions[oldest_id]
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = SortSession()
+            self._sessions.move_to_end(session_id)
+            session.used = now
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            return session
+
+    def clear(self) -> None:
+        with self._lock:
+            self._sessions.clear()
@@ -1,13 +1,233 @@
+import itertools
+import json
 import os
-import glob
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
 
+from manifest import DirectoryManifest
+from metrics import span
+from mover import BulkMover
 
-FILE_FORMAT = "jpg"
 
+STORAGES = ("move", "virtual")
+JOURNAL_DIRNAME = ".journal"
+MANIFEST_FILENAME = ".manifest.json"
+# class membership of a data root sorted with virtual storage
+CLASSES_LOG_FILENAME = ".classes.log"
+EXPORT_LINKS = ("symlink", "hardlink", "copy")
 
-def Storage():
-    def __init__(self, root_dir: str) -> None:
-        self.root_dir = root_dir
 
-    def get_all_raw(self) -> None:
-        return glob.glob(self.root_dir + f"/**/*.{FILE_FORMAT}", recursive = True)
+class Storage():
+    """
+        Where the files of the library are and what moving an item to another class does to them.
+        Items are listed from the non-hidden folders of the data root, interrupted moves are finished first
+    """
+    # the move is a record appended on enter, cheap enough to be made while membership changes are serialized
+    records_moves = False
+
+    def __init__(self, data_root: str, suffix: str) -> None:
+        self.data_root = data_root
+        self.suffix = suffix
+        self.manifest = DirectoryManifest(os.path.join(data_root, MANIFEST_FILENAME))
+        self.mover = BulkMover(os.path.join(data_root, JOURNAL_DIRNAME))
+        recovered = self.mover.recover()
+        if recovered > 0:
+            print(f"Finished {recovered} interrupted moves")
+
+    def scan(self) -> dict[str, set[str]]:
+        """ Items of every class """
+        raise NotImplementedError
+
+    def file(self, class_name: str, item: str) -> str:
+        """ Path of the file of an item of the class, relative to the data root """
+        raise NotImplementedError
+
+    def create(self, class_name: str) -> None:
+        raise NotImplementedError
+
+    def add(self, paths: list[str]) -> None:
+        """ Files given by paths relative to the data root landed while the server runs """
+
+    @contextmanager
+    def move(self, from_class: str, to_class: str, items: list[str]) -> Iterator[None]:
+        """ Moves the items on enter, the body commits the move in memory. If the body fails the move is undone """
+        raise NotImplementedError
+
+
+class MoveStorage(Storage):
+    """ Every class is a folder of the data root, moving items moves their files """
+    def __init__(self, data_root: str, suffix: str) -> None:
+        assert not os.path.exists(os.path.join(data_root, CLASSES_LOG_FILENAME)), \
+            f"{data_root} is sorted with virtual storage, serve it with storage='virtual' or export it first"
+        super().__init__(data_root, suffix)
+
+    def scan(self) -> dict[str, set[str]]:
+        return self.manifest.scan(self.data_root, self.suffix)
+
+    def file(self, class_name: str, item: str) -> str:
+        return os.path.join(class_name, item)
+
+    def create(self, class_name: str) -> None:
+        os.mkdir(os.path.join(self.data_root, class_name))
+
+    @contextmanager
+    def move(self, from_class: str, to_class: str, items: list[str]) -> Iterator[None]:
+        with self.mover.batch(
+                os.path.join(self.data_root, from_class), os.path.join(self.data_root, to_class), items):
+            yield
+
+
+class VirtualStorage(Storage):
+    """
+        Files never move, for read-only or network mounted archives. Every folder is a class holding the files
+        found in it until the log CLASSES_LOG_FILENAME of the data root moves them elsewhere.
+        A move appends one json line, so it costs O(items moved) whatever the filesystem of the files.
+        Classes created while sorting have no folder, `export` materializes the layout as folders
+    """
+    records_moves = True
+
+    def __init__(self, data_root: str, suffix: str) -> None:
+        super().__init__(data_root, suffix)
+        self.log_path = os.path.join(data_root, CLASSES_LOG_FILENAME)
+        # item -> folder its file is in
+        self.folders: dict[str, str] = {}
+
+    def scan(self) -> dict[str, set[str]]:
+        self.folders = {}
+        classes: dict[str, set[str]] = {}
+        for folder, items in self.manifest.scan(self.data_root, self.suffix).items():
+            classes[folder] = set()
+            self.folders.update((item, folder) for item in items)
+        membership = dict(self.folders)
+        records = self._read_log()
+        for record in records:
+            if record["op"] == "create":
+                classes.setdefault(record["cluster"], set())
+            elif record["op"] == "move":
+                classes.setdefault(record["to"], set())
+                # files deleted since the move are gone from the library
+                membership.update((item, record["to"]) for item in record["items"] if item in membership)
+        for item, class_name in membership.items():
+            classes[class_name].add(item)
+        self._compact(classes, len(records))
+        return classes
+
+    def file(self, class_name: str, item: str) -> str:
+        return os.path.join(self.folders[item], item)
+
+    def create(self, class_name: str) -> None:
+        self._append({"op": "create", "cluster": class_name})
+
+    def add(self, paths: list[str]) -> None:
+        self.folders.update((os.path.basename(path), os.path.dirname(path)) for path in paths)
+
+    @contextmanager
+    def move(self, from_class: str, to_class: str, items: list[str]) -> Iterator[None]:
+        with span("move.log"):
+            self._append({"op": "move", "from": from_class, "to": to_class, "items": items})
+        try:
+            yield
+        except BaseException:
+            self._append({"op": "move", "from": to_class, "to": from_class, "items": items})
+            raise
+
+    def _append(self, record: dict[str, Any]) -> None:
+        """ One write of a whole line, appends of several worker processes don't interleave """
+        line = (json.dumps(record) + "\n").encode()
+        fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            written = os.write(fd, line)
+            assert written == len(line), f"Short write to {self.log_path}"
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _read_log(self) -> list[dict[str, Any]]:
+        if not os.path.exists(self.log_path):
+            return []
+        with open(self.log_path, 'rb') as f:
+            data = f.read()
+        complete = data[:data.rfind(b"\n") + 1]
+        if len(complete) < len(data):
+            # a line cut short by a crash is dropped, later appends must start on a new line
+            os.truncate(self.log_path, len(complete))
+        return [json.loads(line) for line in complete.splitlines()]
+
+    def _compact(self, classes: dict[str, set[str]], count: int) -> None:
+        """ Rewrites the log with at most two records per class when replaying it took more """
+        records: list[dict[str, Any]] = []
+        for class_name, items in classes.items():
+            if not os.path.isdir(os.path.join(self.data_root, class_name)):
+                records.append({"op": "create", "cluster": class_name})
+            moved = [item for item in items if self.folders[item] != class_name]
+            if moved:
+                records.append({"op": "move", "to": class_name, "items": moved})
+        if count <= len(records):
+            return
+        tmp_path = self.log_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.writelines(json.dumps(record) + "\n" for record in records)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.log_path)
+
+    def export(self, output: Optional[str] = None, link: str = "symlink") -> int:
+        """
+            Materializes the classes as folders of `output` holding a `link` of every file, "symlink", "hardlink"
+            or "copy". Files already there are kept, so an interrupted export can be run again.
+            Without `output` the files are moved into class folders of the data root itself and the log is removed,
+            the data root is served with MoveStorage afterwards. Returns the number of files exported
+        """
+        assert link in EXPORT_LINKS, f"Unknown link {link}, expected one of {EXPORT_LINKS}"
+        classes = self.scan()
+        if output is None:
+            return self._export_in_place(classes)
+        count = 0
+        with ThreadPoolExecutor(BulkMover.threads, thread_name_prefix="export") as pool:
+            for class_name, items in classes.items():
+                folder = os.path.join(output, class_name)
+                os.makedirs(folder, exist_ok=True)
+                sources = [os.path.abspath(os.path.join(self.data_root, self.file(class_name, item))) for item in items]
+                targets = [os.path.join(folder, item) for item in items]
+                # consume the results to raise the first failure
+                count += sum(pool.map(_export_file, sources, targets, itertools.repeat(link)))
+        return count
+
+    def _export_in_place(self, classes: dict[str, set[str]]) -> int:
+        count = 0
+        for class_name, items in classes.items():
+            os.makedirs(os.path.join(self.data_root, class_name), exist_ok=True)
+            by_folder: dict[str, list[str]] = {}
+            for item in items:
+                if self.folders[item] != class_name:
+                    by_folder.setdefault(self.folders[item], []).append(item)
+            for folder, moved in by_folder.items():
+                # journaled, a crash leaves the log in place and the next export finishes the job
+                with self.mover.batch(
+                        os.path.join(self.data_root, folder), os.path.join(self.data_root, class_name), moved):
+                    pass
+                count += len(moved)
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+        return count
+
+
+def _export_file(source: str, target: str, link: str) -> int:
+    if os.path.lexists(target):
+        return 0
+    if link == "symlink":
+        os.symlink(source, target)
+    elif link == "hardlink":
+        os.link(source, target)
+    else:
+        shutil.copy2(source, target)
+    return 1
+
+
+def make_storage(storage: str, data_root: str, suffix: str) -> Storage:
+    assert storage in STORAGES, f"Unknown storage {storage}, expected one of {STORAGES}"
+    if storage == "move":
+        return MoveStorage(data_root, suffix)
+    return VirtualStorage(data_root, suffix)
@@ -0,0 +1,21 @@
+import os
+import sys
+
+
+def available_cores() -> int:
+    """ Cores this process may run on, respects affinity masks set by the container or taskset """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def process_rss() -> int:
+    """ Resident memory of this process in bytes, the peak value where /proc is not available """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes everywhere except macOS
+        return peak if sys.platform == "darwin" else peak * 1024
@@ -0,0 +1,51 @@
+import os
+import sys
+from typing import Callable, Iterator
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embedder import Embedder  # noqa: E402
+from embedder_backends import Backend  # noqa: E402
+
+
+def _pixels(image: Image.Image) -> torch.Tensor:
+    pixels = np.asarray(image.convert('RGB').resize((8, 8)), dtype=np.float32) / 255
+    return torch.from_numpy(pixels.reshape(-1))
+
+
+class PixelBackend(Backend):
+    """ Features are the pixels of an 8x8 downscale, deterministic and fast, so tests don't need a model """
+    name = "pixels-8x8"
+    batch_size = 16
+    num_workers = 0
+
+    def load(self) -> None:
+        self.transform = _pixels
+
+    def __call__(self, batch: torch.Tensor) -> np.ndarray:
+        return batch.numpy()
+
+
+@pytest.fixture
+def pixel_embedder(monkeypatch: pytest.MonkeyPatch) -> Iterator[None]:
+    monkeypatch.setattr(Embedder, "backend", PixelBackend())
+    monkeypatch.setattr(Embedder, "embedding_dim", 8)
+    yield
+
+
+@pytest.fixture
+def make_images() -> Callable[[str, list[str]], None]:
+    """ Writes random jpgs with the given names into a folder """
+    rng = np.random.default_rng(0)
+
+    def make(folder: str, names: list[str]) -> None:
+        os.makedirs(folder, exist_ok=True)
+        for name in names:
+            pixels = rng.integers(0, 255, (16, 16, 3), dtype=np.uint8)
+            Image.fromarray(pixels).save(os.path.join(folder, name))
+    return make
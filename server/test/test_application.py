@@ -0,0 +1,123 @@
+import json
+import os
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+import pytest
+
+from cluster import Cluster
+from application import Application, EMBEDDINGS_FILENAME, UNSORTED_CLASS
+from embedder import Embedder
+from embeddings import Embeddings, read_embeddings, save_embeddings
+from storage import CLASSES_LOG_FILENAME, JOURNAL_DIRNAME
+
+
+ITEMS = [f"{i:03}.jpg" for i in range(24)]
+
+
+@pytest.fixture
+def data_root(tmp_path: Path, make_images: Callable[[str, list[str]], None], pixel_embedder: None) -> str:
+    make_images(str(tmp_path / UNSORTED_CLASS), ITEMS)
+    os.makedirs(tmp_path / "cats")
+    return str(tmp_path)
+
+
+def test_startup_finishes_an_interrupted_move(data_root: str) -> None:
+    Application(data_root)
+    moving = ITEMS[:4]
+    # a crash after the journal was written and two files were moved
+    journal_dir = os.path.join(data_root, JOURNAL_DIRNAME)
+    os.makedirs(journal_dir, exist_ok=True)
+    source, target = os.path.join(data_root, UNSORTED_CLASS), os.path.join(data_root, "cats")
+    with open(os.path.join(journal_dir, "batch.json"), 'w') as f:
+        json.dump({"from": source, "to": target, "items": moving}, f)
+    for item in moving[:2]:
+        os.rename(os.path.join(source, item), os.path.join(target, item))
+
+    app = Application(data_root)
+    assert sorted(app.clusters["cats"].items) == moving
+    assert sorted(app.unsorted.items) == ITEMS[4:]
+    assert sorted(os.listdir(target)) == moving
+    assert os.listdir(journal_dir) == []
+    cats = app.cluster_ids["cats"]
+    assert all(app.row_cluster[app.embeddings.rows(moving)] == cats)
+    assert not any(app.row_cluster[app.embeddings.rows(ITEMS[4:])] == cats)
+
+
+def test_files_of_a_move_in_progress_are_found(data_root: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    app = Application(data_root)
+    moving = ITEMS[:3]
+    paths: dict[str, Optional[str]] = {}
+    move_members = app._move_members
+
+    def commit(from_cluster: Cluster, to_cluster: Cluster, items: list[str]) -> None:
+        # files are in the new folder, membership is still the old one
+        paths.update((item, app.item_path(item)) for item in items)
+        move_members(from_cluster, to_cluster, items)
+
+    monkeypatch.setattr(app, "_move_members", commit)
+    app.unsorted2cluster(moving, "cats")
+    assert paths == {item: os.path.join(data_root, "cats", item) for item in moving}
+    assert all(app.item_path(item) == os.path.join(data_root, "cats", item) for item in moving)
+    assert app._moving == {}
+
+
+@pytest.mark.parametrize("storage", ["move", "virtual"])
+def test_workers_moving_the_same_items(data_root: str, storage: str) -> None:
+    os.makedirs(os.path.join(data_root, "dogs"))
+    first, second = (Application(data_root, shared_state=True, storage=storage) for _ in range(2))
+    moving = ITEMS[:3]
+    # both workers accepted the move before either committed it
+    first._reserve_items(first.unsorted, first.clusters["cats"], moving)
+    second._reserve_items(second.unsorted, second.clusters["dogs"], moving[1:] + ITEMS[3:5])
+    first._move2cluster(first.unsorted, first.clusters["cats"], moving)
+    # the files are gone from unsorted or the membership replayed from the first worker says so
+    with pytest.raises((FileNotFoundError, AssertionError)):
+        second._move2cluster(second.unsorted, second.clusters["dogs"], moving[1:] + ITEMS[3:5])
+
+    for app in (first, second, Application(data_root, storage=storage)):
+        app.sync()
+        assert sorted(app.clusters["cats"].items) == moving
+        assert len(app.clusters["dogs"].items) == 0
+        assert sorted(app.unsorted.items) == ITEMS[3:]
+        assert all(app.row_cluster[app.embeddings.rows(moving)] == app.cluster_ids["cats"])
+        assert all(app.row_cluster[app.embeddings.rows(ITEMS[3:])] == app.cluster_ids[UNSORTED_CLASS])
+    assert second._moving == {}
+    if storage == "virtual":
+        with open(os.path.join(data_root, CLASSES_LOG_FILENAME)) as f:
+            assert [json.loads(line)["to"] for line in f] == ["cats"]
+
+
+@pytest.mark.parametrize("options", [{}, {"mmap_embeddings": True}, {"compression": "pq", "dedup": True}])
+def test_empty_data_root(
+    tmp_path: Path, make_images: Callable[[str, list[str]], None], pixel_embedder: None, options: dict[str, Any]
+) -> None:
+    data_root = str(tmp_path)
+    os.makedirs(tmp_path / UNSORTED_CLASS)
+    app = Application(data_root, **options)
+    assert len(app.embeddings) == 0
+    assert os.path.exists(os.path.join(data_root, EMBEDDINGS_FILENAME))
+    Application(data_root, **options)
+    # the first items stored bring the projection
+    make_images(str(tmp_path / UNSORTED_CLASS), ITEMS)
+    app = Application(data_root, **options)
+    assert sorted(app.embeddings.names) == ITEMS
+    assert read_embeddings(os.path.join(data_root, EMBEDDINGS_FILENAME)).projection is not None
+
+
+def test_store_without_projection_is_refused_before_embedding(
+    data_root: str, make_images: Callable[[str, list[str]], None], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    embeddings_path = os.path.join(data_root, EMBEDDINGS_FILENAME)
+    Application(data_root)
+    # what upgrading a legacy store leaves: rows without the model and the projection they were made with
+    stored = read_embeddings(embeddings_path)
+    save_embeddings(embeddings_path, Embeddings(stored.names, stored.vectors))
+    make_images(os.path.join(data_root, UNSORTED_CLASS), ["new.jpg"])
+
+    def embed(*args: Any) -> Embeddings:
+        raise AssertionError("embedded before checking the projection")
+
+    monkeypatch.setattr(Embedder, "generate_embeddings", embed)
+    with pytest.raises(AssertionError, match="no stored projection"):
+        Application(data_root)
@@ -0,0 +1,83 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import duplicates
+from duplicates import Duplicates
+
+
+def _near_duplicates(groups: int, size: int, noise: float, seed: int = 0) -> np.ndarray:
+    """ `size` noisy copies of `groups` random vectors, shuffled and L2 normalized """
+    rng = np.random.default_rng(seed)
+    vectors = np.repeat(rng.standard_normal((groups, 32)), size, axis=0)
+    vectors += noise * rng.standard_normal(vectors.shape)
+    vectors = vectors[rng.permutation(len(vectors))]
+    normalized: np.ndarray = (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+    return normalized
+
+
+def _reference(vectors: np.ndarray, keys: np.ndarray, threshold: float) -> np.ndarray:
+    """ Row by row: the first earlier representative sharing a bucket and similar enough """
+    representative = np.arange(len(vectors))
+    for row in range(len(vectors)):
+        for other in range(row):
+            if representative[other] == other and (keys[:, other] == keys[:, row]).any() and \
+                    vectors[other] @ vectors[row] >= threshold:
+                representative[row] = other
+                break
+    return representative
+
+
+@pytest.mark.parametrize("noise", [0.01, 0.1, 0.2])
+def test_members_are_close_to_their_representative(noise: float) -> None:
+    vectors = _near_duplicates(200, 5, noise)
+    groups = Duplicates.build(vectors, "uid")
+    assert np.all(groups.representative <= np.arange(len(vectors)))
+    assert np.all(groups.is_representative[groups.representative])
+    cosine = np.sum(vectors * vectors[groups.representative], axis=1)
+    assert cosine.min() >= groups.threshold - 1e-6
+    for row in np.flatnonzero(groups.is_representative):
+        assert np.all(groups.representative[groups.members(int(row))] == row)
+
+
+def test_copies_are_grouped() -> None:
+    vectors = _near_duplicates(200, 5, 0.01)
+    groups = Duplicates.build(vectors, "uid")
+    assert np.count_nonzero(groups.is_representative) == 200
+    assert np.all(groups.group_sizes(np.flatnonzero(groups.is_representative)) == 5)
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("count", [0, 1, 333, 700, 999])
+def test_extended_groups_like_built(seed: int, count: int) -> None:
+    vectors = _near_duplicates(200, 5, 0.1, seed)
+    extended = Duplicates.build(vectors[:count], "uid").extended(vectors)
+    built = Duplicates.build(vectors, "uid")
+    assert np.array_equal(extended.representative, built.representative)
+    assert np.array_equal(extended.keys, built.keys)
+
+
+@pytest.mark.parametrize("candidates, pairwise_bucket, max_bucket", [(4, 32, 4096), (1, 32, 4096), (1, 2, 3)])
+def test_groups_match_row_by_row_grouping(
+    monkeypatch: pytest.MonkeyPatch, candidates: int, pairwise_bucket: int, max_bucket: int
+) -> None:
+    """ Few candidates and small buckets take the exact lookup and the block by block paths """
+    monkeypatch.setattr(duplicates, "CANDIDATES", candidates)
+    monkeypatch.setattr(duplicates, "PAIRWISE_BUCKET", pairwise_bucket)
+    monkeypatch.setattr(Duplicates, "max_bucket", max_bucket)
+    vectors = _near_duplicates(60, 6, 0.12)
+    groups = Duplicates.build(vectors, "uid")
+    assert np.array_equal(groups.representative, _reference(vectors, groups.keys, groups.threshold))
+    extended = Duplicates.build(vectors[:100], "uid").extended(vectors)
+    assert np.array_equal(extended.representative, groups.representative)
+
+
+def test_save_load(tmp_path: Path) -> None:
+    groups = Duplicates.build(_near_duplicates(20, 3, 0.01), "uid")
+    path = str(tmp_path / "groups.duplicates.npz")
+    groups.save(path)
+    loaded = Duplicates.load(path)
+    assert loaded.uid == "uid" and loaded.threshold == groups.threshold
+    assert np.array_equal(loaded.representative, groups.representative)
+    assert np.array_equal(loaded.planes, groups.planes)
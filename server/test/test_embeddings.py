@@ -0,0 +1,119 @@
+import os
+from pathlib import Path
+from typing import Any, Callable
+
+import h5py
+import numpy as np
+import pytest
+
+from application import Application, EMBEDDINGS_FILENAME, UNSORTED_CLASS
+from embedder import Embedder
+from embeddings import (
+    MMAP_SUFFIX, VECTORS_DATASET, Embeddings, Projection, append_embeddings, extend_mapped_vectors,
+    is_legacy_embeddings, read_embeddings, save_embeddings, upgrade_embeddings
+)
+
+
+ITEMS = [f"{i:03}.jpg" for i in range(24)]
+
+
+def _embeddings(count: int, seed: int = 0) -> Embeddings:
+    vectors = np.random.default_rng(seed).standard_normal((count, 16)).astype(np.float32)
+    names = [f"{seed}-{i}.jpg" for i in range(count)]
+    projection = Projection(np.zeros(32, dtype=np.float32), np.eye(16, 32, dtype=np.float32))
+    return Embeddings(names, vectors, projection, "model")
+
+
+def _save_legacy(path: str, embeddings: Embeddings) -> None:
+    """ Version 1 layout, one dataset per item and no format version """
+    with h5py.File(path, 'w') as f:
+        for name, vector in zip(embeddings.names, np.asarray(embeddings.vectors)):
+            f.create_dataset(name, data=vector)
+
+
+def _assert_same(loaded: Embeddings, expected: Embeddings) -> None:
+    assert loaded.names == expected.names
+    assert isinstance(loaded.vectors, np.ndarray) and isinstance(expected.vectors, np.ndarray)
+    np.testing.assert_array_equal(loaded.vectors, expected.vectors)
+
+
+def test_legacy_upgrade(tmp_path: Path) -> None:
+    path = str(tmp_path / EMBEDDINGS_FILENAME)
+    expected = _embeddings(10)
+    _save_legacy(path, expected)
+    assert is_legacy_embeddings(path)
+    with pytest.raises(AssertionError, match="legacy format"):
+        read_embeddings(path)
+    assert upgrade_embeddings(path)
+    assert not upgrade_embeddings(path)
+    upgraded = read_embeddings(path)
+    # h5py lists the per-item datasets by name
+    _assert_same(upgraded, Embeddings(sorted(expected.names), expected.vectors[np.argsort(expected.names)]))
+    assert upgraded.projection is None and upgraded.model is None
+
+
+@pytest.mark.parametrize("mmap", [False, True])
+def test_startup_upgrades_a_legacy_store(
+    tmp_path: Path, make_images: Callable[[str, list[str]], None], pixel_embedder: None,
+    monkeypatch: pytest.MonkeyPatch, mmap: bool
+) -> None:
+    make_images(str(tmp_path / UNSORTED_CLASS), ITEMS)
+    path = str(tmp_path / EMBEDDINGS_FILENAME)
+    embedded = Application(str(tmp_path)).embeddings
+    _save_legacy(path, embedded)
+    os.remove(tmp_path / UNSORTED_CLASS / ITEMS[0])
+
+    def embed(*args: Any) -> Embeddings:
+        raise AssertionError("nothing is missing from the store")
+
+    monkeypatch.setattr(Embedder, "generate_embeddings", embed)
+    app = Application(str(tmp_path), mmap_embeddings=mmap)
+    assert not is_legacy_embeddings(path)
+    assert sorted(app.embeddings.names) == ITEMS[1:]
+    rows = embedded.rows(app.embeddings.names)
+    np.testing.assert_array_equal(app.embeddings.vectors, np.asarray(embedded.vectors)[rows])
+    assert len(app.sort({ITEMS[1]})) == len(ITEMS) - 2
+
+
+def test_mmap_matches_reading(tmp_path: Path) -> None:
+    path = str(tmp_path / EMBEDDINGS_FILENAME)
+    expected = _embeddings(100)
+    save_embeddings(path, expected)
+    mapped = read_embeddings(path, mmap=True)
+    _assert_same(mapped, read_embeddings(path))
+    assert isinstance(mapped.vectors, np.ndarray)
+    assert isinstance(mapped.vectors, np.memmap) or isinstance(mapped.vectors.base, np.memmap)
+    assert mapped.projection is not None and expected.projection is not None
+    np.testing.assert_array_equal(mapped.projection.components, expected.projection.components)
+    assert os.path.exists(str(tmp_path / "embeddings") + MMAP_SUFFIX)
+
+
+def test_mmap_follows_appended_rows(tmp_path: Path) -> None:
+    path = str(tmp_path / EMBEDDINGS_FILENAME)
+    first, more = _embeddings(100), _embeddings(30, seed=1)
+    save_embeddings(path, first)
+    read_embeddings(path, mmap=True)
+    # appended by another process, the mapped copy is stale
+    append_embeddings(path, more)
+    _assert_same(read_embeddings(path, mmap=True), first.extend(more))
+
+    # a live library extends the mapped copy in place, the next start maps it as it is
+    mapped = read_embeddings(path, mmap=True)
+    even_more = _embeddings(20, seed=2)
+    append_embeddings(path, even_more)
+    assert isinstance(mapped.vectors, np.ndarray)
+    extended = extend_mapped_vectors(path, mapped.vectors, np.asarray(even_more.vectors))
+    expected = first.extend(more).extend(even_more)
+    np.testing.assert_array_equal(extended, expected.vectors)
+    _assert_same(read_embeddings(path, mmap=True), expected)
+
+
+def test_rows_of_an_interrupted_append_are_ignored(tmp_path: Path) -> None:
+    path = str(tmp_path / EMBEDDINGS_FILENAME)
+    expected = _embeddings(10)
+    save_embeddings(path, expected)
+    # the rows were written, the count wasn't
+    with h5py.File(path, 'a') as f:
+        f[VECTORS_DATASET].resize(15, axis=0)
+    _assert_same(read_embeddings(path), expected)
+    _assert_same(read_embeddings(path, mmap=True), expected)
@@ -0,0 +1,80 @@
+import os
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+import pytest
+
+from application import Application, EMBEDDINGS_FILENAME, UNSORTED_CLASS
+from embeddings import read_embeddings
+
+
+ITEMS = [f"{i:03}.jpg" for i in range(24)]
+MODES = [
+    {},
+    {"mmap_embeddings": True},
+    {"compression": "int8", "dedup": True, "prototype_queries": True},
+    {"storage": "virtual"},
+]
+
+
+def _ingest(app: Application, make_images: Callable[[str, list[str]], None], names: list[str]) -> list[str]:
+    make_images(os.path.join(app.data_root, UNSORTED_CLASS), names)
+    return app.ingest([os.path.join(UNSORTED_CLASS, name) for name in names])
+
+
+@pytest.mark.parametrize("options", MODES)
+def test_ingest_into_an_empty_library(
+    tmp_path: Path, make_images: Callable[[str, list[str]], None], pixel_embedder: None, options: dict[str, Any]
+) -> None:
+    data_root = str(tmp_path)
+    os.makedirs(tmp_path / UNSORTED_CLASS)
+    app = Application(data_root, **options)
+    assert len(_ingest(app, make_images, ITEMS[:12])) == 12
+    assert len(_ingest(app, make_images, ITEMS[12:])) == 12
+    assert sorted(app.embeddings.names) == ITEMS
+    assert sorted(app.unsorted.items) == ITEMS
+    assert app.embeddings.projection is not None
+    assert len(app.sort({ITEMS[0]})) == len(ITEMS) - 1
+
+    stored = read_embeddings(os.path.join(data_root, EMBEDDINGS_FILENAME))
+    assert stored.names == app.embeddings.names
+    assert stored.projection is not None
+    assert isinstance(stored.vectors, np.ndarray)
+    np.testing.assert_allclose(stored.vectors, app._exact_vectors(), atol=1e-6)
+    restarted = Application(data_root, **options)
+    assert sorted(restarted.embeddings.names) == ITEMS
+
+
+@pytest.mark.parametrize("options", MODES)
+def test_ingest_swaps_in_the_new_rows(
+    tmp_path: Path, make_images: Callable[[str, list[str]], None], pixel_embedder: None, options: dict[str, Any]
+) -> None:
+    data_root = str(tmp_path)
+    make_images(str(tmp_path / UNSORTED_CLASS), ITEMS[:16])
+    os.makedirs(tmp_path / "cats")
+    app = Application(data_root, **options)
+    app.unsorted2cluster(ITEMS[:4], "cats")
+    before = app.embeddings
+    exact_before = app._exact_vectors().copy()
+
+    make_images(str(tmp_path / "cats"), ITEMS[16:18])
+    added = _ingest(app, make_images, ITEMS[18:]) + app.ingest([os.path.join("cats", name) for name in ITEMS[16:18]])
+    assert len(added) == 8
+    # requests holding the embeddings from before the swap keep reading the same rows
+    assert len(before) == 16 and before.names == app.embeddings.names[:16]
+    np.testing.assert_array_equal(app._exact_vectors()[:16], exact_before)
+    assert np.asarray(before.vectors).shape == (16, app.embeddings.vectors.shape[1])
+
+    cats = ITEMS[:4] + ITEMS[16:18]
+    assert sorted(app.clusters["cats"].items) == cats
+    assert sorted(app.unsorted.items) == ITEMS[4:16] + ITEMS[18:]
+    assert all(app.row_cluster[app.embeddings.rows(cats)] == app.cluster_ids["cats"])
+    assert all(app.row_cluster[app.embeddings.rows(app.unsorted.items)] == app.cluster_ids[UNSORTED_CLASS])
+    sorted_names = [item["n"] for item in app.sort({ITEMS[18]})]
+    assert sorted(sorted_names) == sorted(set(app.unsorted.items) - {ITEMS[18]})
+    assert {item["n"] for item in app.sort_by_class("cats")} <= set(app.unsorted.items)
+
+    restarted = Application(data_root, **options)
+    assert restarted.embeddings.names == app.embeddings.names
+    np.testing.assert_allclose(restarted._exact_vectors(), app._exact_vectors(), atol=1e-6)
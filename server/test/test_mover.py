@@ -0,0 +1,89 @@
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+from mover import BulkMover
+
+
+def _touch(folder: str, names: list[str]) -> None:
+    os.makedirs(folder, exist_ok=True)
+    for name in names:
+        with open(os.path.join(folder, name), 'w') as f:
+            f.write(name)
+
+
+def _crash_after(journal_dir: str, source: str, target: str, items: list[str], moved: int) -> None:
+    """ Leaves what a process killed during a batch leaves: the journal and the first `moved` files moved """
+    os.makedirs(journal_dir, exist_ok=True)
+    with open(os.path.join(journal_dir, "batch.json"), 'w') as f:
+        json.dump({"from": source, "to": target, "items": items}, f)
+    for item in items[:moved]:
+        os.rename(os.path.join(source, item), os.path.join(target, item))
+
+
+def test_batch_moves_files_and_removes_the_journal(tmp_path: Path) -> None:
+    source, target = str(tmp_path / "a"), str(tmp_path / "b")
+    items = [f"{i}.jpg" for i in range(5)]
+    _touch(source, items + ["other.jpg"])
+    os.makedirs(target)
+    mover = BulkMover(str(tmp_path / ".journal"))
+    with mover.batch(source, target, items):
+        pass
+    assert sorted(os.listdir(target)) == sorted(items)
+    assert os.listdir(source) == ["other.jpg"]
+    assert os.listdir(mover.journal_dir) == []
+
+
+def test_failing_commit_moves_files_back(tmp_path: Path) -> None:
+    source, target = str(tmp_path / "a"), str(tmp_path / "b")
+    items = [f"{i}.jpg" for i in range(5)]
+    _touch(source, items)
+    os.makedirs(target)
+    mover = BulkMover(str(tmp_path / ".journal"))
+    with pytest.raises(RuntimeError):
+        with mover.batch(source, target, items):
+            raise RuntimeError("commit failed")
+    assert sorted(os.listdir(source)) == sorted(items)
+    assert os.listdir(target) == []
+    assert os.listdir(mover.journal_dir) == []
+
+
+def test_failing_move_moves_files_back(tmp_path: Path) -> None:
+    source, target = str(tmp_path / "a"), str(tmp_path / "b")
+    items = [f"{i}.jpg" for i in range(5)]
+    _touch(source, items[:3])
+    os.makedirs(target)
+    mover = BulkMover(str(tmp_path / ".journal"))
+    with pytest.raises(FileNotFoundError):
+        with mover.batch(source, target, items):
+            pass
+    assert sorted(os.listdir(source)) == items[:3]
+    assert os.listdir(target) == []
+
+
+@pytest.mark.parametrize("moved", [0, 2, 5])
+def test_recover_finishes_an_interrupted_batch(tmp_path: Path, moved: int) -> None:
+    source, target = str(tmp_path / "a"), str(tmp_path / "b")
+    items = [f"{i}.jpg" for i in range(5)]
+    _touch(source, items + ["other.jpg"])
+    os.makedirs(target)
+    journal_dir = str(tmp_path / ".journal")
+    _crash_after(journal_dir, source, target, items, moved)
+    assert BulkMover(journal_dir).recover() == 1
+    assert sorted(os.listdir(target)) == sorted(items)
+    assert os.listdir(source) == ["other.jpg"]
+    assert os.listdir(journal_dir) == []
+    assert BulkMover(journal_dir).recover() == 0
+
+
+def test_recover_rolls_back_when_the_destination_is_gone(tmp_path: Path) -> None:
+    source, target = str(tmp_path / "a"), str(tmp_path / "b")
+    items = [f"{i}.jpg" for i in range(5)]
+    _touch(source, items)
+    journal_dir = str(tmp_path / ".journal")
+    _crash_after(journal_dir, source, target, items, 0)
+    assert BulkMover(journal_dir).recover() == 1
+    assert sorted(os.listdir(source)) == sorted(items)
+    assert os.listdir(journal_dir) == []
@@ -0,0 +1,67 @@
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+import numpy as np
+import pytest
+from flask import Flask
+
+from api_blueprint import make_api
+from application import Application, UNSORTED_CLASS
+from pagination import Cursor, random_positions
+
+
+ITEMS = [f"{i:03}.jpg" for i in range(24)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 7, 64, 1000, 1025])
+@pytest.mark.parametrize("page", [1, 3, 100])
+def test_pages_are_a_permutation(size: int, page: int) -> None:
+    positions = np.concatenate([random_positions(7, size, start, page) for start in range(0, size, page)])
+    assert np.array_equal(np.sort(positions), np.arange(size))
+    assert len(random_positions(7, size, size, page)) == 0
+
+
+def test_order_depends_on_the_seed_only() -> None:
+    assert np.array_equal(random_positions(7, 1000, 100, 50), random_positions(7, 1000, 0, 150)[100:])
+    assert not np.array_equal(random_positions(7, 1000, 0, 1000), random_positions(8, 1000, 0, 1000))
+
+
+def test_cursor_round_trip() -> None:
+    cursor = Cursor(0xdeadbeef, 1234)
+    assert Cursor.decode(cursor.encode()) == cursor
+
+
+@pytest.fixture
+def client(tmp_path: Path, make_images: Callable[[str, list[str]], None], pixel_embedder: None) -> Any:
+    make_images(str(tmp_path / UNSORTED_CLASS), ITEMS)
+    flask_app = Flask(__name__)
+    flask_app.register_blueprint(make_api(Application(str(tmp_path))))
+    return flask_app.test_client()
+
+
+def _page(client: Any, cursor: Optional[str], limit: int = 5) -> tuple[list[str], Optional[str]]:
+    query = f"?limit={limit}" + (f"&cursor={cursor}" if cursor is not None else "")
+    response = client.get(f"/api/classes/{UNSORTED_CLASS}{query}")
+    assert response.status_code == 200
+    return [file["n"] for file in response.json["files"]], response.json["next"]
+
+
+def test_class_pages(client: Any) -> None:
+    names, cursor = _page(client, None)
+    cursors = [cursor]
+    while cursor is not None:
+        page, cursor = _page(client, cursor)
+        names += page
+        cursors.append(cursor)
+    assert sorted(names) == ITEMS
+    assert len(cursors) == 5
+    # a page asked again is the same page
+    assert _page(client, cursors[1]) == _page(client, cursors[1])
+    assert _page(client, cursors[1])[0] == names[10:15]
+
+
+@pytest.mark.parametrize("cursor", ["garbage", "!!!", Cursor(1, 2).encode()[:-2], "LTEuMA==", "MQ=="])
+def test_bad_cursor(client: Any, cursor: str) -> None:
+    response = client.get(f"/api/classes/{UNSORTED_CLASS}?cursor={cursor}")
+    assert response.status_code == 400
+    assert "Invalid cursor" in response.json["status"]
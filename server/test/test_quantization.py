@@ -0,0 +1,56 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from embeddings import Embeddings
+from numpy_sorter import find_close_to_many, max_scores
+from quantization import MODES, load_quantized, quantize
+
+
+TARGET_COUNT = 50
+# how much lower the i-th best score found with compressed vectors re-ranked at full precision may be than the
+# exact one. PQ codes are coarse enough to swap near-ties around the cut, the top 50 scores span a few hundredths here
+MAX_REGRET = {"float16": 1e-5, "int8": 1e-5, "pq": 0.02}
+
+
+def _clustered(count: int, dim: int, seed: int = 0) -> np.ndarray:
+    """ Noisy copies of a few directions, library embeddings are clustered rather than uniform """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((40, dim))
+    vectors = centers[rng.integers(0, len(centers), count)] + 0.5 * rng.standard_normal((count, dim))
+    normalized: np.ndarray = (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+    return normalized
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_reranked_top_k_matches_exact(mode: str) -> None:
+    vectors = _clustered(3000, 64)
+    names = [f"{i}.jpg" for i in range(len(vectors))]
+    exact = Embeddings(names, vectors)
+    compressed = Embeddings(names, quantize(vectors, mode, exact=vectors))
+    rng = np.random.default_rng(1)
+    for size in (1, 5, 20):
+        request = set(rng.choice(names, size, replace=False))
+        expected = find_close_to_many(request, exact, TARGET_COUNT)
+        result = find_close_to_many(request, compressed, TARGET_COUNT)
+        assert len(result) == TARGET_COUNT
+        scores = np.array([score for _, score in result])
+        assert np.all(np.diff(scores) <= 0)
+        assert np.max(np.array([score for _, score in expected]) - scores) <= MAX_REGRET[mode]
+        if mode != "pq":
+            assert [name for name, _ in result] == [name for name, _ in expected]
+        # re-ranked scores are the full precision ones
+        exact_scores = max_scores(exact, exact.rows(request), exact.rows(name for name, _ in result))
+        np.testing.assert_allclose(scores, exact_scores, atol=1e-5)
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_save_load(tmp_path: Path, mode: str) -> None:
+    vectors = _clustered(500, 32)
+    quantized = quantize(vectors, mode)
+    path = str(tmp_path / f"embeddings.{mode}.npz")
+    quantized.save(path, "uid")
+    loaded, uid = load_quantized(path)
+    assert uid == "uid" and loaded.mode == mode
+    np.testing.assert_array_equal(loaded[np.arange(len(vectors))], quantized[np.arange(len(vectors))])
@@ -0,0 +1,96 @@
+from typing import Optional
+
+import numpy as np
+import pytest
+
+from embeddings import Embeddings, extend_rows
+from numpy_sorter import find_close_to_many, find_close_to_scores
+from sort_session import SortSession, SortSessions
+
+
+TARGET_COUNT = 200
+
+
+def _vectors(count: int, seed: int) -> np.ndarray:
+    vectors = np.random.default_rng(seed).standard_normal((count, 32)).astype(np.float32)
+    normalized: np.ndarray = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    return normalized
+
+
+def _assert_same_sort(
+    session: SortSession, embeddings: Embeddings, items: set[str], rows: Optional[np.ndarray] = None
+) -> None:
+    known = {item for item in items if item in embeddings.index}
+    expected = find_close_to_many(known, embeddings, TARGET_COUNT, rows=rows)
+    result = find_close_to_scores(session.update(embeddings, items), known, embeddings, TARGET_COUNT, rows)
+    assert [name for name, _ in result] == [name for name, _ in expected]
+    np.testing.assert_allclose([score for _, score in result], [score for _, score in expected], atol=1e-5)
+
+
+@pytest.fixture
+def embeddings() -> Embeddings:
+    return Embeddings([f"{i}.jpg" for i in range(3000)], _vectors(3000, 0))
+
+
+def test_added_and_removed_items(embeddings: Embeddings) -> None:
+    names = embeddings.names
+    session = SortSession()
+    selections = [
+        set(names[:5]),
+        set(names[:20]),                      # added
+        set(names[:20]) | {names[2999]},      # added one
+        set(names[3:20]),                     # removed a few
+        set(names[10:30]),                    # mixed
+        set(names[25:30]),                    # removed most, scored from scratch
+        set(names[25:30]) | {"unknown.jpg"},  # unknown items are ignored
+        set(),
+        set(names[100:110]),
+    ]
+    for items in selections:
+        _assert_same_sort(session, embeddings, items)
+
+
+def test_restricted_rows(embeddings: Embeddings) -> None:
+    names = embeddings.names
+    rows = np.arange(0, len(embeddings), 3)
+    session = SortSession()
+    for items in [set(names[:10]), set(names[5:15]), set(names[5:8])]:
+        _assert_same_sort(session, embeddings, items, rows)
+
+
+def test_rows_added_to_the_library(embeddings: Embeddings) -> None:
+    names = embeddings.names
+    session = SortSession()
+    _assert_same_sort(session, embeddings, set(names[:10]))
+    vectors = embeddings.vectors
+    assert isinstance(vectors, np.ndarray)
+    for step in range(3):
+        more = _vectors(500, step + 1)
+        vectors = extend_rows(vectors, more)
+        count = len(embeddings)
+        embeddings = Embeddings(names + [f"{i}.jpg" for i in range(count, count + len(more))], vectors)
+        names = embeddings.names
+        # new rows are scored against the selection, then the selection changes
+        _assert_same_sort(session, embeddings, set(names[:10]))
+        _assert_same_sort(session, embeddings, set(names[5:12]) | {names[-1]})
+
+
+def test_fewer_rows_are_scored_from_scratch(embeddings: Embeddings) -> None:
+    session = SortSession()
+    _assert_same_sort(session, embeddings, set(embeddings.names[:10]))
+    fewer = embeddings.without(set(embeddings.names[:5]))
+    _assert_same_sort(session, fewer, set(fewer.names[:10]))
+
+
+def test_sessions_drop_least_recently_used(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(SortSessions, "max_sessions", 2)
+    sessions = SortSessions()
+    first = sessions.get("a")
+    sessions.get("b")
+    assert sessions.get("a") is first
+    sessions.get("c")
+    assert len(sessions) == 2
+    assert sessions.get("a") is first
+    monkeypatch.setattr(SortSessions, "ttl", -1.0)
+    assert sessions.get("a") is not first
+    assert len(sessions) == 1
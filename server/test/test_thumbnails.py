@@ -0,0 +1,24 @@
+import os
+from pathlib import Path
+from typing import Callable
+
+from PIL import Image
+
+from thumbnails import ThumbnailCache, _make_thumbnails
+
+
+def test_edited_original_replaces_its_thumbnail(tmp_path: Path, make_images: Callable[[str, list[str]], None]) -> None:
+    make_images(str(tmp_path / "cats"), ["a.jpg"])
+    source = str(tmp_path / "cats" / "a.jpg")
+    cache = ThumbnailCache(str(tmp_path / ".thumbnails"))
+    target = cache.get(source, "a.jpg", os.stat(source))
+    with Image.open(target) as image:
+        assert max(image.size) <= cache.size
+    assert _make_thumbnails(cache.cache_dir, [(source, "a.jpg")], cache.size, cache.quality) == 0
+
+    stat = os.stat(source)
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert _make_thumbnails(cache.cache_dir, [(source, "a.jpg")], cache.size, cache.quality) == 1
+    assert cache.get(source, "a.jpg", os.stat(source)) == target
+    assert os.stat(target).st_mtime_ns == os.stat(source).st_mtime_ns
+    assert os.listdir(os.path.dirname(target)) == [os.path.basename(target)]
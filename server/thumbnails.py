@@ -0,0 +1,112 @@
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable
+
+from PIL import Image
+
+from system_info import available_cores
+
+
+def _make_thumbnail(source: str, target: str, mtime_ns: int, size: int, quality: int) -> None:
+    """ The thumbnail gets the mtime `mtime_ns` of the original it is made from """
+    with Image.open(source) as image:
+        # let the jpeg decoder downscale by up to 8x instead of decoding the full resolution
+        image.draft('RGB', (size, size))
+        thumbnail = image.convert('RGB')
+    thumbnail.thumbnail((size, size), Image.Resampling.BILINEAR)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    # request threads may make the same missing thumbnail at once, each writes its own file
+    fd, tmp_target = tempfile.mkstemp(dir=os.path.dirname(target), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            thumbnail.save(f, format='WEBP', quality=quality)
+        os.utime(tmp_target, ns=(mtime_ns, mtime_ns))
+        # replaces the thumbnail of an older version of the original, the cache holds one file per item
+        os.replace(tmp_target, target)
+    except BaseException:
+        os.remove(tmp_target)
+        raise
+
+
+def _thumbnail_path(cache_dir: str, name: str, size: int) -> str:
+    shard = hashlib.md5(name.encode()).hexdigest()[:2]
+    return os.path.join(cache_dir, shard, f"{name}.{size}.webp")
+
+
+def _is_current(target: str, mtime_ns: int) -> bool:
+    """ The cache is in the data root, mtimes of originals and thumbnails have the same resolution """
+    try:
+        return os.stat(target).st_mtime_ns == mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def _make_thumbnails(cache_dir: str, items: list[tuple[str, str]], size: int, quality: int) -> int:
+    """ Runs in a worker process, skips existing thumbnails and files moved or deleted meanwhile """
+    made = 0
+    for source, name in items:
+        try:
+            mtime_ns = os.stat(source).st_mtime_ns
+            target = _thumbnail_path(cache_dir, name, size)
+            if not _is_current(target, mtime_ns):
+                _make_thumbnail(source, target, mtime_ns, size, quality)
+                made += 1
+        except FileNotFoundError:
+            pass
+    return made
+
+
+class ThumbnailCache():
+    """
+        Downscaled WebP copies of the images, keyed by item name and carrying the mtime of the original,
+        so moving an item between clusters keeps its thumbnail and editing it replaces the thumbnail
+    """
+    size: int = 256
+    quality: int = 80
+    # items per task sent to the worker processes
+    chunk_size: int = 256
+
+    def __init__(self, cache_dir: str) -> None:
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self._pool = ProcessPoolExecutor(
+            max_workers=available_cores(),
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+
+    def path(self, name: str) -> str:
+        return _thumbnail_path(self.cache_dir, name, self.size)
+
+    def etag(self, stat: os.stat_result) -> str:
+        return f"{stat.st_mtime_ns:x}-{stat.st_size:x}-{self.size}"
+
+    def get(self, source: str, name: str, stat: os.stat_result) -> str:
+        """ Path of the thumbnail, made right away if the background workers didn't get to it yet """
+        target = self.path(name)
+        if not _is_current(target, stat.st_mtime_ns):
+            _make_thumbnail(source, target, stat.st_mtime_ns, self.size, self.quality)
+        return target
+
+    def schedule(self, items: Iterable[tuple[str, str]]) -> None:
+        """ Makes thumbnails of (source path, name) pairs in the background, returns immediately """
+        thread = threading.Thread(target=self._submit, args=(list(items),), name="thumbnails", daemon=True)
+        thread.start()
+
+    def _submit(self, items: list[tuple[str, str]]) -> None:
+        futures = [
+            self._pool.submit(
+                _make_thumbnails, self.cache_dir, items[start:start + self.chunk_size], self.size, self.quality)
+            for start in range(0, len(items), self.chunk_size)
+        ]
+        made = 0
+        for future in futures:
+            try:
+                made += future.result()
+            except Exception:
+                traceback.print_exc()
+        print(f"Made {made} thumbnails")
@@ -8,6 +8,8 @@ import Divider from '@mui/material/Divider';
 
 
 const ENDPOINT = "http://localhost:3001/api";
+// sorts of the growing selection are scored incrementally by the server
+const SORT_SESSION = Math.random().toString(36).slice(2);
 
 interface ImageProps {
   label: string;
@@ -37,7 +39,7 @@ class Image extends Component<ImageProps> {
     if (this.props.filename == null) {
       imgSrc = "/icon-image-placeholder.svg";
     } else {
-      imgSrc = ENDPOINT + "/file/" + this.props.label + "/" + this.props.filename;
+      imgSrc = ENDPOINT + "/file/" + this.props.filename;
     }
 
     return (
@@ -122,7 +124,7 @@ function App() {
     fetch(ENDPOINT + "/sort", {
       method: 'post',
       headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ files: staged })
+      body: JSON.stringify({ files: staged, session: SORT_SESSION })
     }).then(response => response.json()).then(
       data => setUngrouped(data["files"])
     )